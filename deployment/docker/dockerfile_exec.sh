@@ -108,11 +108,13 @@ fi
 # Configure the HTTP+applications server.
 # * The port is fixed --- see docker_container_run.sh.
 # * Use 4 concurrent processes by default. Expose management statistics to localhost only.
+# * Enable threads, which are used to refresh the apps catalog in the background.
 cat > /tmp/uwsgi.ini <<EOF;
 [uwsgi]
 http = 0.0.0.0:8000
 wsgi-file = siteapp/wsgi.py
 processes = ${PROCESSES-4}
+enable-threads = true
 stats = 127.0.0.1:9191
 EOF
 
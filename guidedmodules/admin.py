@@ -4,7 +4,7 @@ from django.utils.html import escape as escape_html
 
 from .models import \
 	AppSource, AppInstance, Module, ModuleQuestion, ModuleAsset, \
-	Task, TaskAnswer, TaskAnswerHistory, \
+	Task, TaskRenderedOutput, TaskAnswer, TaskAnswerHistory, \
 	InstrumentationEvent
 
 class AppSourceSpecWidget(forms.Widget):
@@ -260,7 +260,7 @@ class AppSourceAdminForm(forms.ModelForm):
 
 class AppSourceAdmin(admin.ModelAdmin):
 	form = AppSourceAdminForm # customize spec and approved_apps widgets
-	list_display = ('slug', 'source', 'flags')
+	list_display = ('slug', 'source', 'flags', 'catalog_build')
 	filter_horizontal = ('available_to_orgs',)
 	readonly_fields = ('is_system_source',)
 	def source(self, obj):
@@ -269,6 +269,11 @@ class AppSourceAdmin(admin.ModelAdmin):
 		flags = []
 		if obj.is_system_source: flags.append("SYSTEM")
 		return ", ".join(flags)
+	def catalog_build(self, obj):
+		info = obj.get_catalog_build_info()
+		if not info: return ""
+		if info.get("error"): return "failed after {:.1f}s".format(info["duration"])
+		return "{} apps in {:.1f}s".format(info["apps"], info["duration"])
 
 class AppInstanceAdmin(admin.ModelAdmin):
 	list_display = ('appname', 'version_number', 'version_name', 'source', 'system_app')
@@ -293,13 +298,18 @@ class ModuleAssetAdmin(admin.ModelAdmin):
 class TaskAdmin(admin.ModelAdmin):
 	list_display = ('title', 'organization_and_project', 'editor', 'module', 'is_finished', 'submodule_of', 'created')
 	raw_id_fields = ('project', 'editor', 'module')
-	readonly_fields = ('module', 'invitation_history')
+	readonly_fields = ('module', 'invitation_history', 'cached_state_reads')
 	search_fields = ('project__organization__name', 'editor__username', 'editor__email', 'module__key')
 	def submodule_of(self, obj):
 		return obj.is_answer_to_unique()
 	def organization_and_project(self, obj):
 		return obj.project.organization_and_title()
 
+class TaskRenderedOutputAdmin(admin.ModelAdmin):
+	list_display = ('task', 'document', 'format', 'variant', 'size', 'created')
+	raw_id_fields = ('task',)
+	readonly_fields = ('task', 'document', 'format', 'variant', 'size', 'reads', 'created')
+
 class TaskAnswerAdmin(admin.ModelAdmin):
 	list_display = ('question', 'task', '_project', 'created')
 	raw_id_fields = ('task',)
@@ -331,6 +341,7 @@ admin.site.register(Module, ModuleAdmin)
 admin.site.register(ModuleQuestion, ModuleQuestionAdmin)
 admin.site.register(ModuleAsset, ModuleAssetAdmin)
 admin.site.register(Task, TaskAdmin)
+admin.site.register(TaskRenderedOutput, TaskRenderedOutputAdmin)
 admin.site.register(TaskAnswer, TaskAnswerAdmin)
 admin.site.register(TaskAnswerHistory, TaskAnswerHistoryAdmin)
 admin.site.register(InstrumentationEvent, InstrumentationEventAdmin)
@@ -6,13 +6,14 @@
 import enum
 import json
 import sys
+import time
 from collections import OrderedDict
 
-from django.db import transaction
+from django.db import transaction, IntegrityError
 from django.db.models.deletion import ProtectedError
 
 from .models import AppSource, AppInstance, ModuleAsset, \
-                    Module, ModuleQuestion, Task, \
+                    Module, ModuleQuestion, Task, TaskAnswer, \
                     extract_catalog_metadata
 
 from .validate_module_specification import \
@@ -30,6 +31,10 @@ class ModuleDefinitionError(Exception):
 class ValidationError(ModuleDefinitionError):
     def __init__(self, file_name, scope, message):
         super().__init__("There was an error in %s (%s): %s" % (file_name, scope, message))
+        self.error_args = (file_name, scope, message)
+    def __reduce__(self):
+        # So that it can be passed back from a validation worker process.
+        return (ValidationError, self.error_args)
 
 class CyclicDependency(ModuleDefinitionError):
     def __init__(self, path):
@@ -43,12 +48,53 @@ class IncompatibleUpdate(Exception):
     pass
 
 
-@transaction.atomic # there can be an error mid-way through
-def load_app_into_database(app, update_mode=AppImportUpdateMode.CreateInstance, update_appinst=None):
+def load_app_into_database(app, update_mode=AppImportUpdateMode.CreateInstance, update_appinst=None, reuse_identical=False, stats=None, parallel=False):
+    # If stats is a dict, it is filled in with counts of what was done
+    # and how long it took. If parallel is True, the module specifications
+    # of large apps are validated in worker processes (see validate_app_modules).
+    start_time = time.time()
+
     # Pull in all of the modules. We need to know them all because they'll
     # be processed recursively.
     available_modules = dict(app.get_modules())
+    assets = list(app.get_assets())
+
+    # Fingerprint the app content before the module specs are modified
+    # by loading them.
+    content_hash = compute_app_content_hash(app, available_modules, assets)
+
+    # If reuse_identical is set and an AppInstance was already loaded from
+    # identical app content, return it instead. The AppInstance is then
+    # shared by more than one Project, so anything that changes it in place
+    # must call get_app_instance_for_project_update first.
+    if update_appinst is None and reuse_identical:
+        appinst = AppInstance.objects.filter(
+            source=app.store.source,
+            appname=app.name,
+            content_hash=content_hash,
+            system_app=None,
+        ).order_by("id").first()
+        if appinst:
+            return appinst
+
+    # Validate and normalize the module specifications. This doesn't touch
+    # the database and is the slow part of loading a large app, so it is
+    # done before the transaction is started and, if requested, in parallel.
+    validation_start_time = time.time()
+    available_modules = validate_app_modules(app, available_modules, parallel=parallel)
+    validation_time = time.time() - validation_start_time
+
+    appinst = _load_app_into_database(app, update_mode, update_appinst, available_modules, assets, content_hash, stats)
+
+    if stats is not None:
+        stats["validation_time"] = validation_time
+        stats["time"] = time.time() - start_time
 
+    return appinst
+
+
+@transaction.atomic # there can be an error mid-way through
+def _load_app_into_database(app, update_mode, update_appinst, available_modules, assets, content_hash, stats):
     # Create an AppInstance to add new Modules into, unless update_appinst is given.
     if update_appinst is None:
         appinst = AppInstance.objects.create(
@@ -56,24 +102,30 @@ def load_app_into_database(app, update_mode=AppImportUpdateMode.CreateInstance,
             appname=app.name,
             catalog_metadata={},
             asset_paths={},
+            content_hash=content_hash,
         )
     else:
-        # Update Modules in this one.
+        # Update Modules in this one. It will no longer be identical to
+        # the app content it was first loaded from.
         appinst = update_appinst
+        appinst.content_hash = None
 
     # Load them all into the database. Each will trigger load_module_into_database
     # for any modules it depends on.
     processed_modules = { }
+    updated_modules = set()
     for module_id in available_modules.keys():
         load_module_into_database(
             app,
             appinst,
             module_id,
             available_modules, processed_modules,
-            [], update_mode)
+            [], update_mode, updated_modules)
 
     # Load assets.
-    load_module_assets_into_database(app, appinst)
+    old_assets = (appinst.asset_paths, appinst.trust_assets)
+    load_module_assets_into_database(app, appinst, assets)
+    assets_changed = (update_appinst is not None) and (old_assets != (appinst.asset_paths, appinst.trust_assets))
 
     # If there's an 'app' module, move the app catalog information
     # to the AppInstance.
@@ -82,26 +134,67 @@ def load_app_into_database(app, update_mode=AppImportUpdateMode.CreateInstance,
         appinst.save()
         processed_modules['app'].save()
 
-    return appinst
-
-
-def load_module_into_database(app, appinst, module_id, available_modules, processed_modules, dependency_path, update_mode):
-    # Prevent cyclic dependencies between modules.
-    if module_id in dependency_path:
-        raise CyclicDependency(dependency_path)
+    # Clear the cached state of the Tasks of any Modules that were updated
+    # in place, all at once now that the Modules are in their final state.
+    # Templates and output documents of any Module can refer to assets, so
+    # if the assets changed, clear the cached state of all of the app's Tasks.
+    invalidation_start_time = time.time()
+    if assets_changed:
+        tasks = Task.objects.filter(module__app=appinst)
+    else:
+        tasks = Task.objects.filter(module__in=updated_modules)
+    tasks = list(tasks.only("id"))
+    Task.clear_state(tasks)
+
+    if stats is not None:
+        stats.update({
+            "modules": len(processed_modules),
+            "modules_updated": len(updated_modules),
+            "assets_changed": assets_changed,
+            "tasks_invalidated": len(tasks),
+            "invalidation_time": time.time() - invalidation_start_time,
+        })
 
-    # Because of dependencies between modules, we may have already
-    # been here. Do this after the cyclic dependency check or else
-    # we would never see a cyclic dependency.
-    if module_id in processed_modules:
-        return processed_modules[module_id]
+    return appinst
 
-    # Load the module's YAML file.
-    if module_id not in available_modules:
-        raise DependencyError((dependency_path[-1] if len(dependency_path) > 0 else None), module_id)
-
-    spec = available_modules[module_id]
 
+# Apps with fewer modules than this are validated in this process because
+# starting worker processes would take longer than validating them.
+PARALLEL_VALIDATION_MIN_MODULES = 8
+
+def validate_app_modules(app, available_modules, parallel=False):
+    # Validate and normalize every module specification in an app, returning
+    # a new dict of module IDs to normalized specifications. If parallel is
+    # True, large apps are validated in a pool of worker processes, which is
+    # why this must not touch the database. The workers are forked, so only
+    # pass parallel from single-threaded processes like management commands
+    # --- never from the web server, whose processes run other threads
+    # (e.g. the document conversion pool) that a fork could deadlock on.
+    from django.conf import settings
+    workers = min(settings.APP_LOADING_WORKERS, len(available_modules))
+    if not parallel or workers < 2 or len(available_modules) < PARALLEL_VALIDATION_MIN_MODULES:
+        return OrderedDict(
+            (module_id, validate_module_spec(module_id, spec, app))
+            for module_id, spec in available_modules.items())
+
+    # The app can't be sent to the workers, so read the external document
+    # files that the module specifications refer to here and send them along.
+    jobs = [
+        (module_id, spec, PrereadAppFiles(app, get_module_spec_documents(spec)))
+        for module_id, spec in available_modules.items()
+    ]
+
+    # Errors raised in a worker are raised again here, and since the results
+    # are collected in module order, the first error is the same as if the
+    # modules were validated one by one.
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        chunksize = max(1, len(jobs) // (workers * 4))
+        specs = list(pool.map(validate_module_spec, *zip(*jobs), chunksize=chunksize))
+    return OrderedDict(zip(available_modules, specs))
+
+
+def validate_module_spec(module_id, spec, app):
     # Sanity check that the 'id' in the YAML file matches just the last
     # part of the path of the module_id. This allows the IDs to be 
     # relative to the path in which the module is found.
@@ -115,17 +208,129 @@ def load_module_into_database(app, appinst, module_id, available_modules, proces
 
     # Validate and normalize the module specification.
     try:
-        spec = validate_module(spec, app)
+        return validate_module(spec, app)
     except ModuleValidationError as e:
         raise ValidationError(spec['id'], e.context, e.message)
 
+
+def get_module_spec_documents(spec):
+    # Return the paths of the external files that the introduction and
+    # output documents of a module specification refer to.
+    docs = [spec.get("introduction")]
+    if isinstance(spec.get("output"), list):
+        docs.extend(spec["output"])
+    return [doc for doc in docs if isinstance(doc, str)]
+
+
+class PrereadAppFiles:
+    # Stands in for an app in validate_module by serving only the files
+    # that were read ahead of time.
+    def __init__(self, app, paths):
+        self.files = { path: app.read_file(path) for path in paths }
+    def read_file(self, path):
+        return self.files[path]
+
+
+def compute_app_content_hash(app, available_modules, assets):
+    # Compute a fingerprint of everything that goes into an AppInstance
+    # when an app is loaded: the module YAML specifications, the asset
+    # file hashes, and the AppSource's asset trust setting.
+    import hashlib
+    h = hashlib.sha256()
+    h.update(json.dumps([app.store.source.id, app.name, app.store.source.trust_assets]).encode("utf8"))
+    h.update(json.dumps(sorted(available_modules.items()), default=str).encode("utf8"))
+    h.update(json.dumps(sorted((file_path, file_hash) for file_path, file_hash, content_opener in assets)).encode("utf8"))
+    return h.hexdigest()
+
+
+@transaction.atomic
+def get_app_instance_for_project_update(appinst, project):
+    # Before an AppInstance is changed in place on behalf of a Project (e.g.
+    # when the Project's app is upgraded), make sure that no other Project
+    # is affected. If other Projects use the AppInstance, copy it (copy-on-write)
+    # and move this Project's Tasks over to the copy. Returns the AppInstance
+    # that may be changed.
+
+    if not Task.objects.filter(module__app=appinst).exclude(project=project).exists():
+        # No other Project uses it. But don't let Projects started later
+        # share it, since it's about to be changed.
+        if appinst.content_hash is not None:
+            appinst.content_hash = None
+            appinst.save()
+        return appinst
+
+    # Copy the AppInstance.
+    new_appinst = AppInstance.objects.create(
+        source=appinst.source,
+        appname=appinst.appname,
+        catalog_metadata=appinst.catalog_metadata,
+        version_number=appinst.version_number,
+        version_name=appinst.version_name,
+        asset_paths=appinst.asset_paths,
+        trust_assets=appinst.trust_assets,
+    )
+    new_appinst.asset_files.set(appinst.asset_files.all())
+
+    # Copy its Modules.
+    module_map = { }
+    for m in appinst.modules.all():
+        old_id = m.id
+        m.pk = None
+        m.app = new_appinst
+        m.save()
+        module_map[old_id] = m
+
+    # Copy their questions. Module-type questions that refer to Modules
+    # in the same AppInstance must refer to the copies, both in the
+    # answer_type_module field and in the module-id field of the spec.
+    question_map = { }
+    for q in ModuleQuestion.objects.filter(module__app=appinst):
+        old_id = q.id
+        q.pk = None
+        q.module = module_map[q.module_id]
+        if q.answer_type_module_id in module_map:
+            q.answer_type_module = module_map[q.answer_type_module_id]
+            q.spec = OrderedDict(q.spec)
+            q.spec["module-id"] = q.answer_type_module.id
+        q.save()
+        question_map[old_id] = q
+
+    # Move the Project's Tasks and their answers over to the copy.
+    for old_id, m in module_map.items():
+        Task.objects.filter(project=project, module_id=old_id).update(module=m)
+    for old_id, q in question_map.items():
+        TaskAnswer.objects.filter(task__project=project, question_id=old_id).update(question=q)
+    Task.clear_state(Task.objects.filter(project=project, module__app=new_appinst))
+
+    return new_appinst
+
+
+def load_module_into_database(app, appinst, module_id, available_modules, processed_modules, dependency_path, update_mode, updated_modules):
+    # Prevent cyclic dependencies between modules.
+    if module_id in dependency_path:
+        raise CyclicDependency(dependency_path)
+
+    # Because of dependencies between modules, we may have already
+    # been here. Do this after the cyclic dependency check or else
+    # we would never see a cyclic dependency.
+    if module_id in processed_modules:
+        return processed_modules[module_id]
+
+    # Load the module's YAML file.
+    if module_id not in available_modules:
+        raise DependencyError((dependency_path[-1] if len(dependency_path) > 0 else None), module_id)
+
+    # The module specification was already validated and normalized
+    # by validate_app_modules.
+    spec = available_modules[module_id]
+
     # Recursively update any modules this module references
     # because references to those modules are stored in the
     # database using a foreign key, so we need to that those
     # records in place first.
     dependencies = { }
     for m1 in get_module_spec_dependencies(spec):
-        mdb = load_module_into_database(app, appinst, m1, available_modules, processed_modules, dependency_path + [spec["id"]], update_mode)
+        mdb = load_module_into_database(app, appinst, m1, available_modules, processed_modules, dependency_path + [spec["id"]], update_mode, updated_modules)
         dependencies[m1] = mdb
 
     # Now that dependent modules are loaded, replace module string IDs with database numeric IDs.
@@ -156,8 +361,10 @@ def load_module_into_database(app, appinst, module_id, available_modules, proces
             or update_mode == AppImportUpdateMode.ForceUpdate:
             # There are no incompatible changes and we're allowed to update modules,
             # or we're forcing an update and it doesn't matter whether or not there
-            # are changes --- update this one in place.
+            # are changes --- update this one in place. Its Tasks are
+            # invalidated at the end of load_app_into_database.
             update_module(m, spec, True)
+            updated_modules.add(m)
 
         else:
             # Block an incompatible update --- don't create a new module.
@@ -230,9 +437,12 @@ def update_module(m, spec, log_status):
             except ProtectedError:
                 raise IncompatibleUpdate("Module {} cannot be updated because question {}, which has been removed, has already been answered.".format(m.module_name, q.key))
 
-    # If we're updating a Module in-place, clear out any cached state on its Tasks.
-    for t in Task.objects.filter(module=m):
-        t.on_answer_changed()
+    # Compute and store the dependency graph between the questions.
+    m.update_question_dependencies()
+
+    # If we're updating a Module in-place, the cached state on its Tasks
+    # must be cleared out, but the caller does that for all updated Modules
+    # at once.
 
 
 def update_question(m, definition_order, spec, log_status):
@@ -395,40 +605,157 @@ def is_question_changed(mq, definition_order, spec):
     # The changes to this question do not create a data inconsistency.
     return False
 
-def load_module_assets_into_database(app, appinst):
+def load_module_assets_into_database(app, appinst, assets=None):
     # Load all of the static assets from the source into the database.
-    # If a ModuleAsset already exists for an asset, use that.
+    # If a ModuleAsset already exists for an asset, use that. assets
+    # is what app.get_assets() returns, if the caller already has it.
 
     source = app.store.source
-
-    # Add the assets.
+    if assets is None:
+        assets = app.get_assets()
+    assets = list(assets)
+
+    # Get the ModuleAssets that already exist --- they might have been
+    # created for an earlier app --- without a query per asset.
+    existing_assets = get_module_assets(source, { file_hash for file_path, file_hash, content_opener in assets })
+
+    # Store the content of the new assets. An asset may appear at more than
+    # one path in the app, but it's only stored once. The encoded files are
+    # saved in batches so that a large app isn't held in memory all at once.
+    batch = OrderedDict() # content hash => (file path, StoredFile)
+    batch_size = 0
+    for file_path, file_hash, content_opener in assets:
+        if file_hash in existing_assets or file_hash in batch:
+            continue
+        with content_opener() as f:
+            sf = create_stored_file(ModuleAsset._meta.get_field("file").upload_to, f)
+        batch[file_hash] = (file_path, sf)
+        batch_size += sf.encoded_size
+        if len(batch) >= ASSET_BATCH_FILES or batch_size >= ASSET_BATCH_BYTES:
+            existing_assets.update(save_module_assets(source, batch))
+            batch = OrderedDict()
+            batch_size = 0
+    if batch:
+        existing_assets.update(save_module_assets(source, batch))
+
+    # Add the assets to the app.
     appinst.trust_assets = source.trust_assets # remember setting at time of app load
     appinst.asset_paths = { }
-    for file_path, file_hash, content_loader in app.get_assets():
-        # Get or create the ModuleAsset --- it might already exist in an earlier app.
-        asset, is_new = ModuleAsset.objects.get_or_create(
-            source=source,
-            content_hash=file_hash,
-        )
-        if is_new:
-            # Set the new file content.
-            from django.core.files.base import ContentFile
-            asset.file.save(file_path, ContentFile(content_loader()))
-            asset.save()
-
-        mime_types = {
-            "css": "text/css",
-            "js": "text/javascript",
-        }
-        mime_type = mime_types.get(file_path.rsplit(".", 1)[-1])
-        if mime_type:
-            from dbstorage.models import StoredFile
-            StoredFile.objects\
-                .filter(path=asset.file.name)\
-                .update(mime_type=mime_type)
-
-        # Add to the app.
-        appinst.asset_files.add(asset)
+    for file_path, file_hash, content_opener in assets:
         appinst.asset_paths[file_path] = file_hash
+    appinst.asset_files.add(*{ existing_assets[file_hash] for file_path, file_hash, content_opener in assets })
 
     appinst.save()
+
+
+# Limits on the number of new asset files, and their total encoded size,
+# that are held in memory before they are saved.
+ASSET_BATCH_FILES = 50
+ASSET_BATCH_BYTES = 32*1024*1024
+
+def save_module_assets(source, new_files):
+    # Save new ModuleAssets for new_files, a dict from content hashes to
+    # (file path, unsaved StoredFile) tuples, and return a dict from the
+    # content hashes to the ModuleAssets.
+    from dbstorage.models import StoredFile
+
+    # Files with the same content may already be stored for some other
+    # reason. Since file names are content hashes, the existing ones
+    # can be used.
+    paths = [sf.path for file_path, sf in new_files.values()]
+    stored_paths = set(StoredFile.objects.filter(path__in=paths).values_list("path", flat=True))
+    new_stored_files = { sf.path: sf for file_path, sf in new_files.values() if sf.path not in stored_paths }
+    bulk_create_ignoring_conflicts(StoredFile, list(new_stored_files.values()))
+
+    # Override the detected MIME type of stylesheets and scripts.
+    mime_types = {
+        "css": "text/css",
+        "js": "text/javascript",
+    }
+    for ext, mime_type in mime_types.items():
+        paths = [sf.path for file_path, sf in new_files.values() if file_path.rsplit(".", 1)[-1] == ext]
+        if paths:
+            StoredFile.objects.filter(path__in=paths).update(mime_type=mime_type)
+
+    bulk_create_ignoring_conflicts(ModuleAsset, [
+        ModuleAsset(source=source, content_hash=file_hash, file=sf.path)
+        for file_hash, (file_path, sf) in new_files.items()
+    ])
+    return get_module_assets(source, set(new_files))
+
+def bulk_create_ignoring_conflicts(model, objs):
+    # Create the objects, skipping any that violate a unique constraint
+    # because another app load created the same rows at the same time.
+    # (Django 2.0's bulk_create has no ignore_conflicts option.) If the
+    # bulk insert fails, insert the objects one by one.
+    try:
+        with transaction.atomic():
+            model.objects.bulk_create(objs)
+    except IntegrityError:
+        for obj in objs:
+            obj.pk = None
+            try:
+                with transaction.atomic():
+                    obj.save()
+            except IntegrityError:
+                pass
+
+def get_module_assets(source, content_hashes):
+    # Return a dict from content hashes to the source's ModuleAssets with
+    # those hashes. Query in batches to stay under database limits on the
+    # number of query parameters.
+    content_hashes = sorted(content_hashes)
+    ret = { }
+    for i in range(0, len(content_hashes), 500):
+        for asset in ModuleAsset.objects.filter(source=source, content_hash__in=content_hashes[i:i+500]):
+            ret[asset.content_hash] = asset
+    return ret
+
+
+def create_stored_file(directory, f):
+    # Return a new, unsaved dbstorage StoredFile holding the content of
+    # the binary file object f, named the way dbstorage's DatabaseStorage
+    # names files (by a hash of the content). The content is read, hashed,
+    # and compressed in chunks so that the uncompressed file is never held
+    # in memory all at once.
+    import base64, hashlib, mimetypes, zlib
+    import magic
+    from dbstorage.models import StoredFile
+
+    sha1 = hashlib.sha1()
+    compressor = zlib.compressobj(9)
+    head = b"" # the start of the file, to detect its MIME type
+    pending = b"" # compressed data not yet base64-encoded
+    encoded = [] # base64-encoded chunks
+    size = 0
+    while True:
+        chunk = f.read(65536)
+        if not chunk:
+            break
+        size += len(chunk)
+        sha1.update(chunk)
+        if len(head) < 65536:
+            head += chunk[:65536-len(head)]
+
+        # Encode as much of the compressed data as fills whole base64 blocks.
+        pending += compressor.compress(chunk)
+        n = len(pending) - (len(pending) % 3)
+        encoded.append(base64.b64encode(pending[:n]).decode("ascii"))
+        pending = pending[n:]
+    pending += compressor.flush()
+    encoded.append(base64.b64encode(pending).decode("ascii"))
+
+    sf = StoredFile()
+    with magic.Magic(flags=magic.MAGIC_MIME_TYPE) as m:
+        sf.mime_type = m.id_buffer(head) or "application/octet-stream"
+    name = sha1.hexdigest().lower()
+    ext = mimetypes.guess_extension(sf.mime_type, strict=False)
+    if ext:
+        name += ext[:10]
+    sf.path = directory + "/" + name
+    sf.size = size
+    sf.gzipped = True
+    sf.encoding = 1
+    sf.value = "".join(encoded)
+    sf.encoded_size = len(sf.value)
+    return sf
@@ -301,9 +301,12 @@ class PyFsApp(App):
                     # The module ID combines its local path and the filename.
                     module_id = "/".join(path + [fn_name])
 
-                    # Read the YAML file.
-                    with self.fs.open(entry.name) as f:
-                        module_spec = read_yaml_file(f)
+                    # Read the YAML file. If the filesystem gives us its git
+                    # blob hash, an unchanged file isn't even read again.
+                    module_spec = read_yaml_file_from_fs(
+                        self.fs,
+                        "/".join(path + [entry.name]),
+                        blob_hash=entry.get("hash", "sha1"))
 
                     yield (module_id, module_spec)
 
@@ -335,7 +338,7 @@ class PyFsApp(App):
 
         for entry in fs.scandir("/".join(["assets"] + path)):
             if entry.is_dir:
-                for asset in iter_assets(fs, path+[entry.name]):
+                for asset in PyFsApp.iter_assets(fs, path+[entry.name]):
                     yield asset
             else:
                 fn = "/".join(path + [entry.name])
@@ -348,13 +351,14 @@ class PyFsApp(App):
                         m.update(data)
                     content_hash = m.hexdigest()
 
-                def make_content_loader(fn):
-                    def content_loader():
-                        with fs.open("assets/" + fn, "rb") as f:
-                            return f.read()
-                    return content_loader
+                # Return a function that opens the asset so that its
+                # content can be read in chunks.
+                def make_content_opener(fn):
+                    def content_opener():
+                        return fs.open("assets/" + fn, "rb")
+                    return content_opener
 
-                yield (fn, content_hash, make_content_loader(fn))
+                yield (fn, content_hash, make_content_opener(fn))
 
 
 # This class implements AppSourceConnection for a local path using fs.osfs.OSFS.
@@ -449,17 +453,20 @@ class GithubApiAppSourceConnection(PyFsAppSourceConnection):
 
 
 class GitRepositoryFilesystem(SimplifiedReadonlyFilesystem):
+    # Git repositories are mirrored into bare repositories on disk, one per
+    # (url, branch, ssh_key), in settings.GIT_MIRROR_CACHE_DIR so that the
+    # repository doesn't have to be fetched from scratch each time the
+    # AppSource is opened. A mirror is refreshed with an incremental fetch
+    # only if it hasn't been fetched in the last settings.GIT_MIRROR_FRESHNESS
+    # seconds. Files are read straight from the mirror's object database
+    # at the commit that was current when the filesystem was opened.
+
     def __init__(self, url, branch, path, ssh_key=None):
         self.url = url
         self.branch = branch or None
         self.path = (path or "") + "/"
         self.ssh_key = ssh_key
 
-        # Create a local git working directory.
-        import tempfile
-        self.tempdir_obj = tempfile.TemporaryDirectory()
-        self.tempdir = self.tempdir_obj.__enter__()
-
         self.description = self.url + "/" + self.path.strip("/")
         if self.branch:
             self.description += "@" + self.branch
@@ -471,64 +478,101 @@ class GitRepositoryFilesystem(SimplifiedReadonlyFilesystem):
         return "<gitfs '%s'>" % self.description
 
     def close(self):
-        # Release the temporary directory.
-        self.tempdir_obj.__exit__(None, None, None)
+        # Stop the git processes that read from the mirror.
+        if hasattr(self, "repo"):
+            self.repo.close()
+
+    def get_mirror_dir(self):
+        # The ssh_key is included in the hash so that AppSources with
+        # different credentials don't share a mirror, since otherwise
+        # an AppSource with invalid credentials could read a mirror
+        # fetched with another AppSource's credentials.
+        import hashlib, os.path
+        from django.conf import settings
+        key = hashlib.sha1("\0".join([self.url, self.branch or "", self.ssh_key or ""]).encode("utf8")).hexdigest()
+        return os.path.join(settings.GIT_MIRROR_CACHE_DIR, key + ".git")
+
+    def update_mirror(self, mirror_dir):
+        # Create the mirror if it doesn't exist and fetch the branch unless
+        # it was fetched recently. Return the commit sha of the branch.
+        import os, os.path, tempfile, time, fcntl
+        import git, git.exc
+        from django.conf import settings
+
+        os.makedirs(os.path.dirname(mirror_dir), exist_ok=True)
+
+        # Only one process at a time may update a mirror.
+        with open(mirror_dir + ".lock", "w") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+
+            if not os.path.exists(mirror_dir):
+                git.Repo.init(mirror_dir, bare=True)
+            repo = git.Repo(mirror_dir)
+            try:
+                # Is the mirror fresh? The mirror's fetched-at file is touched
+                # after each successful fetch.
+                stamp_file = os.path.join(mirror_dir, "fetched-at")
+                if os.path.exists(stamp_file) \
+                    and time.time() - os.path.getmtime(stamp_file) < settings.GIT_MIRROR_FRESHNESS:
+                    return repo.git.rev_parse("refs/mirror/head")
+
+                # Make SSH non-interactive.
+                ssh_options = "ssh -o StrictHostKeyChecking=no -o BatchMode=yes"
+
+                with tempfile.TemporaryDirectory() as tempdir:
+                    # If an SSH key is provided, store it in a temporary directory
+                    # (not in the mirror) and then use it.
+                    if self.ssh_key:
+                        ssh_key_file = os.path.join(tempdir, "ssh.key")
+                        old_umask = os.umask(0o077) # ssh requires group/world permissions to be zero
+                        try:
+                            with open(ssh_key_file, "wb") as f:
+                                f.write(self.ssh_key.encode("ascii"))
+                        finally:
+                            os.umask(old_umask)
+                        ssh_options += " -i " + ssh_key_file
+
+                    repo.git.environment()["GIT_SSH_COMMAND"] = ssh_options
+
+                    # For debugging, log a command that we could try on the command line.
+                    #print("SSH_COMMAND=\"{ssh_options}\" git fetch --depth 1 {url} {branch}".format(
+                    #    ssh_options=ssh_options, url=self.url, branch=self.branch), file=sys.stderr)
+
+                    # Fetch. Objects already in the mirror aren't transferred again.
+                    try:
+                        repo.git.execute(
+                            [
+                                repo.git.git_exec_name,
+                                "fetch",
+                                "--depth", "1", # avoid getting whole repo history
+                                "--force",
+                                self.url, # repo URL
+                                (self.branch or "HEAD") + ":refs/mirror/head", # branch to fetch and where to put it
+                            ], kill_after_timeout=20)
+                    except git.exc.GitCommandError as e:
+                        # This is where errors occur, which is hopefully about auth.
+                        raise fs.errors.CreateFailed("The repository URL is either not valid, not public, or ssh_key was not specified or not valid (%s)." % e.stderr)
+
+                with open(stamp_file, "w"):
+                    pass
+                return repo.git.rev_parse("refs/mirror/head")
+            finally:
+                repo.close()
 
     def get_repo_root(self):
         # Return cached tree.
         if hasattr(self, "repo_root_tree"):
             return self.repo_root_tree
 
-        import os, os.path
         import git
 
-        # Create an empty git repo in the temporary directory.
-        self.repo = git.Repo.init(self.tempdir)
+        # Bring the mirror up to date and get the commit to read from.
+        mirror_dir = self.get_mirror_dir()
+        self.commit_sha = self.update_mirror(mirror_dir)
 
-        # Make SSH non-interactive.
-        ssh_options = "ssh -o StrictHostKeyChecking=no -o BatchMode=yes"
-
-        # If an SSH key is provided, store it in the temporary directory and
-        # then use it.
-        if self.ssh_key:
-            ssh_key_file = os.path.join(self.tempdir, "ssh.key")
-            old_umask = os.umask(0o077) # ssh requires group/world permissions to be zero
-            try:
-                with open(ssh_key_file, "wb") as f:
-                    f.write(self.ssh_key.encode("ascii"))
-            finally:
-                os.umask(old_umask)
-            ssh_options += " -i " + ssh_key_file
-
-        self.repo.git.environment()["GIT_SSH_COMMAND"] = ssh_options
-
-        # For debugging, log a command that we could try on the command line.
-        #print("SSH_COMMAND=\"{ssh_options}\" git fetch --depth 1 {url} {branch}".format(
-        #    ssh_options=ssh_options, url=self.url, branch=self.branch), file=sys.stderr)
-
-        # Fetch.
-        import git.exc
-        try:
-            self.repo.git.execute(
-                [
-                    self.repo.git.git_exec_name,
-                    "fetch",
-                    "--depth", "1", # avoid getting whole repo history
-                    self.url, # repo URL
-                    self.branch or "", # branch to fetch
-                ], kill_after_timeout=20)
-        except git.exc.GitCommandError as e:
-            # This is where errors occur, which is hopefully about auth.
-            raise fs.errors.CreateFailed("The repository URL is either not valid, not public, or ssh_key was not specified or not valid (%s)." % e.stderr)
-
-        # Get the tree for the remote branch's HEAD.
-        tree = self.repo.tree("FETCH_HEAD")
-
-        # The Pythonic way would be to add a remote for the remote repository, run
-        # fetch, and then access its ref.
-        #self.remote = self.repo.create_remote("origin", self.spec["url"])
-        #self.remote.fetch(self.spec.get("branch"))
-        #tree = self.repo.tree(self.remote.refs[0])
+        # Get the tree for the commit.
+        self.repo = git.Repo(mirror_dir)
+        tree = self.repo.commit(self.commit_sha).tree
 
         # If a path was given, move to that subdirectory.
         # TODO: Check that paths with subdirectories that have no other content
@@ -599,13 +643,102 @@ class GitRepositoryAppSourceConnection(PyFsAppSourceConnection):
 
 
 def read_yaml_file(f):
-    # Use the safe YAML loader via rtyaml, which loads mappings with
-    # OrderedDicts so that order is not lost, and catch errors.
-    import rtyaml, yaml.scanner, yaml.parser, yaml.constructor
+    # Parse a YAML file from an open file.
+    return parse_yaml(f.read())
+
+def read_yaml_file_from_fs(fs, path, blob_hash=None):
+    # Parse a YAML file in a PyFilesystem2 filesystem. If blob_hash, the
+    # file's git blob hash, is given, it is used as the key for the cache of
+    # parsed YAML documents so the file is not read if it is in the cache.
+    if blob_hash:
+        cache_key = "git-blob:" + blob_hash
+        doc = get_cached_yaml_document(cache_key)
+        if doc is not None:
+            return doc
+    else:
+        cache_key = None
+    with fs.openbin(path) as f:
+        return parse_yaml(f.read(), cache_key=cache_key)
+
+def get_yaml_loader():
+    # Use libyaml's C parser when it is available, which is much faster than
+    # the pure-Python parser, with a constructor that loads mappings into
+    # OrderedDicts so that key order is not lost.
+    global _yaml_loader
+    if _yaml_loader is None:
+        import yaml, yaml.resolver
+        from collections import OrderedDict
+        try:
+            from yaml import CSafeLoader as SafeLoader
+        except ImportError:
+            from yaml import SafeLoader
+        class OrderedSafeLoader(SafeLoader):
+            pass
+        def construct_ordered_mapping(loader, node):
+            loader.flatten_mapping(node) # handle merge keys
+            return OrderedDict(loader.construct_pairs(node))
+        OrderedSafeLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_ordered_mapping)
+        _yaml_loader = OrderedSafeLoader
+    return _yaml_loader
+_yaml_loader = None
+
+# Parsed YAML documents are kept in an in-process LRU cache keyed by the
+# hash of the file content (or its git blob hash) so that unchanged files
+# aren't parsed again each time an app is loaded. The documents are stored
+# pickled because callers modify the documents they get, and unpickling is
+# a fast way to make a fresh copy.
+YAML_CACHE_MAX_SIZE = 2048
+_yaml_cache = None
+_yaml_cache_lock = None
+
+def get_cached_yaml_document(cache_key):
+    import pickle
+    if _yaml_cache is None:
+        return None
+    with _yaml_cache_lock:
+        blob = _yaml_cache.get(cache_key)
+        if blob is None:
+            return None
+        _yaml_cache.move_to_end(cache_key)
+    return pickle.loads(blob)
+
+def cache_yaml_document(cache_key, doc):
+    global _yaml_cache, _yaml_cache_lock
+    import pickle
+    if _yaml_cache is None:
+        import threading
+        from collections import OrderedDict
+        _yaml_cache = OrderedDict()
+        _yaml_cache_lock = threading.Lock()
+    blob = pickle.dumps(doc, protocol=pickle.HIGHEST_PROTOCOL)
+    with _yaml_cache_lock:
+        _yaml_cache[cache_key] = blob
+        _yaml_cache.move_to_end(cache_key)
+        while len(_yaml_cache) > YAML_CACHE_MAX_SIZE:
+            _yaml_cache.popitem(last=False)
+
+def clear_yaml_cache():
+    if _yaml_cache is not None:
+        with _yaml_cache_lock:
+            _yaml_cache.clear()
+
+def parse_yaml(content, cache_key=None):
+    # Parse YAML content (str or bytes) using the cache of parsed documents.
+    # The cache key is the hash of the content unless one is given. Parse
+    # errors are raised as AppSourceConnectionErrors.
+    import hashlib
+    import yaml.scanner, yaml.parser, yaml.constructor
+    if cache_key is None:
+        cache_key = "sha256:" + hashlib.sha256(content.encode("utf8") if isinstance(content, str) else content).hexdigest()
+    doc = get_cached_yaml_document(cache_key)
+    if doc is not None:
+        return doc
     try:
-        return rtyaml.load(f)
+        doc = yaml.load(content, Loader=get_yaml_loader())
     except (yaml.scanner.ScannerError, yaml.parser.ParserError, yaml.constructor.ConstructorError) as e:
         raise AppSourceConnectionError("There was an error parsing the YAML file: " + str(e))
+    cache_yaml_document(cache_key, doc)
+    return doc
 
 AppSourceConnectionTypes = {
     "null": NullAppSourceConnection,
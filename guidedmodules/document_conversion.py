@@ -0,0 +1,209 @@
+# Converts rendered output documents to other formats (PDF, DOCX, etc.)
+# using external converters (wkhtmltopdf, pandoc).
+#
+# Conversions run on a long-lived pool of worker threads shared by all
+# requests in this process, so the number of converter processes running
+# at once is bounded by settings.DOCUMENT_CONVERSION_WORKERS no matter how
+# many people click download at the same time. The results are cached on
+# disk in settings.DOCUMENT_CONVERSION_CACHE_DIR keyed by a hash of the
+# input document, the target format, and the converter's version, so
+# downloading an unchanged document again doesn't run the converter. When
+# the cache grows beyond settings.DOCUMENT_CONVERSION_CACHE_MAX_SIZE
+# megabytes, the least recently used files are deleted.
+
+from django.conf import settings
+
+import concurrent.futures
+import hashlib
+import os
+import os.path
+import subprocess # nosec
+import tempfile
+import threading
+import time
+
+# How long to wait for a converter to finish, in seconds.
+CONVERSION_TIMEOUT = 10
+
+# How often each process checks the size of the cache, in seconds, and the
+# fraction of the maximum size that pruning the cache brings it down to.
+CACHE_PRUNE_INTERVAL = 60
+CACHE_PRUNE_TARGET = 0.9
+
+class ConversionError(Exception):
+    pass
+
+_pool = None
+_pool_lock = threading.RLock()
+_pending = { } # cache key => Future of a conversion that is running
+_converter_versions = { }
+_last_cache_prune = 0
+
+def get_conversion_pool():
+    # Start the pool of worker threads the first time it's needed.
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings.DOCUMENT_CONVERSION_WORKERS,
+                thread_name_prefix="document-conversion")
+        return _pool
+
+def get_converter_version(converter):
+    # Get the version string of a converter, which goes into the cache
+    # key so that upgrading a converter doesn't serve stale output.
+    if converter not in _converter_versions:
+        cmd = {
+            "wkhtmltopdf": ["/usr/bin/wkhtmltopdf", "--version"],
+            "pandoc": ["/usr/bin/pandoc", "--version"],
+        }[converter]
+        try:
+            version = subprocess.check_output(cmd, stderr=subprocess.DEVNULL, timeout=CONVERSION_TIMEOUT)
+            version = version.decode("utf8", "replace").split("\n")[0].strip()
+        except (OSError, subprocess.SubprocessError):
+            # The converter isn't installed or is broken. Don't remember
+            # the failure so that we try again next time.
+            return None
+        _converter_versions[converter] = version
+    return _converter_versions[converter]
+
+def get_cache_key(content, output_format, converter_version):
+    h = hashlib.sha256()
+    h.update(output_format.encode("utf8") + b"\0")
+    h.update(converter_version.encode("utf8") + b"\0")
+    h.update(content)
+    return h.hexdigest()
+
+def get_cache_path(cache_key):
+    # Spread files over subdirectories so no directory gets too large.
+    return os.path.join(settings.DOCUMENT_CONVERSION_CACHE_DIR, cache_key[0:2], cache_key)
+
+def read_cache(cache_key):
+    try:
+        fn = get_cache_path(cache_key)
+        with open(fn, "rb") as f:
+            blob = f.read()
+        # Mark the file as recently used. See prune_cache.
+        os.utime(fn)
+        return blob
+    except FileNotFoundError:
+        # (It may also have been pruned between reading and marking it.)
+        return None
+
+def write_cache(cache_key, blob):
+    # Write to a temporary file and then move it into place so that
+    # readers never see a partially written file.
+    fn = get_cache_path(cache_key)
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    fd, tmpfn = tempfile.mkstemp(dir=os.path.dirname(fn))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(blob)
+        os.replace(tmpfn, fn)
+    except:
+        os.unlink(tmpfn)
+        raise
+
+    # Check the size of the cache every so often.
+    global _last_cache_prune
+    with _pool_lock:
+        if time.time() - _last_cache_prune < CACHE_PRUNE_INTERVAL:
+            return
+        _last_cache_prune = time.time()
+    prune_cache(settings.DOCUMENT_CONVERSION_CACHE_MAX_SIZE * 1024 * 1024)
+
+def prune_cache(max_size):
+    # If the files in the cache total more than max_size bytes, delete the
+    # least recently used ones (by modification time, which read_cache
+    # updates) until they total less than CACHE_PRUNE_TARGET of max_size.
+    # Other processes may be reading, writing, and pruning at the same time.
+    files = []
+    for dirpath, dirnames, filenames in os.walk(settings.DOCUMENT_CONVERSION_CACHE_DIR):
+        for fn in filenames:
+            if len(fn) != 64:
+                continue # a temporary file being written by write_cache
+            fn = os.path.join(dirpath, fn)
+            try:
+                st = os.stat(fn)
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, fn))
+    total_size = sum(size for mtime, size, fn in files)
+    if total_size <= max_size:
+        return
+    for mtime, size, fn in sorted(files):
+        if total_size <= max_size * CACHE_PRUNE_TARGET:
+            break
+        try:
+            os.unlink(fn)
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+def convert_html(html, output_format):
+    # Convert an HTML document (a str) to output_format, which is "pdf"
+    # (converted using wkhtmltopdf) or a pandoc output format name, and
+    # return the converted document as bytes.
+    converter = "wkhtmltopdf" if output_format == "pdf" else "pandoc"
+    content = html.encode("utf8")
+
+    # Return a cached conversion.
+    converter_version = get_converter_version(converter)
+    if converter_version is None:
+        raise ConversionError("The {} document converter is not available.".format(converter))
+    cache_key = get_cache_key(content, output_format, converter_version)
+    blob = read_cache(cache_key)
+    if blob is not None:
+        return blob
+
+    # Queue the conversion on the worker pool, unless the same
+    # conversion is already queued or running, and wait for it.
+    with _pool_lock:
+        future = _pending.get(cache_key)
+        if future is None:
+            future = get_conversion_pool().submit(run_conversion, cache_key, converter, content, output_format)
+            _pending[cache_key] = future
+    return future.result()
+
+def run_conversion(cache_key, converter, content, output_format):
+    try:
+        if converter == "wkhtmltopdf":
+            blob = run_wkhtmltopdf(content)
+        else:
+            blob = run_pandoc(content, output_format)
+        write_cache(cache_key, blob)
+        return blob
+    finally:
+        with _pool_lock:
+            _pending.pop(cache_key, None)
+
+def run_wkhtmltopdf(content):
+    # Mark the encoding explicitly, to match the encoding of content.
+    content = b'<meta charset="UTF-8" />' + content
+
+    # xvfb is required to run wkhtmltopdf in headless mode on Debian.
+    cmd = ["/usr/bin/xvfb-run", "--", "/usr/bin/wkhtmltopdf",
+           "-q", # else errors go to stdout
+           "--disable-javascript",
+           "--encoding", "UTF-8",
+           "-s", "Letter", # page size
+           "-", "-"]
+    with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
+        stdout, stderr = proc.communicate(content, timeout=CONVERSION_TIMEOUT)
+        if proc.returncode != 0: raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+    return stdout
+
+def run_pandoc(content, output_format):
+    # odt and some other formats cannot pipe to stdout, so we always
+    # generate a temporary file.
+    with tempfile.TemporaryDirectory() as tempdir:
+        # convert from HTML to something else, writing to a temporary file
+        outfn = os.path.join(tempdir, "output")
+        cmd = ["/usr/bin/pandoc", "-f", "html", "-t", output_format, "-o", outfn]
+        with subprocess.Popen(cmd, stdin=subprocess.PIPE) as proc:
+            proc.communicate(content, timeout=CONVERSION_TIMEOUT)
+            if proc.returncode != 0: raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+
+        # return the content of the temporary file
+        with open(outfn, "rb") as f:
+            return f.read()
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+import time
+
+from guidedmodules.models import AppSource, AppInstance, Module, ModuleQuestion
+from guidedmodules.module_logic import ModuleAnswers, clear_impute_rules_cache
+
+class Command(BaseCommand):
+    help = 'Times evaluating the state of a generated module with many impute conditions, compiling the impute conditions on every evaluation (cold) and once per module (warm). Nothing is saved to the database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', type=int, default=200, help="The number of questions in the module.")
+        parser.add_argument('--iterations', type=int, default=20, help="The number of times to evaluate the module's state in each run.")
+
+    def handle(self, *args, **options):
+        # The module is created in a transaction that is rolled back.
+        with transaction.atomic():
+            module = self.create_module(options["questions"])
+            cold = self.run(module, options["iterations"], cold=True)
+            warm = self.run(module, options["iterations"], cold=False)
+            transaction.set_rollback(True)
+
+        self.stdout.write("{} questions, {} iterations".format(options["questions"], options["iterations"]))
+        self.stdout.write("cold: {:.1f} ms per evaluation".format(cold / options["iterations"] * 1000))
+        self.stdout.write("warm: {:.1f} ms per evaluation".format(warm / options["iterations"] * 1000))
+        self.stdout.write("speedup: {:.1f}x".format(cold / warm if warm > 0 else float("inf")))
+
+    def create_module(self, num_questions):
+        # Each question has impute conditions that refer to the questions
+        # before it: an expression condition and a template value.
+        source = AppSource.objects.create(slug="benchmark-impute-rules", spec={ "type": "null" })
+        app = AppInstance.objects.create(source=source, appname="benchmark", catalog_metadata={}, asset_paths={})
+        module = Module(source=source, app=app, module_name="benchmark", spec={ "id": "benchmark", "title": "Benchmark" })
+        module.save()
+        for i in range(num_questions):
+            spec = { "id": "q{}".format(i), "title": "Question {}".format(i), "prompt": "?", "type": "text" }
+            if i >= 2:
+                spec["impute"] = [
+                    { "condition": "q{} == 'skip' and q{} != 'skip'".format(i-1, i-2), "value": "skip" },
+                    { "condition": "q{}|length > 3".format(i-1), "value": "{{{{q{}}}}}-{}".format(i-1, i), "value-mode": "template" },
+                ]
+            ModuleQuestion.objects.create(module=module, key=spec["id"], definition_order=i, spec=spec)
+        return module
+
+    def run(self, module, iterations, cold):
+        questions = list(module.questions.order_by("definition_order"))
+        answertuples = { q.key: (q, False, None, None) for q in questions }
+        answertuples["q0"] = (questions[0], True, None, "start")
+        answertuples["q1"] = (questions[1], True, None, "start")
+        clear_impute_rules_cache()
+        start = time.perf_counter()
+        for _ in range(iterations):
+            if cold:
+                # Throw away the compiled impute conditions.
+                clear_impute_rules_cache()
+            ModuleAnswers(module, None, dict(answertuples)).with_extended_info()
+        return time.perf_counter() - start
@@ -18,17 +18,22 @@ class Command(BaseCommand):
                 oldappinst = AppInstance.objects.filter(source=app.store.source, appname=app.name, system_app=True).first()
 
                 # Try to update the existing app.
+                stats = { }
                 try:
                     appinst = load_app_into_database(
                         app,
                         update_appinst=oldappinst,
-                        update_mode=AppImportUpdateMode.CompatibleUpdate if oldappinst else AppImportUpdateMode.CreateInstance)
+                        update_mode=AppImportUpdateMode.CompatibleUpdate if oldappinst else AppImportUpdateMode.CreateInstance,
+                        stats=stats,
+                        parallel=True)
+                    if stats["modules_updated"] or stats["assets_changed"]:
+                        print(app, "{modules_updated} of {modules} modules updated, {tasks_invalidated} tasks refreshed in {time:.1f}s".format(**stats))
                 except IncompatibleUpdate as e:
                     # App was changed in an incompatible way, so fall back to creating
                     # a new AppInstance and mark the old one as no longer the system_app.
                     # Only one can be the system_app.
                     print(app, e)
-                    appinst = load_app_into_database(app)
+                    appinst = load_app_into_database(app, parallel=True)
                     oldappinst.system_app = None # the correct value here is None, not False, to avoid unique constraint violation
                     oldappinst.save()
 
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+import time
+
+from guidedmodules.models import DocumentExportJob
+
+class Command(BaseCommand):
+    help = 'Processes the queue of output documents being exported to PDF, DOCX, etc.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty instead of waiting for new jobs.")
+        parser.add_argument('--poll-interval', type=float, default=1.0, help="How often to check for new jobs when the queue is empty, in seconds.")
+
+    def handle(self, *args, **options):
+        while True:
+            # Take the next job off of the queue.
+            job = DocumentExportJob.claim_next()
+
+            if job is None:
+                # The queue is empty. Clean up old exports and then
+                # wait for more jobs.
+                DocumentExportJob.delete_expired()
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+                continue
+
+            # Run it.
+            job.run()
+            if job.status == "failed":
+                self.stderr.write("{} failed: {}".format(repr(job), job.error))
+            elif options["verbosity"] > 1:
+                self.stdout.write("{} finished.".format(repr(job)))
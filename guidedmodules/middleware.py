@@ -1,6 +1,7 @@
 from time import time as now
 
 from .models import InstrumentationEvent
+from .module_logic import AnswerSnapshot, DeferredRollups
 
 class InstrumentQuestionPageLoadTimes:
     def __init__(self, next_middleware):
@@ -28,4 +29,24 @@ class InstrumentQuestionPageLoadTimes:
             )
 
         # Return the response unchanged.
-        return response
\ No newline at end of file
+        return response
+
+class AnswerSnapshotMiddleware:
+    def __init__(self, next_middleware):
+        self.next_middleware = next_middleware
+
+    def __call__(self, request):
+        # Load Task answers at most once per Project per request. See
+        # module_logic.AnswerSnapshot.
+        with AnswerSnapshot():
+            return self.next_middleware(request)
+
+class DeferredRollupsMiddleware:
+    def __init__(self, next_middleware):
+        self.next_middleware = next_middleware
+
+    def __call__(self, request):
+        # Update the rollups of the Tasks whose answers change once at the
+        # end of the request. See module_logic.DeferredRollups.
+        with DeferredRollups():
+            return self.next_middleware(request)
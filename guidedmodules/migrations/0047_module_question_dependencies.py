@@ -0,0 +1,19 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:00
+
+from django.db import migrations
+import jsonfield.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0046_auto_20180528_1835'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='module',
+            name='question_dependencies',
+            field=jsonfield.fields.JSONField(blank=True, help_text='The dependency graph between the questions of this Module and the order in which they are evaluated, computed from the question specifications when the Module is loaded, with a version hash.', null=True),
+        ),
+    ]
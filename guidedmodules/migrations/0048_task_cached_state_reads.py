@@ -0,0 +1,26 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:02
+
+from django.db import migrations, models
+
+# State cached before read sets were recorded has no cached_state_reads rows,
+# so Task.clear_state would never clear it when other Tasks change. Clear it
+# all so that it is computed again with its read sets.
+def forwards_func(apps, schema_editor):
+    Task = apps.get_model("guidedmodules", "Task")
+    db_alias = schema_editor.connection.alias
+    Task.objects.using(db_alias).update(cached_state=None)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0047_module_question_dependencies'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='cached_state_reads',
+            field=models.ManyToManyField(blank=True, help_text="The other Tasks whose answers were read to compute the entries in this Task's cached_state.", related_name='cached_state_readers', to='guidedmodules.Task'),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
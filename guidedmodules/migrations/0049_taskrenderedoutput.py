@@ -0,0 +1,41 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+import jsonfield.fields
+
+# Rendered output documents used to be cached in Task.cached_state. Clear
+# the cached state of all Tasks so the old entries don't linger. It is
+# recomputed on demand.
+def forwards_func(apps, schema_editor):
+    Task = apps.get_model("guidedmodules", "Task")
+    db_alias = schema_editor.connection.alias
+    Task.objects.using(db_alias).exclude(cached_state=None).update(cached_state=None)
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0048_task_cached_state_reads'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskRenderedOutput',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document', models.IntegerField(help_text="The index of the output document in the Module's output specification.")),
+                ('format', models.CharField(help_text="The format the document was rendered to, e.g. 'html'.", max_length=16)),
+                ('variant', models.CharField(blank=True, help_text="Other rendering options that affect the rendered content, e.g. 'data-urls' if assets were embedded in data: URLs.", max_length=16)),
+                ('content', models.TextField(help_text='The rendered document.')),
+                ('size', models.IntegerField(help_text='The size in bytes of the rendered document, when encoded in UTF-8.')),
+                ('reads', jsonfield.fields.JSONField(help_text='The IDs of the Tasks that were read while rendering the document. The rendered document is deleted when any of them change.')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('task', models.ForeignKey(help_text='The Task whose output document was rendered.', on_delete=django.db.models.deletion.CASCADE, related_name='rendered_outputs', to='guidedmodules.Task')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='taskrenderedoutput',
+            unique_together={('task', 'document', 'format', 'variant')},
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
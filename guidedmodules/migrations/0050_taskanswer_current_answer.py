@@ -0,0 +1,30 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Set TaskAnswer.current_answer to the TaskAnswerHistory with the highest
+# primary key.
+def forwards_func(apps, schema_editor):
+    TaskAnswer = apps.get_model("guidedmodules", "TaskAnswer")
+    db_alias = schema_editor.connection.alias
+    for ta in TaskAnswer.objects.using(db_alias)\
+        .annotate(current_answer_id_=models.Max('answer_history__id'))\
+        .exclude(current_answer_id_=None)\
+        .values("id", "current_answer_id_"):
+        TaskAnswer.objects.using(db_alias).filter(id=ta["id"]).update(current_answer=ta["current_answer_id_"])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0049_taskrenderedoutput'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskanswer',
+            name='current_answer',
+            field=models.ForeignKey(blank=True, help_text='The most recent TaskAnswerHistory for this TaskAnswer, i.e. the one with the highest primary key. Maintained by set_current_answer.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='guidedmodules.TaskAnswerHistory'),
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
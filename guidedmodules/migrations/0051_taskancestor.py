@@ -0,0 +1,52 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:08
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Fill in TaskAncestor from the current answers that refer to sub-tasks.
+def forwards_func(apps, schema_editor):
+    TaskAnswerHistory = apps.get_model("guidedmodules", "TaskAnswerHistory")
+    TaskAncestor = apps.get_model("guidedmodules", "TaskAncestor")
+    db_alias = schema_editor.connection.alias
+
+    parents = { }
+    for task_id, parent_id in TaskAnswerHistory.answered_by_task.through.objects.using(db_alias)\
+        .filter(taskanswerhistory__taskanswer__current_answer=models.F("taskanswerhistory_id"))\
+        .values_list("task_id", "taskanswerhistory__taskanswer__task_id"):
+        parents.setdefault(task_id, set()).add(parent_id)
+
+    links = []
+    for task_id in parents:
+        ancestors = set()
+        stack = list(parents[task_id])
+        while stack:
+            ancestor_id = stack.pop()
+            if ancestor_id in ancestors: continue
+            ancestors.add(ancestor_id)
+            stack.extend(parents.get(ancestor_id, []))
+        ancestors.discard(task_id)
+        links.extend(TaskAncestor(task_id=task_id, ancestor_id=ancestor_id) for ancestor_id in ancestors)
+    TaskAncestor.objects.using(db_alias).bulk_create(links)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0050_taskanswer_current_answer'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskAncestor',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ancestor', models.ForeignKey(help_text='The Task that has the task as a current answer to a question, directly or through other Tasks.', on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='guidedmodules.Task')),
+                ('task', models.ForeignKey(help_text='The Task that is (perhaps indirectly) an answer to a question in the ancestor Task.', on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='guidedmodules.Task')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='taskancestor',
+            unique_together={('task', 'ancestor')},
+        ),
+        migrations.RunPython(forwards_func, migrations.RunPython.noop),
+    ]
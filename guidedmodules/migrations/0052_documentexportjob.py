@@ -0,0 +1,38 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('guidedmodules', '0051_taskancestor'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentExportJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('document_id', models.CharField(help_text="The id of the output document in the Task's Module's output specification.", max_length=128)),
+                ('download_format', models.CharField(help_text="The format to export the document to, e.g. 'pdf'.", max_length=16)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')], default='queued', help_text='Where the job is in its processing.', max_length=8)),
+                ('content', models.BinaryField(blank=True, help_text='The exported document, once the job is finished.', null=True)),
+                ('filename', models.CharField(blank=True, help_text='The suggested filename of the exported document.', max_length=256)),
+                ('mime_type', models.CharField(blank=True, help_text='The MIME type of the exported document.', max_length=128)),
+                ('error', models.TextField(blank=True, help_text='Why the job failed, if it failed.')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('started', models.DateTimeField(blank=True, help_text='When a worker started processing the job.', null=True)),
+                ('finished', models.DateTimeField(blank=True, help_text='When the job finished or failed.', null=True)),
+                ('task', models.ForeignKey(help_text='The Task whose output document is being exported.', on_delete=django.db.models.deletion.CASCADE, related_name='export_jobs', to='guidedmodules.Task')),
+                ('user', models.ForeignKey(help_text='The user who requested the export, who is the only one who can download it.', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='documentexportjob',
+            index_together={('status', 'created')},
+        ),
+    ]
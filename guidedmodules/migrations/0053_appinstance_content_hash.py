@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0052_documentexportjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='appinstance',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='A hash of the module specifications and assets that this AppInstance was loaded from. Projects started from identical app content share the AppInstance. Null once the AppInstance has been changed in place.', max_length=64, null=True),
+        ),
+    ]
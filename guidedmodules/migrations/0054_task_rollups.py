@@ -0,0 +1,28 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('guidedmodules', '0053_appinstance_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='finished',
+            field=models.NullBooleanField(help_text="Whether this Task and its sub-tasks are finished, or null if not yet computed. A copy of the 'rollups' entry of cached_state that can be used in queries."),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='progress_answered',
+            field=models.IntegerField(blank=True, help_text='The number of questions answered in this Task and its sub-tasks, or null if not yet computed.', null=True),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='progress_total',
+            field=models.IntegerField(blank=True, help_text='The number of questions in this Task and its sub-tasks, or null if not yet computed.', null=True),
+        ),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models, transaction
+from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 from django.conf import settings
 
@@ -65,6 +65,24 @@ class AppSource(models.Model):
         h.update(self.updated.isoformat().encode("ascii"))
         return h.hexdigest()
 
+    def record_catalog_build(self, duration, app_count, error=None):
+        # Remember how long it took to build the compliance apps catalog
+        # for this source so that slow sources can be spotted in the admin.
+        # Use a queryset update so that the 'updated' field, which is part
+        # of the catalog's cache key, is not bumped.
+        extra = dict(self.extra or {})
+        extra["catalog_build"] = {
+            "finished": timezone.now().isoformat(),
+            "duration": round(duration, 3),
+            "apps": app_count,
+            "error": str(error) if error else None,
+        }
+        AppSource.objects.filter(id=self.id).update(extra=extra)
+        self.extra = extra
+
+    def get_catalog_build_info(self):
+        return (self.extra or {}).get("catalog_build")
+
     def open(self):
         # Return an AppSourceConnection instance for this source.
         from .app_source_connections import AppSourceConnection
@@ -86,6 +104,8 @@ class AppInstance(models.Model):
     asset_paths = JSONField(help_text="A dictionary mapping file paths to the content_hashes of assets included in the assets field of this instance.")
     trust_assets = models.BooleanField(default=False, help_text="Are assets trusted? Assets include Javascript that will be served on our domain, Python code included with Modules, and Jinja2 templates in Modules.")
 
+    content_hash = models.CharField(max_length=64, blank=True, null=True, db_index=True, help_text="A hash of the module specifications and assets that this AppInstance was loaded from. Projects started from identical app content share the AppInstance. Null once the AppInstance has been changed in place.")
+
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     updated = models.DateTimeField(auto_now=True, db_index=True)
 
@@ -115,35 +135,24 @@ class AppInstance(models.Model):
         return (self.source.spec["type"] == "local" # so we can save to disk
             and user.has_perm('guidedmodules.change_module'))
 
-    def has_upgrade_priv(self, user):
-        # Does a user have permission to ugprade the Modules in this AppInstance?
-        # Yes if the user is an admin of all the Projects that the Tasks that use
-        # the Modules are in. In practice, that's just the one Project that was
-        # created when this AppInstance was created.
+    def has_upgrade_priv(self, user, project):
+        # Does a user have permission to ugprade the Modules in this AppInstance
+        # for a Project? Yes if the user is an admin of the Project and the
+        # Project uses this AppInstance.
         #
-        # In the database, we allow AppInstances to be shared across many Projects.
-        # The system AppInstance which holds e.g. the user profile module *is*
-        # shared across many user projects, but that AppInstance is blacklisted
-        # from upgrades below. But in other cases there's an implicit constraint
-        # that Projects and AppInstances are one-to-one because when we "start"
-        # an app **we always create an AppInstance and a Project as a pair.**
-        #
-        # In an abundance of caution, the permission check is coded to not make
-        # that assuption that there is just one Project tied to this AppInstance,
-        # so we check that the user is an admin to all relevant Projects. We would
-        # not want to upgrade an AppInstance associated with a Task that the user
-        # does not have administrative rights to. If in the future the implicit
-        # constraint is removed, we would need to be more precise about what is
-        # upgrade since we would not want to upgrade all Projects at once necessarily.
+        # AppInstances are shared across Projects. The system AppInstance which
+        # holds e.g. the user profile module is shared across many user projects,
+        # and it is blacklisted from upgrades below. Other AppInstances are shared
+        # by all of the Projects started from identical app content (see
+        # load_app_into_database). Upgrading one of those only upgrades the given
+        # Project because the AppInstance is copied first (see
+        # app_loading.get_app_instance_for_project_update), so the user only needs
+        # to be an admin of that Project.
         if self.system_app: return False
-        projects = Task.objects.filter(module__app=self).values_list("project", flat=True).distinct()
-        if len(projects) == 0:
-            # This AppInstance doesn't appear to be in use! Well, lock it down.
+        if not Task.objects.filter(module__app=self, project=project).exists():
+            # This AppInstance isn't in use by the Project! Well, lock it down.
             return False
-        for project in projects:
-            if user not in Project.objects.get(id=project).get_admins():
-                return False
-        return True
+        return user in project.get_admins()
 
 def extract_catalog_metadata(app_module, migration=None):
     # Note that this function is used in migration 0044 and so
@@ -216,6 +225,8 @@ class Module(models.Model):
 
     spec = JSONField(help_text="Module definition data.", load_kwargs={'object_pairs_hook': OrderedDict})
 
+    question_dependencies = JSONField(blank=True, null=True, help_text="The dependency graph between the questions of this Module and the order in which they are evaluated, computed from the question specifications when the Module is loaded, with a version hash.")
+
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     updated = models.DateTimeField(auto_now=True, db_index=True)
 
@@ -324,6 +335,15 @@ class Module(models.Model):
                 }
             })
 
+    def update_question_dependencies(self):
+        # Re-compute the dependency graph between this Module's questions
+        # and save it. This must be called whenever the Module's questions
+        # are changed. Saving also bumps self.updated, which invalidates
+        # other in-process caches of Module data.
+        from .module_logic import build_question_dependency_graph
+        self.question_dependencies = build_question_dependency_graph(self)
+        self.save()
+
     def questions_dependencies(self):
         # For the admin.
         from .module_logic import get_all_question_dependencies, get_question_dependencies_with_type
@@ -432,6 +452,25 @@ class ModuleQuestion(models.Model):
         # For debugging.
         return "<ModuleQuestion [%d] %s.%s (%s)>" % (self.id, self.module.module_name, self.key, repr(self.module))
 
+    # The Module's stored question dependency graph is computed from its
+    # questions, so clear it when a question is saved or deleted. It's
+    # re-computed by Module.update_question_dependencies, or the next time
+    # it's needed by module_logic.get_question_dependency_graph. Clear it
+    # with a query so that Module.updated isn't bumped.
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.clear_module_question_dependencies()
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        self.clear_module_question_dependencies()
+        return ret
+
+    def clear_module_question_dependencies(self):
+        Module.objects.filter(id=self.module_id).update(question_dependencies=None)
+        if ModuleQuestion.module.is_cached(self):
+            self.module.question_dependencies = None
+
     def choices_as_csv(self):
         # Helper method for module authoring.
         import csv, io
@@ -490,6 +529,9 @@ class Task(models.Model):
     deleted_at = models.DateTimeField(blank=True, null=True, db_index=True, help_text="If 'deleted' by a user, the date & time the Task was deleted.")
 
     cached_state = JSONField(blank=True, default=None, help_text="Cached value storing whether the Task is finished, its computed title, and other state that depends on question answers.")
+    finished = models.NullBooleanField(help_text="Whether this Task and its sub-tasks are finished, or null if not yet computed. A copy of the 'rollups' entry of cached_state that can be used in queries.")
+    progress_answered = models.IntegerField(blank=True, null=True, help_text="The number of questions answered in this Task and its sub-tasks, or null if not yet computed.")
+    progress_total = models.IntegerField(blank=True, null=True, help_text="The number of questions in this Task and its sub-tasks, or null if not yet computed.")
 
     uuid = models.UUIDField(default=uuid.uuid4, editable=False, help_text="A UUID (a unique identifier) for this Task, used to synchronize Task content between systems.")
 
@@ -497,6 +539,8 @@ class Task(models.Model):
 
     invitation_history = models.ManyToManyField('siteapp.Invitation', blank=True, help_text="The history of accepted invitations that had this Task as a target.")
 
+    cached_state_reads = models.ManyToManyField('self', symmetrical=False, blank=True, related_name="cached_state_readers", help_text="The other Tasks whose answers were read to compute the entries in this Task's cached_state.")
+
     class Meta:
         index_together = [
             ('project', 'editor', 'module'),
@@ -576,37 +620,37 @@ class Task(models.Model):
         # Efficiently get the current answer to every question of each of the tasks.
         #
         # Since we track the history of answers to each question, we need to get the most
-        # recent answer for each question. It's fastest if we pre-load the complete history
-        # of every question rather than making a separate database call for each question
-        # to find its most recent answer. See TaskAnswer.get_current_answer().
+        # recent answer for each question. Each TaskAnswer keeps a reference to its most
+        # recent TaskAnswerHistory, so we can load just those records in a single query
+        # rather than making a separate database call for each question or loading the
+        # complete history. See TaskAnswer.get_current_answer().
         #
         # Return a generator that yields tuples of (Task, ModuleQuestion, TaskAnswerHistory).
         # Among tuples for a particular Task, the tuples are in order of ModuleQuestion.definition_order.
+        tasks = list(tasks)
 
         # Batch load all of the current answers of the tasks.
-        current_answers = { } # Question => TaskAnswerHistory
+        current_answers = { } # (Task ID, Question ID) => TaskAnswerHistory
         for ansh in \
             (TaskAnswerHistory.objects
-                .filter(taskanswer__task__in=tasks)
-                .order_by('-id')
+                .filter(id__in=TaskAnswer.objects.filter(task__in=tasks).values("current_answer"))
                 .select_related('taskanswer', 'taskanswer__task', 'taskanswer__question', 'answered_by')
                 .prefetch_related('answered_by_task')
                 .prefetch_related("answered_by_task__module__app__source")
                 .prefetch_related("answered_by_task__module__questions")):\
-            current_answers.setdefault((ansh.taskanswer.task, ansh.taskanswer.question), ansh)
+            current_answers[(ansh.taskanswer.task_id, ansh.taskanswer.question_id)] = ansh
 
         # Batch load all of the ModuleQuestions.
-        questions = ModuleQuestion.objects.filter(module__in={ task.module for task in tasks })\
-            .order_by("definition_order")
+        questions = { } # Module ID => [ModuleQuestion]
+        for question in ModuleQuestion.objects.filter(module__in={ task.module_id for task in tasks })\
+            .order_by("definition_order"):
+            questions.setdefault(question.module_id, []).append(question)
 
         # Iterate over the tasks and their questions in order...
         for task in tasks:
-            for question in questions:
-                # Skip if this question is not for this task.
-                if question.module != task.module: continue
-
+            for question in questions.get(task.module_id, []):
                 # Get the latest TaskAnswerHistory instance, if there is any.
-                answer = current_answers.get((task, question), None)
+                answer = current_answers.get((task.id, question.id), None)
 
                 # If the answer is marked as cleared, then treat as if it had
                 # not been there at all.
@@ -624,8 +668,23 @@ class Task(models.Model):
     def get_answers(self):
         # Return a ModuleAnswers instance that wraps this Task and its Pythonic answer values.
         # The dict of answers is ordered to preserve the question definition order.
-        answertuples = OrderedDict()
-        for q, a in self.get_current_answer_records():
+        # During a request, answers are served from the request's AnswerSnapshot.
+        from .module_logic import record_task_read, get_answer_snapshot
+        record_task_read(self)
+        snapshot = get_answer_snapshot()
+        if snapshot is not None:
+            answertuples = snapshot.get_answertuples(self)
+        else:
+            answertuples = Task.get_all_answertuples([self])[self.id]
+        return ModuleAnswers(self.module, self, answertuples)
+
+    @staticmethod
+    def get_all_answertuples(tasks):
+        # Return a dict from Task IDs to the ordered answer tuples of the
+        # Tasks, for ModuleAnswers, loaded with get_all_current_answer_records.
+        tasks = list(tasks)
+        ret = { task.id: OrderedDict() for task in tasks }
+        for task, q, a in Task.get_all_current_answer_records(tasks):
             # Get the value of that answer.
             if a is not None:
                 is_answered = True
@@ -633,8 +692,8 @@ class Task(models.Model):
             else:
                 is_answered = False
                 value = None
-            answertuples[q.key] = (q, is_answered, a, value)
-        return ModuleAnswers(self.module, self, answertuples)
+            ret[task.id][q.key] = (q, is_answered, a, value)
+        return ret
 
     def get_last_modification(self):
         ans = TaskAnswerHistory.objects\
@@ -653,79 +712,158 @@ class Task(models.Model):
         if not isinstance(self.cached_state, dict):
             self.cached_state = { }
 
+        # Any cached state that is being computed that reads this cached
+        # state depends on this Task, and on the Tasks that the cached
+        # value was computed from.
+        from .module_logic import TaskReadSet, record_task_read
+        record_task_read(self, self.cached_state.get("_reads", { }).get(key))
+
         # Handle a cache miss --- call refresh_func() and
         # then save it to cached_state (and save to the db).
+        # Record which Tasks were read while computing the
+        # value (always including this one) so that the
+        # value is cleared when any of them changes. See
+        # clear_state.
         if key not in self.cached_state:
-            self.cached_state[key] = refresh_func()
+            with TaskReadSet() as read_set:
+                value = refresh_func()
+            read_set.task_ids.add(self.id)
+            self.cached_state[key] = value
+            self.cached_state.setdefault("_reads", { })[key] = sorted(read_set.task_ids)
             self.save(update_fields=["cached_state"])
+            self.cached_state_reads.add(*(read_set.task_ids - { self.id }))
 
         # Return cached value.
         return self.cached_state[key]
 
+    def _get_cached_output(self, document_index, output_format, variant, refresh_func):
+        # Like _get_cached_state, but for rendered output documents, which
+        # can be large and so are stored one per row in TaskRenderedOutput
+        # rather than in the cached_state JSON field.
+        from .module_logic import TaskReadSet, record_task_read
+        entry = TaskRenderedOutput.objects\
+            .filter(task=self, document=document_index, format=output_format, variant=variant)\
+            .only("content", "reads")\
+            .first()
+        if entry is not None:
+            record_task_read(self, entry.reads)
+            return entry.content
+        record_task_read(self)
+
+        # Cache miss. Render and save, recording which Tasks were read
+        # while rendering.
+        with TaskReadSet() as read_set:
+            value = refresh_func()
+        read_set.task_ids.add(self.id)
+        try:
+            with transaction.atomic():
+                TaskRenderedOutput.objects.create(
+                    task=self,
+                    document=document_index,
+                    format=output_format,
+                    variant=variant,
+                    content=value,
+                    size=len(value.encode("utf8")),
+                    reads=sorted(read_set.task_ids),
+                )
+        except IntegrityError:
+            # Another request rendered the same document at the same time.
+            # Its content is just as good as ours.
+            pass
+        self.cached_state_reads.add(*(read_set.task_ids - { self.id }))
+        return value
+
     def is_started(self):
         return self.answers.exists()
 
     def is_finished(self):
-        def compute_is_finished():
-            # Check that all questions that need an answer have
-            # an answer and that all module-type questions are
-            # finished.
-            try:
-                answers = self.get_answers().with_extended_info()
-            except Exception:
-                # If there is an error evaluating imputed conditions,
-                # just say the task is unfinished.
-                return False
-            if len(answers.can_answer) != 0:
-                return False
-            for a in answers.as_dict().values():
-                # module-type questions
-                if isinstance(a, ModuleAnswers) and a.task:
-                    if not a.task.is_finished():
-                        return False
-                # module-set-type questions
-                if isinstance(a, list):
-                    for item in a:
-                        if isinstance(item, ModuleAnswers) and item.task:
-                            if not item.task.is_finished():
-                                return False
-            return True
-        return self._get_cached_state("is_finished", compute_is_finished)
+        return self.get_rollups()[0]
 
     def get_progress_percent(self):
          answered, total = self.get_progress_percent_tuple()
          return (answered/total*100) if (total > 0) else 100
 
     def get_progress_percent_tuple(self):
-        def compute_progress_percent():
-            # Return a tuple of the number of questions that have an answer
-            # and the total number of questions. For module-type questions
-            # that are answered, recursively add the questions of the inner module.
-            try:
-                answers = self.get_answers().with_extended_info()
-            except Exception:
-                # If there is an error evaluating imputed conditions,
-                # just say the task is empty.
-                return (0, 0)
-
-            num_answered = 0
-            num_questions = 0
-            for (q, is_answered, a, value) in answers.answertuples.values():
-                # module-type questions with a real answer
-                if isinstance(value, ModuleAnswers) and value.task:
-                    inner_answered, inner_total = value.task.get_progress_percent_tuple()
-                    num_answered += inner_answered
-                    num_questions += inner_total
-
-                # all other questions
-                else:
-                    if is_answered:
-                        num_answered += 1
-                    num_questions += 1
+        # Return a tuple of the number of questions that have an answer
+        # and the total number of questions, including the questions of
+        # sub-tasks.
+        return self.get_rollups()[1:]
+
+    def get_rollups(self):
+        # Return a tuple of whether the Task is finished, the number of questions
+        # that have an answer, and the total number of questions, rolled up over
+        # the Task and its sub-tasks. They're cached in cached_state like other
+        # state and also stored in columns so that pages that list Tasks can
+        # read them directly. The columns are nulled by clear_state when the
+        # cached entry is cleared and are brought up to date for the Tasks whose
+        # answers changed and the Tasks they are answers to by on_answer_changed.
+        if self.finished is not None and self.progress_answered is not None and self.progress_total is not None:
+            from .module_logic import record_task_read
+            reads = self.cached_state.get("_reads", { }) if isinstance(self.cached_state, dict) else { }
+            record_task_read(self, reads.get("rollups"))
+            return (self.finished, self.progress_answered, self.progress_total)
+
+        finished, answered, total = self._get_cached_state("rollups", self.compute_rollups)
+        self.finished, self.progress_answered, self.progress_total = finished, answered, total
+        Task.objects.filter(id=self.id).update(finished=finished, progress_answered=answered, progress_total=total)
+        return (finished, answered, total)
+
+    def compute_rollups(self):
+        # Check that all questions that need an answer have an answer and
+        # that all module-type questions are finished, and count the questions
+        # that have an answer. For module-type questions that are answered,
+        # add the counts of the inner Task.
+        try:
+            answers = self.get_answers().with_extended_info()
+        except Exception:
+            # If there is an error evaluating imputed conditions,
+            # just say the task is unfinished and empty.
+            return (False, 0, 0)
+
+        finished = len(answers.can_answer) == 0
+        num_answered = 0
+        num_questions = 0
+        for (q, is_answered, a, value) in answers.answertuples.values():
+            # module-type questions with a real answer
+            if isinstance(value, ModuleAnswers) and value.task:
+                inner_finished, inner_answered, inner_total = value.task.get_rollups()
+                finished = finished and inner_finished
+                num_answered += inner_answered
+                num_questions += inner_total
+
+            # all other questions
+            else:
+                if is_answered:
+                    num_answered += 1
+                num_questions += 1
 
-            return (num_answered, num_questions)
-        return self._get_cached_state("progress_percent_tuple", compute_progress_percent)
+                # module-set-type questions
+                if isinstance(value, list):
+                    for item in value:
+                        if isinstance(item, ModuleAnswers) and item.task:
+                            finished = finished and item.task.is_finished()
 
+        return (finished, num_answered, num_questions)
+
+    @staticmethod
+    def update_rollups(task_ids):
+        # Compute the rollups of these Tasks and then of the Tasks that they
+        # are the current answers to, level by level up the tree of Tasks, so
+        # that they are already computed when a page that lists Tasks is next
+        # viewed. Their old rollups were cleared by clear_state since they read
+        # these Tasks. Then update the lifecycle stages of the Projects whose
+        # root Tasks were updated.
+        task_ids = set(task_ids)
+        seen_task_ids = set()
+        while task_ids:
+            for task in Task.objects.filter(id__in=task_ids).select_related("module"):
+                task.get_rollups()
+            seen_task_ids |= task_ids
+            task_ids = set(TaskAnswer.objects
+                .filter(current_answer__answered_by_task__in=task_ids)
+                .values_list("task_id", flat=True)) - seen_task_ids
+        for project in Project.objects.filter(root_task__in=seen_task_ids, lifecycle_stage_code=None).select_related("root_task__module"):
+            project.update_lifecycle_stage_code()
 
     # This method is called any time an answer to any of this Task's questions
     # is changed, or for questions that are answered by sub-tasks, and if any
@@ -733,49 +871,112 @@ class Task(models.Model):
     def on_answer_changed(self):
         Task.clear_state({ self })
 
-    # Do the work of clearing the cached_state of a set of Tasks.
-    # * Clear the Tasks' cached_state field and bump their 'updated' time so
-    #   anyone waiting for changes to the tasks knows a change ocurred.
-    # * Do the same for any Tasks that these Tasks are a current answer of a question to.
-    # * Since templates can peek up to the project and see anything within it,
-    #   then any Task in the same project must also have their cache cleared.
-    #   TODO: It would be nice to know whether or not the cached_state is actually
-    #   based on project-level information because most Tasks might not peek
-    #   up and Tasks that don't do not need to have their cached_state cleared
-    #   in this case.
-    @staticmethod
-    def clear_state(tasks):
-        tasks = set(tasks)
-        target_tasks = tasks
-        while target_tasks:
-            new_tasks = set()
-
-            # Add Tasks whose current answers include any of these Tasks. First
-            # find TaskAnswerHistory records that reference the tasks....
-            ans = TaskAnswerHistory.objects.filter(answered_by_task__in=target_tasks)\
-                .select_related("taskanswer__task")
-
-            # Then find the IDs of the *current* answers of any of those questions.
-            curans = list(TaskAnswer.objects\
-                .filter(id__in={ a.taskanswer.id for a in ans })\
-                .annotate(current_answer_id=models.Max('answer_history__id'))\
-                .values_list('current_answer_id', flat=True))
+        # Answers read earlier in this request are no longer current.
+        from .module_logic import clear_answer_snapshots, update_rollups
+        clear_answer_snapshots()
 
-            # And filter so we only have current answers remaining.
-            ans = ans.filter(id__in=curans)
+        # Bring the finished and progress rollups up to date, and the lifecycle
+        # stages of the Projects whose root Tasks were updated, now or, if many
+        # answers are being saved, once they are all saved.
+        update_rollups({ self.id })
 
-            # Add Tasks in the same Project as any of the Tasks seen so far.
-            for task in Task.objects.filter(project__in={ t.project_id for t in target_tasks }):
-                new_tasks.add(task)
+        # Users' account settings are cached along with their access to
+        # Organizations. See User.localize_to_org_if_can_read.
+        if self.project.is_account_project:
+            for user_id in self.project.members.values_list("user_id", flat=True):
+                User.clear_org_access_cache(user_id)
 
-            new_tasks -= tasks
-            tasks |= new_tasks
-            target_tasks = new_tasks
-
-        # Clear cached_state
-        tasks_qs = Task.objects.filter(id__in={ t.id for t in tasks })
-        tasks_qs.update(cached_state=None, updated=timezone.now())
+    # Do the work of clearing the cached_state of a set of Tasks.
+    # * Clear the Tasks' cached_state field and rendered output documents and
+    #   bump their 'updated' time so anyone waiting for changes to the tasks
+    #   knows a change ocurred.
+    # * Do the same for the cached_state entries and rendered output documents
+    #   of any other Tasks that read the answers or cached state of these Tasks
+    #   when they were computed (templates can peek at other Tasks, including
+    #   up to the project and organization, and down into sub-tasks). Entries
+    #   that didn't read any of these Tasks are kept.
+    # * Since those entries are themselves read by other Tasks (e.g. a Task's
+    #   is_finished reads the is_finished state of its sub-tasks), repeat for
+    #   any Tasks that had entries cleared.
+    # tasks is a collection of Tasks or a QuerySet.
+    @staticmethod
+    def clear_state(tasks):
+        if isinstance(tasks, models.QuerySet):
+            changed_task_ids = set(tasks.values_list("id", flat=True))
+        else:
+            changed_task_ids = { t.id for t in tasks }
+        seen_task_ids = set(changed_task_ids)
+        target_task_ids = changed_task_ids
+        now = timezone.now()
+
+        # Everything cached for the changed Tasks is stale. Clear them all
+        # at once with set-based statements.
+        if changed_task_ids:
+            Task.objects.filter(id__in=changed_task_ids).update(cached_state=None, updated=now,
+                finished=None, progress_answered=None, progress_total=None)
+            TaskRenderedOutput.objects.filter(task__in=changed_task_ids).delete()
+            Task.cached_state_reads.through.objects.filter(from_task__in=changed_task_ids).delete()
+            Project.objects.filter(root_task__in=changed_task_ids).update(lifecycle_stage_code=None)
+
+        while target_task_ids:
+            new_task_ids = set()
+
+            # Find the other Tasks that read any of the target Tasks.
+            reader_tasks = list(Task.objects\
+                .filter(cached_state_reads__in=target_task_ids)\
+                .exclude(id__in=changed_task_ids)\
+                .distinct()\
+                .only("id", "cached_state"))
+
+            # Get the read sets of their rendered output documents. (Load
+            # model instances so that the JSON field is decoded --- values_list
+            # would return the raw JSON text.)
+            output_reads = { }
+            for output in TaskRenderedOutput.objects.filter(task__in=reader_tasks).only("id", "task_id", "reads"):
+                output_reads.setdefault(output.task_id, { })[output.id] = output.reads
+
+            for task in reader_tasks:
+                # Which entries are stale? Entries that read a target Task (besides
+                # the Task itself, whose answers didn't change), and entries saved
+                # without a read set. An entry computed from another of the Task's
+                # entries includes that entry's reads (see record_task_read), so
+                # it is stale whenever that entry is.
+                def is_stale(reads):
+                    return reads is None \
+                        or bool((set(reads) - { task.id }) & target_task_ids)
+                state = task.cached_state if isinstance(task.cached_state, dict) else { }
+                reads = state.pop("_reads", { })
+                stale_keys = { key for key in state if is_stale(reads.get(key)) }
+                outputs = output_reads.get(task.id, { })
+                stale_outputs = { output_id for output_id, output_reads in outputs.items() if is_stale(output_reads) }
+                if not stale_keys and not stale_outputs:
+                    continue
 
+                # Clear them and update the Tasks that this Task still reads.
+                for key in stale_keys:
+                    del state[key]
+                    reads.pop(key, None)
+                if state:
+                    state["_reads"] = reads
+                for output_id in stale_outputs:
+                    del outputs[output_id]
+                rollups = { "finished": None, "progress_answered": None, "progress_total": None } \
+                    if "rollups" in stale_keys else { }
+                Task.objects.filter(id=task.id).update(cached_state=state or None, updated=now, **rollups)
+                TaskRenderedOutput.objects.filter(id__in=stale_outputs).delete()
+                if stale_outputs:
+                    # The Project lifecycle stage is computed from an output document.
+                    Project.objects.filter(root_task=task.id).update(lifecycle_stage_code=None)
+                task.cached_state_reads.set(
+                    { task_id for task_ids in list(reads.values()) + list(outputs.values()) for task_id in task_ids }
+                    - { task.id })
+
+                # Other Tasks that read this one are now stale too.
+                if task.id not in seen_task_ids:
+                    new_task_ids.add(task.id)
+
+            seen_task_ids |= new_task_ids
+            target_task_ids = new_task_ids
 
     def get_status_display(self):
         # Is this task done?
@@ -796,23 +997,14 @@ class Task(models.Model):
             ).distinct()
 
         if recursive:
-            # Add in all tasks that these tasks refer to via answers to questions.
-            # (Including tasks in the same project because those may reference
-            # other tasks in other projects with different access levels.)
-            seen_task_ids = set(t.id for t in tasks)
-            tasks1 = tasks
-            while len(tasks1) > 0:
-                # Collect all of the tasks referenced by the last batch as answers,
-                # except ones we've already seen.
-                tasks2 = set()
-                for t in tasks1:
-                    for q, a in t.get_current_answer_records():
-                        if a:
-                            tasks2 |= set(a.answered_by_task.all())
-                tasks2_ids = set(tt.id for tt in tasks2)
-                seen_task_ids |= tasks2_ids
-                tasks |= Task.objects.filter(id__in=tasks2_ids).distinct()
-                tasks1 = tasks2
+            # Add in all tasks that these tasks refer to via answers to questions,
+            # recursively. (Including tasks in the same project because those may
+            # reference other tasks in other projects with different access levels.)
+            # TaskAncestor holds the tasks that refer to each task, recursively.
+            tasks = Task.objects.filter(
+                models.Q(id__in=tasks.values("id"))
+                | models.Q(ancestor_links__ancestor__in=tasks.values("id"))
+                ).distinct()
 
         return tasks
 
@@ -829,28 +1021,15 @@ class Task(models.Model):
 
         if recursive:
             # Access also comes from access to any Task that refers to this Task as a
-            # *current* answer to the question. First fetch all tasks that refer to this
-            # task, and then filter to see if the answer is current. Include Tasks in
-            # the same project because they may in turn be answers to tasks in other
-            # projects. Expand this out recursively.
-            parent_tasks = set()
-            search_tasks = [self]
-            while len(search_tasks) > 0:
-                ptasks = set(
-                    tah.taskanswer.task
-                    for tah in TaskAnswerHistory.objects
-                        .filter(answered_by_task__in=search_tasks)
-                        .exclude(taskanswer__task__id__in=[t.id for t in parent_tasks])
-                        .select_related("taskanswer__task")
-                    if tah.is_latest())
-                parent_tasks |= ptasks
-                search_tasks = ptasks
-
-            access_levels = set(t.get_access_level(user, recursive=False) for t in parent_tasks)
-            if "WRITE" in access_levels:
+            # *current* answer to the question, recursively, which are kept in the
+            # TaskAncestor table. Those Tasks may be in the same project or in other
+            # projects. The editor and members of the projects of those Tasks have
+            # write access.
+            if Task.objects\
+                .filter(descendant_links__task=self, deleted_at=None)\
+                .filter(models.Q(editor=user) | models.Q(project__members__user=user))\
+                .exists():
                 return "WRITE"
-            if "READ" in access_levels:
-                return "READ"
 
         return None
 
@@ -952,10 +1131,7 @@ class Task(models.Model):
             return self.module.spec["title"]
 
         # Render the instance-name template if its rendered value is not cached.
-        if self.cached_state is None:
-            self.cached_state = { }
-        if "title" not in self.cached_state:
-
+        def compute_title():
             if Task.IS_COMPUTING_TITLE:
                 # Hopefully this never occurs, but rendering the instance-name
                 # template could end up causing the task's title to be computed.
@@ -963,16 +1139,12 @@ class Task(models.Model):
 
             Task.IS_COMPUTING_TITLE = True
             try:
-                title = self.render_simple_string(
+                return self.render_simple_string(
                     "instance-name", self.module.spec["title"],
                     is_computing_title=True).strip()
             finally:
                 Task.IS_COMPUTING_TITLE = False
-
-            self.cached_state["title"] = title
-            self.save(update_fields=["cached_state"])
-
-        return self.cached_state["title"]
+        return self._get_cached_state("title", compute_title)
 
 
     def render_introduction(self):
@@ -1073,47 +1245,13 @@ class Task(models.Model):
 
         elif download_format == "pdf":
             # Render to HTML and convert to PDF using wkhtmltopdf.
-            
-            # Mark the encoding explicitly, to match the html.encode() argument below.
-            html = doc["html"]
-            html = '<meta charset="UTF-8" />' + html
-
-            import subprocess # nosec
-            cmd = ["/usr/bin/xvfb-run", "--", "/usr/bin/wkhtmltopdf",
-                   "-q", # else errors go to stdout
-                   "--disable-javascript",
-                   "--encoding", "UTF-8",
-                   "-s", "Letter", # page size
-                   "-", "-"]
-            with subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE) as proc:
-                stdout, stderr = proc.communicate(
-                      html.encode("utf8"),
-                      timeout=10)
-                if proc.returncode != 0: raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
-
-            blob = stdout
+            from .document_conversion import convert_html
+            blob = convert_html(doc["html"], "pdf")
 
         else:
             # Render to HTML and convert using pandoc.
-
-            # odt and some other formats cannot pipe to stdout, so we always
-            # generate a temporary file.
-            import tempfile, os.path, subprocess # nosec
-            with tempfile.TemporaryDirectory() as tempdir:
-                # convert from HTML to something else, writing to a temporary file
-                outfn = os.path.join(tempdir, filename)
-                with subprocess.Popen(
-                    ["/usr/bin/pandoc", "-f", "html", "-t", pandoc_format, "-o", outfn],
-                    stdin=subprocess.PIPE
-                    ) as proc:
-                    proc.communicate(
-                        doc["html"].encode("utf8"),
-                        timeout=10)
-                    if proc.returncode != 0: raise subprocess.CalledProcessError(0, '')
-
-                # return the content of the temporary file
-                with open(outfn, "rb") as f:
-                    blob = f.read()
+            from .document_conversion import convert_html
+            blob = convert_html(doc["html"], pandoc_format)
 
         return blob, filename, mime_type
 
@@ -1234,6 +1372,8 @@ class Task(models.Model):
 
             # Add the new task.
             ansh.answered_by_task.add(task)
+            ans.set_current_answer(ansh)
+            TaskAncestor.update([task])
 
             # Mark that the Task has had an answer changed.
             self.on_answer_changed()
@@ -1476,9 +1616,201 @@ class Task(models.Model):
         return did_update_any_questions
 
 
+class TaskRenderedOutput(models.Model):
+    task = models.ForeignKey(Task, related_name="rendered_outputs", on_delete=models.CASCADE, help_text="The Task whose output document was rendered.")
+    document = models.IntegerField(help_text="The index of the output document in the Module's output specification.")
+    format = models.CharField(max_length=16, help_text="The format the document was rendered to, e.g. 'html'.")
+    variant = models.CharField(max_length=16, blank=True, help_text="Other rendering options that affect the rendered content, e.g. 'data-urls' if assets were embedded in data: URLs.")
+
+    content = models.TextField(help_text="The rendered document.")
+    size = models.IntegerField(help_text="The size in bytes of the rendered document, when encoded in UTF-8.")
+    reads = JSONField(help_text="The IDs of the Tasks that were read while rendering the document. The rendered document is deleted when any of them change.")
+
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('task', 'document', 'format', 'variant')]
+
+    def __str__(self):
+        return "%s output %d (%s%s)" % (self.task, self.document, self.format, (", " + self.variant) if self.variant else "")
+
+    @staticmethod
+    def get_cache_size(**filters):
+        # Return the number of rendered output documents and their total
+        # size in bytes, optionally filtered, e.g. by task__project=.
+        ret = TaskRenderedOutput.objects.filter(**filters).aggregate(count=models.Count('id'), size=models.Sum('size'))
+        return (ret["count"], ret["size"] or 0)
+
+class DocumentExportJob(models.Model):
+    # A queue of output documents to convert to other formats, which can take
+    # longer than a web request should. Jobs are processed by the
+    # process_export_jobs management command.
+
+    # Formats that are exported through this queue rather than in the request.
+    ASYNC_FORMATS = ("pdf", "docx", "odt")
+
+    # How long a job may be running before we assume the worker died and the
+    # job can be picked up by another worker, and how long to keep the output
+    # of finished jobs.
+    STALE_AFTER = 60*10 # seconds
+    EXPIRE_AFTER = 60*60*24 # seconds
+
+    task = models.ForeignKey(Task, related_name="export_jobs", on_delete=models.CASCADE, help_text="The Task whose output document is being exported.")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, help_text="The user who requested the export, who is the only one who can download it.")
+    document_id = models.CharField(max_length=128, help_text="The id of the output document in the Task's Module's output specification.")
+    download_format = models.CharField(max_length=16, help_text="The format to export the document to, e.g. 'pdf'.")
+
+    status = models.CharField(max_length=8, default="queued", choices=[("queued", "Queued"), ("running", "Running"), ("finished", "Finished"), ("failed", "Failed")], help_text="Where the job is in its processing.")
+    content = models.BinaryField(blank=True, null=True, help_text="The exported document, once the job is finished.")
+    filename = models.CharField(max_length=256, blank=True, help_text="The suggested filename of the exported document.")
+    mime_type = models.CharField(max_length=128, blank=True, help_text="The MIME type of the exported document.")
+    error = models.TextField(blank=True, help_text="Why the job failed, if it failed.")
+
+    created = models.DateTimeField(auto_now_add=True, db_index=True)
+    started = models.DateTimeField(blank=True, null=True, help_text="When a worker started processing the job.")
+    finished = models.DateTimeField(blank=True, null=True, help_text="When the job finished or failed.")
+
+    class Meta:
+        index_together = [
+            ('status', 'created'),
+        ]
+
+    def __repr__(self):
+        # For debugging.
+        return "<DocumentExportJob %s %s %s %s>" % (self.id, repr(self.task), self.document_id, self.status)
+
+    def get_status_url(self):
+        return "/tasks/_export/%d" % self.id
+
+    def get_download_url(self):
+        return "/tasks/_export/%d/download" % self.id
+
+    def get_status_dict(self):
+        ret = {
+            "status": self.status,
+            "status_url": self.get_status_url(),
+        }
+        if self.status == "finished":
+            ret["download_url"] = self.get_download_url()
+        if self.status == "failed":
+            ret["message"] = self.error
+        return ret
+
+    @staticmethod
+    def enqueue(task, user, document_id, download_format):
+        # Queue a new job, unless the user already has the same export in
+        # the queue, e.g. if they clicked download twice.
+        job = DocumentExportJob.objects.filter(
+            task=task, user=user,
+            document_id=document_id, download_format=download_format,
+            status__in=("queued", "running"))\
+            .order_by('-id').first()
+        if job is None:
+            job = DocumentExportJob.objects.create(
+                task=task, user=user,
+                document_id=document_id, download_format=download_format)
+        return job
+
+    @staticmethod
+    def claim_next():
+        # Take the oldest job off of the queue and mark it as running, or
+        # return None if the queue is empty. Jobs that have been running for
+        # a long time are assumed to have been abandoned by a worker that died.
+        # Several workers may be trying to claim the same job, so the job is
+        # only ours if our update to its status is the one that takes effect.
+        from datetime import timedelta
+        while True:
+            now = timezone.now()
+            claimable = models.Q(status="queued") \
+                | models.Q(status="running", started__lt=now - timedelta(seconds=DocumentExportJob.STALE_AFTER))
+            job = DocumentExportJob.objects.filter(claimable).order_by('created', 'id').only("id").first()
+            if job is None:
+                return None
+            if DocumentExportJob.objects.filter(claimable, id=job.id).update(status="running", started=now):
+                return DocumentExportJob.objects.get(id=job.id)
+
+    def run(self):
+        # Do the export and save the result.
+        try:
+            self.content, self.filename, self.mime_type = \
+                self.task.download_output_document(self.document_id, self.download_format)
+            self.status = "finished"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e) or e.__class__.__name__
+        self.finished = timezone.now()
+        self.save()
+
+    @staticmethod
+    def delete_expired():
+        from datetime import timedelta
+        DocumentExportJob.objects\
+            .filter(finished__lt=timezone.now() - timedelta(seconds=DocumentExportJob.EXPIRE_AFTER))\
+            .delete()
+
+class TaskAncestor(models.Model):
+    # A closure table of the Tasks that refer to other Tasks as current answers
+    # to module-type and module-set-type questions, directly or indirectly.
+    # Maintained by TaskAncestor.update as answers that refer to sub-tasks change.
+    task = models.ForeignKey(Task, related_name="ancestor_links", on_delete=models.CASCADE, help_text="The Task that is (perhaps indirectly) an answer to a question in the ancestor Task.")
+    ancestor = models.ForeignKey(Task, related_name="descendant_links", on_delete=models.CASCADE, help_text="The Task that has the task as a current answer to a question, directly or through other Tasks.")
+
+    class Meta:
+        unique_together = [('task', 'ancestor')]
+
+    def __str__(self):
+        return "%s < %s" % (self.task, self.ancestor)
+
+    @staticmethod
+    def get_parent_task_ids(task_ids):
+        # Return a dict mapping Task IDs to the set of IDs of the Tasks that have them
+        # as a current answer to a question.
+        parents = { }
+        for task_id, parent_id in TaskAnswerHistory.answered_by_task.through.objects\
+            .filter(task_id__in=task_ids, taskanswerhistory__taskanswer__current_answer=models.F("taskanswerhistory_id"))\
+            .values_list("task_id", "taskanswerhistory__taskanswer__task_id"):
+            parents.setdefault(task_id, set()).add(parent_id)
+        return parents
+
+    @staticmethod
+    def update(tasks):
+        # The Tasks that are current answers to a question changed from or to
+        # the given Tasks. Re-compute the ancestors of those Tasks and of
+        # every Task below them.
+        task_ids = { t.id for t in tasks }
+        task_ids |= set(TaskAncestor.objects.filter(ancestor__in=task_ids).values_list("task_id", flat=True))
+
+        # Find the parents of those Tasks, then their parents, and so on.
+        parents = { }
+        frontier = task_ids
+        while frontier:
+            new_parents = TaskAncestor.get_parent_task_ids(frontier)
+            for task_id in frontier:
+                parents[task_id] = new_parents.get(task_id, set())
+            frontier = set().union(*new_parents.values()) - set(parents)
+
+        # Collect the ancestors of each Task.
+        links = []
+        for task_id in task_ids:
+            ancestors = set()
+            stack = list(parents[task_id])
+            while stack:
+                ancestor_id = stack.pop()
+                if ancestor_id in ancestors: continue
+                ancestors.add(ancestor_id)
+                stack.extend(parents[ancestor_id])
+            ancestors.discard(task_id)
+            links.extend(TaskAncestor(task_id=task_id, ancestor_id=ancestor_id) for ancestor_id in ancestors)
+
+        # Replace the table rows.
+        with transaction.atomic():
+            TaskAncestor.objects.filter(task__in=task_ids).delete()
+            TaskAncestor.objects.bulk_create(links)
+
 class TaskAnswer(models.Model):
     task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name="answers", help_text="The Task that this TaskAnswer is a part of.")
     question = models.ForeignKey(ModuleQuestion, on_delete=models.PROTECT, help_text="The question (within the Task's Module) that this TaskAnswer is answering.")
+    current_answer = models.ForeignKey('TaskAnswerHistory', blank=True, null=True, related_name="+", on_delete=models.SET_NULL, help_text="The most recent TaskAnswerHistory for this TaskAnswer, i.e. the one with the highest primary key. Maintained by set_current_answer.")
 
     notes = models.TextField(blank=True, help_text="Notes entered by editors working on this question.")
 
@@ -1502,12 +1834,25 @@ class TaskAnswer(models.Model):
         return self.task.get_absolute_url_to_question(self.question)
 
     def get_current_answer(self):
-        # The current answer is the one with the highest primary key.
-        return self.answer_history\
+        # The current answer is the one with the highest primary key,
+        # which we keep a reference to.
+        if self.current_answer_id is None:
+            return None
+        return TaskAnswerHistory.objects\
+            .filter(id=self.current_answer_id)\
             .prefetch_related("answered_by_task__module__questions")\
-            .order_by('-id')\
             .first()
 
+    def set_current_answer(self, answer):
+        # Update the current_answer reference after a new TaskAnswerHistory
+        # is created for this TaskAnswer. Only move the reference forward,
+        # in case another request created a newer record at the same time.
+        TaskAnswer.objects\
+            .filter(id=self.id)\
+            .filter(models.Q(current_answer=None) | models.Q(current_answer__lt=answer.id))\
+            .update(current_answer=answer)
+        self.current_answer = answer
+
     def has_answer(self):
         ans = self.get_current_answer()
         if ans and not ans.cleared:
@@ -1594,12 +1939,18 @@ class TaskAnswer(models.Model):
             return False
 
         # Store a new TaskAnswerHistory record with the cleared flag set.
-        TaskAnswerHistory.objects.create(
+        answer = TaskAnswerHistory.objects.create(
             taskanswer=self,
             answered_by=user,
             stored_value=None,
             answered_by_file=None,
             cleared=True)
+        self.set_current_answer(answer)
+
+        # Sub-tasks that were the answer are no longer below this Task.
+        prev_subtasks = set(ans.answered_by_task.all())
+        if prev_subtasks:
+            TaskAncestor.update(prev_subtasks)
 
         # Kick the TaskAnswer's updated fields and the Task to mark that the
         # answer has changed.
@@ -1657,6 +2008,19 @@ class TaskAnswer(models.Model):
             unsure=unsure)
         for t in answered_by_tasks:
             answer.answered_by_task.add(t)
+        self.set_current_answer(answer)
+
+        # For uploaded files, compute thumbnails etc. now rather than each
+        # time the answer is used.
+        if self.question.spec["type"] == "file" and answer.answered_by_file.name:
+            answer.compute_file_derivatives()
+            answer.save(update_fields=["extra", "thumbnail"])
+
+        # If the sub-tasks that are the answer changed, update which Tasks
+        # are below which.
+        prev_subtasks = set(current_answer.answered_by_task.all()) if current_answer else set()
+        if prev_subtasks != set(answered_by_tasks):
+            TaskAncestor.update(prev_subtasks | set(answered_by_tasks))
 
         # Kick the Task and TaskAnswer's updated field and let the Task know that
         # its answers have changed.
@@ -1807,7 +2171,7 @@ class TaskAnswerHistory(models.Model):
 
     def is_latest(self):
         # Is this the most recent --- the current --- answer for a TaskAnswer.
-        return self.taskanswer.get_current_answer() == self
+        return self.taskanswer.current_answer_id == self.id
 
     def is_skipped(self):
         # A skipped question is one whose answer is None,
@@ -1856,21 +2220,12 @@ class TaskAnswerHistory(models.Model):
                 # Question was skipped.
                 return None
 
-            # Get the dbstorage.models.StoredFile instance which holds
-            # an auto-detected mime type.
-            from dbstorage.models import StoredFile
-            sf = StoredFile.objects.only("mime_type").get(path=blob.name)
-
-            # Create a display string explaining the file type.
-            if sf.mime_type == "text/plain":
-                file_type = "plain text"
-            elif sf.mime_type.startswith("image/"):
-                file_type = "image"
-            elif sf.mime_type == "text/html":
-                file_type = "HTML"
-            else:
-                import mimetypes
-                file_type = mimetypes.guess_extension(sf.mime_type, strict=False)[1:]
+            # Get the metadata, data URLs and thumbnail that were computed
+            # when the file was uploaded. (Older answers may not have them yet.)
+            if not isinstance(self.extra, dict) or "file" not in self.extra:
+                self.compute_file_derivatives()
+                self.save(update_fields=["extra", "thumbnail"])
+            file_info = self.extra["file"]
 
             # Get the URL that can retreive the resource. It's behind
             # auth so we don't use blob.url, which won't work because
@@ -1885,61 +2240,19 @@ class TaskAnswerHistory(models.Model):
             # the API it makes sense.
             url = self.taskanswer.task.project.organization.get_url(url)
 
-            # Convert it to a data URL so that it can be rendered in exported documents.
-            content_dataurl = None
-            if q.spec.get("file-type") == "image":
-                content_dataurl = image_to_dataurl(self.answered_by_file, 640)
-
-            # Construct a thumbnail and a URL to it.
+            # If we have a thumbnail, indicate so by returning a URL to it.
             thumbnail_url = None
-            thumbnail_dataurl = None
-            if not self.thumbnail:
-                # Try to construct a thumbnail.
-                if sf.mime_type == "text/html":
-                    # Use wkhtmltoimage.
-                    import subprocess # nosec
-                    try:
-                        # Pipe to subprocess.
-                        # xvfb is required to run wkhtmltopdf in headless mode on Debian, see https://github.com/wkhtmltopdf/wkhtmltopdf/issues/2037#issuecomment-62019521.
-                        cmd = ["/usr/bin/xvfb-run", "--", "/usr/bin/wkhtmltoimage",
-                                "-q", # else errors go to stdout
-                                "--disable-javascript",
-                                "-f", "png",
-                                # "--disable-smart-width", - generates a warning on stdout that qt is unpatched, which happens in headless mode
-                                "--zoom", ".7",
-                                "--width", "700",
-                                "--height", str(int(700*9/16)),
-                                "-", "-"]
-                        with subprocess.Popen(cmd,
-                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-                            ) as proc:
-                            stdout, stderr = proc.communicate(
-                                self.answered_by_file.read(),
-                                timeout=10)
-                            if proc.returncode != 0: raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
-
-                        # Store PNG.
-                        from django.core.files.base import ContentFile
-                        value = ContentFile(stdout)
-                        value.name = "thumbnail.png" # needs a name for the storage backend?
-                        self.thumbnail = value
-                        self.save(update_fields=["thumbnail"])
-                    except subprocess.CalledProcessError as e:
-                        print(e)
-
-            if self.thumbnail:
-                # If we have a thumbnail, indicate so by returning a URL to it.
+            if file_info["thumbnail_dataurl"]:
                 thumbnail_url = url + "?thumbnail=1"
-                thumbnail_dataurl = image_to_dataurl(self.thumbnail, 640)
 
             return {
                 "url": url,
-                "content_dataurl": content_dataurl,
-                "size": blob.size,
-                "type": sf.mime_type,
-                "type_display": file_type,
+                "content_dataurl": file_info["content_dataurl"],
+                "size": file_info["size"],
+                "type": file_info["type"],
+                "type_display": file_info["type_display"],
                 "thumbnail_url": thumbnail_url,
-                "thumbnail_dataurl": thumbnail_dataurl,
+                "thumbnail_dataurl": file_info["thumbnail_dataurl"],
             }
         
         # For all other question types, the value is stored in the stored_value
@@ -1963,6 +2276,88 @@ class TaskAnswerHistory(models.Model):
             else:
                 raise Exception("Invalid value in stored_encoding field.")
 
+    def compute_file_derivatives(self):
+        # For answers to "file"-type questions, compute the metadata about the
+        # uploaded file, a data URL of its content (for images) and a thumbnail
+        # (for HTML files), which are expensive to compute, and store them in
+        # the extra field so that get_value can return them without doing any
+        # image processing. Called when the answer is saved. The caller must
+        # save the instance.
+        q = self.taskanswer.question
+        blob = self.answered_by_file
+
+        # Get the dbstorage.models.StoredFile instance which holds
+        # an auto-detected mime type.
+        from dbstorage.models import StoredFile
+        sf = StoredFile.objects.only("mime_type").get(path=blob.name)
+
+        # Create a display string explaining the file type.
+        if sf.mime_type == "text/plain":
+            file_type = "plain text"
+        elif sf.mime_type.startswith("image/"):
+            file_type = "image"
+        elif sf.mime_type == "text/html":
+            file_type = "HTML"
+        else:
+            import mimetypes
+            file_type = mimetypes.guess_extension(sf.mime_type, strict=False)[1:]
+
+        # Convert it to a data URL so that it can be rendered in exported documents.
+        content_dataurl = None
+        if q.spec.get("file-type") == "image":
+            content_dataurl = image_to_dataurl(self.answered_by_file, 640)
+
+        # Construct a thumbnail.
+        thumbnail_dataurl = None
+        if not self.thumbnail:
+            # Try to construct a thumbnail.
+            if sf.mime_type == "text/html":
+                # Use wkhtmltoimage.
+                import subprocess # nosec
+                try:
+                    # Pipe to subprocess.
+                    # xvfb is required to run wkhtmltopdf in headless mode on Debian, see https://github.com/wkhtmltopdf/wkhtmltopdf/issues/2037#issuecomment-62019521.
+                    cmd = ["/usr/bin/xvfb-run", "--", "/usr/bin/wkhtmltoimage",
+                            "-q", # else errors go to stdout
+                            "--disable-javascript",
+                            "-f", "png",
+                            # "--disable-smart-width", - generates a warning on stdout that qt is unpatched, which happens in headless mode
+                            "--zoom", ".7",
+                            "--width", "700",
+                            "--height", str(int(700*9/16)),
+                            "-", "-"]
+                    with subprocess.Popen(cmd,
+                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                        ) as proc:
+                        stdout, stderr = proc.communicate(
+                            self.answered_by_file.read(),
+                            timeout=10)
+                        if proc.returncode != 0: raise subprocess.CalledProcessError(proc.returncode, ' '.join(cmd))
+
+                    # Store PNG.
+                    from django.core.files.base import ContentFile
+                    value = ContentFile(stdout)
+                    value.name = "thumbnail.png" # needs a name for the storage backend?
+                    self.thumbnail = value
+                except (OSError, subprocess.CalledProcessError):
+                    # The answer is still usable without a thumbnail.
+                    import logging
+                    logger = logging.getLogger(__name__)
+                    logger.warning("Could not make a thumbnail for TaskAnswerHistory {}.".format(self.id), exc_info=True)
+
+        if self.thumbnail:
+            thumbnail_dataurl = image_to_dataurl(self.thumbnail, 640)
+
+        if not isinstance(self.extra, dict):
+            self.extra = { }
+        self.extra["file"] = {
+            "content_dataurl": content_dataurl,
+            "size": blob.size,
+            "type": sf.mime_type,
+            "type_display": file_type,
+            "thumbnail_dataurl": thumbnail_dataurl,
+        }
+
     def get_answer_display(self):
         if self.cleared:
             return "[marked unanswered]"
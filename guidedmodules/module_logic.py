@@ -1,4 +1,3 @@
-from django.conf import settings
 from jinja2.sandbox import SandboxedEnvironment
 
 def get_jinja2_template_vars(template):
@@ -33,7 +32,7 @@ class Jinja2Environment(SandboxedEnvironment):
         # Call default operator logic.
         return SandboxedEnvironment.call_binop(self, context, operator, left, right)
 
-def walk_module_questions(module, callback):
+def walk_module_questions(module, callback, processed_questions=None):
     # Walks the questions in depth-first order following the dependency
     # tree connecting questions. If a question is a dependency of multiple
     # questions, it is walked only once.
@@ -46,51 +45,44 @@ def walk_module_questions(module, callback):
     #    of the callback calls on its dependencies.
     # 3) A set of ModuleQuestion instances that this question depends on,
     #    so that the callback doesn't have to compute it (again) itself.
+    #
+    # processed_questions, if given, is a dict mapping question keys to the
+    # states that questions gave in an earlier walk. Those questions are not
+    # walked again --- their states are re-used. The dict is filled in with
+    # the states of the questions that are walked.
 
     # Remember each question that is processed so we only process each
     # question at most once. Cache the state that it gives.
-    processed_questions = { }
-
-    # Pre-load all of the dependencies between questions in this module
-    # and get the questions that are not depended on by any question,
-    # which is where the dependency chains start.
-    dependencies, root_questions = get_all_question_dependencies(module)
-
-    # Local function that processes a single question.
-    def walk_question(q, stack):
-        # If we've seen this question already as a dependency of another
-        # question, then return its state dict from last time.
+    if processed_questions is None:
+        processed_questions = { }
+
+    # Get the dependencies between questions in this module and the order
+    # to walk them in, which was computed when the module was loaded. The
+    # order is a depth-first walk starting from the questions that are not
+    # depended on by any question, in document order, and visiting the
+    # questions each question depends on, also in document order, first.
+    graph = get_question_dependency_graph(module)
+    if graph["error"]:
+        raise ValueError(graph["error"])
+
+    for q in graph["walk_order"]:
+        # If we've seen this question already, skip it.
         if q.key in processed_questions:
-            return processed_questions[q.key]
-        
-        # Prevent infinite recursion.
-        if q.key in stack:
-            raise ValueError("Cyclical dependency in questions: " + "->".join(stack + [q.key]))
+            continue
 
-        # Execute recursively on the questions it depends on,
-        # in module definition order rather than in a random
-        # order.
+        # Merge the states of the questions it depends on, in module
+        # definition order rather than in a random order. They've all
+        # been walked already.
         state = { }
-        deps = list(dependencies[q])
-        deps.sort(key = lambda q : q.definition_order)
-        for qq in deps:
-            state.update(walk_question(qq, stack+[q.key]))
+        for qq in graph["sorted_dependencies"][q]:
+            state.update(processed_questions[qq.key])
 
         # Run the callback and get its state.
-        state = callback(q, state, dependencies[q])
+        state = callback(q, state, graph["dependencies"][q])
 
-        # Remember the state in case we encounter it later.
+        # Remember the state for the questions that depend on it.
         processed_questions[q.key] = dict(state) # clone
 
-        # Return the state to the caller.
-        return state
-
-    # Walk the dependency root questions in document order.
-    root_questions = list(root_questions)
-    root_questions.sort(key = lambda q : q.definition_order)
-    for q in root_questions:
-        walk_question(q, [])
-
 
 def evaluate_module_state(current_answers, parent_context=None):
     # Compute the next question to ask the user, given the user's
@@ -100,22 +92,33 @@ def evaluate_module_state(current_answers, parent_context=None):
     # To figure this out, we walk the dependency tree of questions
     # until we arrive at questions that have no unanswered dependencies.
     # Such questions can be put forth to the user.
+    #
+    # The result of the last evaluation of each Task's state is remembered
+    # (see get_last_module_state). When an answer changes, only the questions
+    # that (transitively) depend on the changed answers are walked again.
+    # Everything else is taken from the last evaluation.
 
-    # Build a list of ModuleQuestions that the user may answer now.
-    can_answer = set()
-
-    # Build a list of ModuleQuestions that still need an answer,
-    # including can_answer and unanswered ModuleQuestions that
-    # have dependencies that are unanswered and need to be answered
-    # first before the questions in this list can be answered.
-    unanswered = set()
-
-    # Build a new array of answer values.
     from collections import OrderedDict
-    answertuples = OrderedDict()
 
-    # Build a list of questions whose answers were imputed.
-    was_imputed = set()
+    # Get the inputs to the evaluation and see what changed since the
+    # last evaluation of this Task's state.
+    inputs = get_module_state_inputs(current_answers)
+    last_state = get_last_module_state(current_answers)
+    if last_state is None:
+        # Walk every question.
+        outcomes = { }
+        processed_questions = { }
+        walk_order = [ ]
+    else:
+        # Walk the questions whose answers changed, the questions whose
+        # impute conditions may depend on things other than the answers
+        # to this module's questions, and everything downstream of them.
+        changed_keys = { key for key in set(inputs) | set(last_state["inputs"])
+                         if inputs.get(key) != last_state["inputs"].get(key) }
+        rewalk = get_downstream_questions(last_state["dependents"], changed_keys | last_state["volatile"])
+        outcomes = { key: outcome for key, outcome in last_state["outcomes"].items() if key not in rewalk }
+        processed_questions = { key: qstate for key, qstate in last_state["processed_questions"].items() if key not in rewalk }
+        walk_order = last_state["walk_order"]
 
     # Create some reusable context for evaluating impute conditions --- really only
     # so that we can pass down project and organization values. Everything else is
@@ -125,15 +128,22 @@ def evaluate_module_state(current_answers, parent_context=None):
         ModuleAnswers(current_answers.module, current_answers.task, {}), lambda _0, _1, _2, _3, value : str(value), # escapefunc
         parent_context=parent_context)
 
-    # Visitor function.
+    # Get the compiled impute conditions of the module's questions.
+    impute_rules = get_module_impute_rules(current_answers.module)
+
+    # Visitor function. It records the outcome for each question in outcomes,
+    # which is turned into the answer tuples and the lists of questions that
+    # can be answered, are unanswered, or were imputed below.
     def walker(q, state, deps):
+        if last_state is None:
+            walk_order.append(q.key)
+
         # If any of the dependencies don't have answers yet, or if it's been
         # skipped but it's a non-skippable dependency, then this question
         # cannot be processed yet.
         for qq, skippable in deps.items():
             if qq.key not in state or (not skippable and state[qq.key][3] is None):
-                unanswered.add(q)
-                answertuples[q.key] = (q, False, None, None)
+                outcomes[q.key] = ("unanswered", (q, False, None, None))
                 return { }
 
         # Can this question's answer be imputed from answers that
@@ -151,17 +161,18 @@ def evaluate_module_state(current_answers, parent_context=None):
             ModuleAnswers(current_answers.module, current_answers.task, state),
             impute_context_parent.escapefunc, parent_context=impute_context_parent, root=True)
 
-        v = run_impute_conditions(q.spec.get("impute", []), impute_context)
+        v = run_impute_conditions(get_question_impute_rules(q, impute_rules), impute_context)
         if v:
             # An impute condition matched. Unwrap to get the value.
             answerobj = None
             v = v[0]
-            was_imputed.add(q.key)
+            outcome = "imputed"
 
         elif q.key in current_answers.as_dict():
             # The user has provided an answer to this question.
             answerobj = current_answers.get(q.key)
             v = current_answers.as_dict()[q.key]
+            outcome = "answered"
 
         elif current_answers.module.spec.get("type") == "project" and q.key == "_introduction":
             # Projects have an introduction but it isn't displayed as a question.
@@ -170,6 +181,7 @@ def evaluate_module_state(current_answers, parent_context=None):
             # TODO: Is this still necessary?
             answerobj = None
             v = None
+            outcome = "introduction"
 
         else:
             # This question does not have an answer yet. We don't set
@@ -178,19 +190,48 @@ def evaluate_module_state(current_answers, parent_context=None):
             #
             # But we can remember that this question *can* be answered
             # by the user, and that it's not answered yet.
-            can_answer.add(q)
-            unanswered.add(q)
-            answertuples[q.key] = (q, False, None, None)
+            outcomes[q.key] = ("can_answer", (q, False, None, None))
             return state
 
         # Update the state that's passed to questions that depend on this
         # and also the global state of all answered questions.
         state[q.key] = (q, True, answerobj, v)
-        answertuples[q.key] = (q, True, answerobj, v)
+        outcomes[q.key] = (outcome, (q, True, answerobj, v))
         return state
 
     # Walk the dependency tree.
-    walk_module_questions(current_answers.module, walker)
+    walk_module_questions(current_answers.module, walker, processed_questions)
+
+    # Build a new array of answer values, a list of ModuleQuestions that the user
+    # may answer now, a list of ModuleQuestions that still need an answer (including
+    # can_answer and unanswered ModuleQuestions that have dependencies that are
+    # unanswered and need to be answered first before the questions in this list
+    # can be answered), and a list of questions whose answers were imputed.
+    answertuples = OrderedDict()
+    can_answer = []
+    unanswered = []
+    was_imputed = set()
+    for key in walk_order:
+        outcome, answertuple = outcomes[key]
+        if outcome == "answered":
+            # Take the user's answer from current_answers rather than from
+            # the last evaluation so that it is the current answer instance.
+            answertuple = (answertuple[0],) + tuple(current_answers.answertuples[key][1:])
+        answertuples[key] = answertuple
+        if outcome == "can_answer":
+            can_answer.append(answertuple[0])
+        if outcome in ("can_answer", "unanswered"):
+            unanswered.append(answertuple[0])
+        if outcome == "imputed":
+            was_imputed.add(key)
+
+    # Remember this evaluation for next time.
+    save_last_module_state(current_answers, last_state, {
+        "inputs": inputs,
+        "outcomes": outcomes,
+        "processed_questions": processed_questions,
+        "walk_order": walk_order,
+    })
 
     # There may be multiple routes through the tree of questions,
     # so we'll prefer the question that is defined first in the spec.
@@ -214,6 +255,175 @@ def evaluate_module_state(current_answers, parent_context=None):
     return ret
 
 
+# The last evaluated state of each Task's Module, so that evaluate_module_state
+# can re-evaluate only what changed. This is an in-process LRU cache. It does
+# not need to be invalidated when answers change because each evaluation compares
+# its inputs with the inputs of the last evaluation.
+MODULE_STATE_CACHE_MAX_SIZE = 256
+_module_state_cache = None
+_module_state_cache_lock = None
+
+def get_module_state_inputs(current_answers):
+    # The evaluation of a module's state depends on which questions are answered,
+    # by which TaskAnswerHistory record, and with what value.
+    current_answers.as_dict() # trigger lazy-loading
+    return {
+        key: (answerobj.id if answerobj is not None else None, value)
+        for key, (q, is_answered, answerobj, value) in current_answers.answertuples.items()
+        if is_answered
+    }
+
+def get_module_state_cache_key(current_answers):
+    # Only the states of saved Tasks are remembered.
+    if current_answers.task is None or current_answers.task.id is None:
+        return None
+    module = current_answers.module
+    return (current_answers.task.id, module.id, module.updated)
+
+def get_last_module_state(current_answers):
+    global _module_state_cache, _module_state_cache_lock
+    key = get_module_state_cache_key(current_answers)
+    if key is None or _module_state_cache is None:
+        return None
+    with _module_state_cache_lock:
+        last_state = _module_state_cache.get(key[0])
+        if last_state is None or last_state["key"] != key:
+            return None
+        _module_state_cache.move_to_end(key[0])
+        return last_state
+
+def save_last_module_state(current_answers, last_state, state):
+    global _module_state_cache, _module_state_cache_lock
+    key = get_module_state_cache_key(current_answers)
+    if key is None:
+        return
+    if last_state is None:
+        # Compute the things that don't change as long as the Module doesn't change.
+        dependencies, _ = get_all_question_dependencies(current_answers.module)
+        question_keys = { q.key for q in dependencies }
+        state["dependents"] = { q.key: set() for q in dependencies }
+        for q, deps in dependencies.items():
+            for qq in deps:
+                state["dependents"][qq.key].add(q.key)
+        state["volatile"] = { q.key for q, deps in dependencies.items()
+                              if is_question_state_volatile(q, deps, question_keys) }
+    else:
+        state["dependents"] = last_state["dependents"]
+        state["volatile"] = last_state["volatile"]
+    state["key"] = key
+
+    if _module_state_cache is None:
+        import threading
+        from collections import OrderedDict
+        _module_state_cache = OrderedDict()
+        _module_state_cache_lock = threading.Lock()
+    with _module_state_cache_lock:
+        _module_state_cache[key[0]] = state
+        _module_state_cache.move_to_end(key[0])
+        while len(_module_state_cache) > MODULE_STATE_CACHE_MAX_SIZE:
+            _module_state_cache.popitem(last=False)
+
+def clear_module_state_cache():
+    if _module_state_cache is not None:
+        with _module_state_cache_lock:
+            _module_state_cache.clear()
+
+
+# The evaluated answers of Tasks (task.get_answers().with_extended_info())
+# are also kept in the shared cache so that viewing a Task that hasn't changed
+# since it was last viewed doesn't need to load its answers or evaluate its
+# module state. An entry is keyed by the Task's 'updated' time, which changes
+# when its answers are saved (see Task.clear_state), and it remembers the
+# 'updated' times of the other Tasks that were read during the evaluation
+# (e.g. sub-tasks and the project root task) so that it isn't used if any of
+# them changed.
+EVALUATED_ANSWERS_CACHE_TIMEOUT = 60*60 # 1 hour
+
+def get_evaluated_answers_cache_key(task):
+    return "evaluated_answers_{}_{}_{}_{}".format(
+        task.id, task.updated.timestamp(),
+        task.module_id, task.module.updated.timestamp())
+
+def get_evaluated_answers(task):
+    # Return task.get_answers().with_extended_info(), from the cache if possible.
+    from django.core.cache import cache
+    from .models import Task
+    import pickle
+    cache_key = get_evaluated_answers_cache_key(task)
+
+    entry = cache.get(cache_key)
+    if entry is not None:
+        reads, answers = entry
+        if reads == dict(Task.objects.filter(id__in=reads).values_list("id", "updated")):
+            for read_set in getattr(_read_sets, "stack", []):
+                read_set.task_ids |= set(reads)
+            record_task_read(task)
+            answers = pickle.loads(answers)
+            answers.module = task.module
+            answers.task = task
+            return answers
+
+    from django.utils import timezone
+    evaluation_start = timezone.now()
+    with TaskReadSet() as read_set:
+        answers = task.get_answers().with_extended_info()
+    read_set.task_ids.discard(task.id)
+    for outer_read_set in getattr(_read_sets, "stack", []):
+        outer_read_set.task_ids |= read_set.task_ids
+
+    # Cache the answers along with the 'updated' times of the other Tasks
+    # that were read. Don't cache them if any of those Tasks changed while
+    # the answers were being evaluated, since the answers may not reflect
+    # the change.
+    reads = dict(Task.objects.filter(id__in=read_set.task_ids).values_list("id", "updated"))
+    if len(reads) == len(read_set.task_ids) and all(updated < evaluation_start for updated in reads.values()):
+        try:
+            cache.set(cache_key, (reads, pickle.dumps(answers)), EVALUATED_ANSWERS_CACHE_TIMEOUT)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            # Some answer value can't be cached.
+            pass
+
+    return answers
+
+def get_downstream_questions(dependents, keys):
+    # Returns the set of question keys that are in keys or transitively
+    # depend on a question in keys.
+    ret = set()
+    stack = list(keys)
+    while stack:
+        key = stack.pop()
+        if key in ret or key not in dependents:
+            continue
+        ret.add(key)
+        stack.extend(dependents[key])
+    return ret
+
+def is_question_state_volatile(question, deps, question_keys):
+    # Can the outcome of evaluating this question change even if the answers
+    # to the other questions in the module don't change? That's the case if
+    # it depends on a module-type question, since the answers of the sub-task
+    # might have changed, or if its impute conditions refer to anything other
+    # than the module's questions, like the project or organization.
+    if any(qq.spec["type"] in ("module", "module-set") for qq in deps):
+        return True
+    try:
+        for rule in question.spec.get("impute", []):
+            varnames = set()
+            if "condition" in rule:
+                varnames |= get_jinja2_template_vars(r"{% if (" + rule["condition"] + r") %}...{% endif %}")
+            if rule.get("value-mode") == "expression":
+                varnames |= get_jinja2_template_vars(r"{% if (" + rule["value"] + r") %}...{% endif %}")
+            if rule.get("value-mode") == "template":
+                varnames |= get_jinja2_template_vars(rule["value"])
+            if varnames - question_keys:
+                return True
+    except Exception:
+        # Invalid expressions are evaluated every time so that they
+        # fail the same way every time.
+        return True
+    return False
+
+
 def get_question_context(answers, question):
     # What is the context of questions around the given question so show
     # the user their progress through the questions?
@@ -296,98 +506,9 @@ def render_content(content, answers, output_format, source, additional_context={
             # Convert the template first to HTML using CommonMark.
 
             if not isinstance(template_body, str): raise ValueError("Template %s has incorrect type: %s" % (source, type(template_body)))
-            
-            # We don't want CommonMark to mess up template tags, however. If
-            # there are symbols which have meaning both to Jinaj2 and CommonMark,
-            # then they may get ruined by CommonMark because they may be escaped.
-            # For instance:
-            #
-            #    {% hello "*my friend*" %}
-            #
-            # would become
-            #
-            #    {% hello "<em>my friend</em>" %}
-            #
-            # and
-            #
-            #    [my link]({{variable_holding_url}})
-            #
-            # would become a link whose target is
-            #
-            #    %7B%7Bvariable_holding_url%7D%7D
-            #
-            # And that's not good!
-            #
-            # Do a simple lexical pass over the template and replace template
-            # tags with special codes that CommonMark will ignore. Then we'll
-            # put back the strings after the CommonMark has been rendered into
-            # HTML, so that the template tags end up in their appropriate place.
-            #
-            # Since CommonMark will clean up Unicode in URLs, e.g. in link and
-            # image URLs, by %-encoding non-URL-safe characters, we have to
-            # also override CommonMark's URL escaping function at
-            # https://github.com/rtfd/CommonMark-py/blob/master/CommonMark/common.py#L71
-            # to not %-encode our special codes. Unfortunately urllib.parse.quote's
-            # "safe" argument does not handle non-ASCII characters.
-            from CommonMark import inlines
-            def urlencode_special(uri):
-                import urllib.parse
-                return "".join(
-                    urllib.parse.quote(c, safe="/@:+?=&()%#*,") # this is what CommonMark does
-                    if c not in "\uE000\uE001" else c # but keep our special codes
-                    for c in uri)
-            inlines.normalize_uri = urlencode_special
-
-            substitutions = []
-            import re
-            def replace(m):
-                # Record the substitution.
-                index = len(substitutions)
-                substitutions.append(m.group(0))
-                return "\uE000%d\uE001" % index # use Unicode private use area code points
-            template_body = re.sub(r"{%[\w\W]*?%}|{{.*?}}", replace, template_body)
-
-            # Use our CommonMark Tables parser & renderer.
-            from CommonMarkExtensions.tables import \
-                ParserWithTables as CommonMarkParser, \
-                RendererWithTables as CommonMarkHtmlRenderer
 
-            # Subclass the renderer to control the output a bit.
-            class q_renderer(CommonMarkHtmlRenderer):
-                def __init__(self):
-                    # Our module templates are currently trusted, so we can keep
-                    # safe mode off, and we're making use of that. Safe mode is
-                    # off by default, but I'm making it explicit. If we ever
-                    # have untrusted template content, we will need to turn
-                    # safe mode on.
-                    super().__init__(options={ "safe": False })
-
-                def heading(self, node, entering):
-                    # Generate <h#> tags with one level down from
-                    # what would be normal since they should not
-                    # conflict with the page <h1>.
-                    if entering and demote_headings:
-                        node.level += 1
-                    super().heading(node, entering)
-
-                def code_block(self, node, entering):
-                    # Suppress info strings because with variable substitution
-                    # untrusted content could land in the <code> class attribute
-                    # without a language- prefix.
-                    node.info = None
-                    super().code_block(node, entering)
-
-                def make_table_node(self, node):
-                    return "<table class='table'>"
-
-            template_format = "html"
-            template_body = q_renderer().render(CommonMarkParser().parse(template_body))
-
-            # Put the Jinja2 template tags back that we removed prior to running
-            # the CommonMark renderer.
-            def replace(m):
-                return substitutions[int(m.group(1))]
-            template_body = re.sub("\uE000(\d+)\uE001", replace, template_body)
+            # The conversion itself happens in compile_content_template so
+            # that its result is cached along with the compiled template.
 
         elif output_format in ("text", "markdown"):
             # Pass through the markdown markup unchanged.
@@ -473,6 +594,17 @@ def render_content(content, answers, output_format, source, additional_context={
 
         import jinja2
 
+        # Get the compiled template and the set of variables it references,
+        # from the process-wide cache if this template was compiled before.
+        # Markdown templates being rendered to HTML come back as HTML templates.
+        template_format, template, template_vars = compile_content_template(
+            template_body, template_format, output_format, demote_headings, source)
+
+        # For tests, callers can use the "PARSE_ONLY" output format to
+        # stop after the template is compiled.
+        if output_format == "PARSE_ONLY":
+            return template
+
         if template_format in ("text", "markdown"):
             def escapefunc(question, task, has_answer, answerobj, value):
                 # Don't perform any escaping. The caller will wrap the
@@ -501,25 +633,6 @@ def render_content(content, answers, output_format, source, additional_context={
                     # being used. Auto-escaping will take care of escaping.
                     return "<{}>".format(message.format(**format_vars))
 
-        # Execute the template.
-
-        # Evaluate the template. Ensure autoescaping is turned on. Even though
-        # we handle it ourselves, we do so using the __html__ method on
-        # RenderedAnswer, which relies on autoescaping logic. This also lets
-        # the template writer disable autoescaping with "|safe".
-        env = Jinja2Environment(
-            autoescape=True,
-            undefined=jinja2.StrictUndefined) # see below - we defined any undefined variables
-        try:
-            template = env.from_string(template_body)
-        except jinja2.TemplateSyntaxError as e:
-            raise ValueError("There was an error loading the Jinja2 template %s: %s, line %d" % (source, str(e), e.lineno))
-
-        # For tests, callers can use the "PARSE_ONLY" output format to
-        # stop after the template is compiled.
-        if output_format == "PARSE_ONLY":
-            return template
-
         # Create an intial context dict with the additional_context provided
         # by the caller, add additional context variables and functions, and
         # add rendered answers into it.
@@ -548,7 +661,7 @@ def render_content(content, answers, output_format, source, additional_context={
             # template, and rendering the variable might mean no one will notice
             # the template is incorrect. But it's probably better UX than having
             # a big error message for the output as a whole or silently ignoring it.
-            for varname in get_jinja2_template_vars(template_body):
+            for varname in template_vars:
                 context.setdefault(varname, UndefinedReference(varname, errorfunc, [source]))
 
             # Now really render.
@@ -632,6 +745,186 @@ def render_content(content, answers, output_format, source, additional_context={
         raise ValueError("Invalid template format encountered: %s." % template_format)
 
 
+# A process-wide cache of compiled templates. Compiling a template (converting
+# Markdown to HTML, parsing and compiling the Jinja2 template, and finding the
+# variables it references) is much more expensive than rendering it, and the
+# same templates (from Module specs) are rendered over and over again. The
+# cache is a bounded LRU keyed by a hash of everything that affects the
+# compiled result. Compiled Jinja2 templates are not tied to a context and
+# are safe to share across threads.
+TEMPLATE_CACHE_MAX_SIZE = 1024
+import threading
+from collections import OrderedDict
+_template_cache = OrderedDict()
+_template_cache_lock = threading.Lock()
+_template_cache_stats = { "hits": 0, "misses": 0 }
+
+def get_template_cache_stats():
+    # Returns hit/miss counters and the current size of the compiled template cache.
+    with _template_cache_lock:
+        return {
+            "hits": _template_cache_stats["hits"],
+            "misses": _template_cache_stats["misses"],
+            "size": len(_template_cache),
+            "max_size": TEMPLATE_CACHE_MAX_SIZE,
+        }
+
+def clear_template_cache():
+    with _template_cache_lock:
+        _template_cache.clear()
+        _template_cache_stats["hits"] = 0
+        _template_cache_stats["misses"] = 0
+
+_template_environment = None
+def get_template_environment():
+    # Evaluate templates with a single, shared environment. Ensure autoescaping
+    # is turned on. Even though we handle it ourselves, we do so using the
+    # __html__ method on RenderedAnswer, which relies on autoescaping logic.
+    # This also lets the template writer disable autoescaping with "|safe".
+    # Undefined variables are defined by render_content, see there.
+    global _template_environment
+    if _template_environment is None:
+        import jinja2
+        _template_environment = Jinja2Environment(
+            autoescape=True,
+            undefined=jinja2.StrictUndefined)
+    return _template_environment
+
+def compile_content_template(template_body, template_format, output_format, demote_headings, source):
+    # Returns a tuple of (template_format, compiled Jinja2 template, set of
+    # undeclared variable names), where template_format is "html" if a
+    # Markdown template was converted to HTML.
+    import hashlib
+    key = hashlib.sha1(repr((template_body, template_format, output_format, bool(demote_headings))).encode("utf8")).hexdigest()
+    with _template_cache_lock:
+        if key in _template_cache:
+            _template_cache.move_to_end(key)
+            _template_cache_stats["hits"] += 1
+            return _template_cache[key]
+        _template_cache_stats["misses"] += 1
+
+    # Compile outside of the lock. If another thread compiles the same
+    # template at the same time, one result will just replace the other.
+    if template_format == "markdown" and output_format in ("html", "PARSE_ONLY"):
+        template_format = "html"
+        template_body = markdown_template_to_html(template_body, demote_headings)
+
+    import jinja2
+    from jinja2 import meta
+    env = get_template_environment()
+    try:
+        # Parse only once. The undeclared variables must be read off the
+        # AST before it is compiled since compilation may modify it.
+        ast = env.parse(template_body)
+        template_vars = set(meta.find_undeclared_variables(ast))
+        template = env.from_string(ast)
+    except jinja2.TemplateSyntaxError as e:
+        raise ValueError("There was an error loading the Jinja2 template %s: %s, line %d" % (source, str(e), e.lineno))
+
+    value = (template_format, template, template_vars)
+    with _template_cache_lock:
+        _template_cache[key] = value
+        while len(_template_cache) > TEMPLATE_CACHE_MAX_SIZE:
+            _template_cache.popitem(last=False)
+    return value
+
+def markdown_template_to_html(template_body, demote_headings):
+    # Converts a Markdown template to an HTML template using CommonMark,
+    # preserving the Jinja2 template tags in it.
+    #
+    # We don't want CommonMark to mess up template tags, however. If
+    # there are symbols which have meaning both to Jinaj2 and CommonMark,
+    # then they may get ruined by CommonMark because they may be escaped.
+    # For instance:
+    #
+    #    {% hello "*my friend*" %}
+    #
+    # would become
+    #
+    #    {% hello "<em>my friend</em>" %}
+    #
+    # and
+    #
+    #    [my link]({{variable_holding_url}})
+    #
+    # would become a link whose target is
+    #
+    #    %7B%7Bvariable_holding_url%7D%7D
+    #
+    # And that's not good!
+    #
+    # Do a simple lexical pass over the template and replace template
+    # tags with special codes that CommonMark will ignore. Then we'll
+    # put back the strings after the CommonMark has been rendered into
+    # HTML, so that the template tags end up in their appropriate place.
+    #
+    # Since CommonMark will clean up Unicode in URLs, e.g. in link and
+    # image URLs, by %-encoding non-URL-safe characters, we have to
+    # also override CommonMark's URL escaping function at
+    # https://github.com/rtfd/CommonMark-py/blob/master/CommonMark/common.py#L71
+    # to not %-encode our special codes. Unfortunately urllib.parse.quote's
+    # "safe" argument does not handle non-ASCII characters.
+    from CommonMark import inlines
+    def urlencode_special(uri):
+        import urllib.parse
+        return "".join(
+            urllib.parse.quote(c, safe="/@:+?=&()%#*,") # this is what CommonMark does
+            if c not in "\uE000\uE001" else c # but keep our special codes
+            for c in uri)
+    inlines.normalize_uri = urlencode_special
+
+    substitutions = []
+    import re
+    def replace(m):
+        # Record the substitution.
+        index = len(substitutions)
+        substitutions.append(m.group(0))
+        return "\uE000%d\uE001" % index # use Unicode private use area code points
+    template_body = re.sub(r"{%[\w\W]*?%}|{{.*?}}", replace, template_body)
+
+    # Use our CommonMark Tables parser & renderer.
+    from CommonMarkExtensions.tables import \
+        ParserWithTables as CommonMarkParser, \
+        RendererWithTables as CommonMarkHtmlRenderer
+
+    # Subclass the renderer to control the output a bit.
+    class q_renderer(CommonMarkHtmlRenderer):
+        def __init__(self):
+            # Our module templates are currently trusted, so we can keep
+            # safe mode off, and we're making use of that. Safe mode is
+            # off by default, but I'm making it explicit. If we ever
+            # have untrusted template content, we will need to turn
+            # safe mode on.
+            super().__init__(options={ "safe": False })
+
+        def heading(self, node, entering):
+            # Generate <h#> tags with one level down from
+            # what would be normal since they should not
+            # conflict with the page <h1>.
+            if entering and demote_headings:
+                node.level += 1
+            super().heading(node, entering)
+
+        def code_block(self, node, entering):
+            # Suppress info strings because with variable substitution
+            # untrusted content could land in the <code> class attribute
+            # without a language- prefix.
+            node.info = None
+            super().code_block(node, entering)
+
+        def make_table_node(self, node):
+            return "<table class='table'>"
+
+    template_body = q_renderer().render(CommonMarkParser().parse(template_body))
+
+    # Put the Jinja2 template tags back that we removed prior to running
+    # the CommonMark renderer.
+    def replace(m):
+        return substitutions[int(m.group(1))]
+    template_body = re.sub("\uE000(\d+)\uE001", replace, template_body)
+    return template_body
+
+
 class HtmlAnswerRenderer:
     def __init__(self, show_metadata, use_data_urls=False):
         self.show_metadata = show_metadata
@@ -750,44 +1043,150 @@ class HtmlAnswerRenderer:
         )
 
 
-def clear_module_question_cache():
-    if hasattr(get_all_question_dependencies, 'cache'):
-        del get_all_question_dependencies.cache
-
-
-def get_all_question_dependencies(module):
-    # Initialize cache, query cache.
-    if not hasattr(get_all_question_dependencies, 'cache'):
-        get_all_question_dependencies.cache = { }
-    if module.id in get_all_question_dependencies.cache:
-        return get_all_question_dependencies.cache[module.id]
+def build_question_dependency_graph(module):
+    # Computes the dependency graph between the questions of a Module and the
+    # order in which walk_module_questions walks them. This is stored in the
+    # Module's question_dependencies field when the Module is loaded (see
+    # Module.update_question_dependencies) so that it doesn't need to be
+    # computed again each time it's needed. The graph is stored by question
+    # key, with a version hash of the question specifications it was computed
+    # from.
+    from collections import OrderedDict
 
     # Pre-load all of the questions by their key so that the dependency
     # evaluation is fast.
-    all_questions = { }
-    for q in module.questions.all():
-        all_questions[q.key] = q
+    questions = list(module.questions.order_by("definition_order"))
+    all_questions = OrderedDict((q.key, q) for q in questions)
+
+    # Compute all of the dependencies of all of the questions, listing each
+    # question's dependencies in module definition order.
+    dependencies = OrderedDict()
+    for q in questions:
+        deps = get_question_dependencies_with_skippable_flag(q, get_from_question_id=all_questions)
+        dependencies[q.key] = OrderedDict(
+            (qq.key, skippable)
+            for qq, skippable in sorted(deps.items(), key = lambda kv : kv[0].definition_order))
+
+    # Find the questions that are at the root of the dependency tree,
+    # which is where the dependency chains start.
+    is_dependency_of_something = set()
+    for deps in dependencies.values():
+        is_dependency_of_something |= set(deps.keys())
+    root_questions = [q.key for q in questions if q.key not in is_dependency_of_something]
+
+    # Compute the walk order: a depth-first post-order walk of the dependency
+    # tree starting at the root questions in document order. A cyclical
+    # dependency is reported when the module is walked, not here, since until
+    # now it has not been an error to load a module with one.
+    walk_order = []
+    visited = set()
+    def walk_question(key, stack):
+        # If we've seen this question already as a dependency of another
+        # question, then there's nothing to do.
+        if key in visited:
+            return
+
+        # Prevent infinite recursion.
+        if key in stack:
+            raise ValueError("Cyclical dependency in questions: " + "->".join(stack + [key]))
+
+        for dep in dependencies[key]:
+            walk_question(dep, stack+[key])
+        visited.add(key)
+        walk_order.append(key)
+    try:
+        for key in root_questions:
+            walk_question(key, [])
+        error = None
+    except ValueError as e:
+        walk_order = None
+        error = str(e)
+
+    return OrderedDict([
+        ("version", get_question_specs_version(questions)),
+        ("dependencies", dependencies),
+        ("walk_order", walk_order),
+        ("error", error),
+    ])
+
+
+def get_question_specs_version(questions):
+    # Compute a version hash over everything a question dependency graph
+    # is computed from, given the questions in definition order.
+    import hashlib, json
+    return hashlib.sha1(json.dumps(
+        [[q.key, q.definition_order, q.spec] for q in questions],
+        sort_keys=True).encode("utf8")).hexdigest()
+
+
+# An in-process cache of the dependency graphs stored in Module.question_dependencies,
+# resolved to ModuleQuestion instances. It is keyed by the version hash of the graph,
+# so when a Module's questions change and its graph is re-computed, every process
+# sees the new graph the next time it loads the Module.
+QUESTION_DEPENDENCY_GRAPH_CACHE_MAX_SIZE = 512
+_question_dependency_graph_cache = None
+_question_dependency_graph_cache_lock = None
+
+def get_question_dependency_graph(module):
+    global _question_dependency_graph_cache, _question_dependency_graph_cache_lock
+    if _question_dependency_graph_cache is None:
+        import threading
+        from collections import OrderedDict
+        _question_dependency_graph_cache = OrderedDict()
+        _question_dependency_graph_cache_lock = threading.Lock()
+
+    graph = module.question_dependencies
+    if graph:
+        key = (module.id, graph["version"])
+        with _question_dependency_graph_cache_lock:
+            if key in _question_dependency_graph_cache:
+                _question_dependency_graph_cache.move_to_end(key)
+                return _question_dependency_graph_cache[key]
+
+    # Resolve the question keys in the stored graph to ModuleQuestion instances.
+    # If the Module predates storing the graph, or if the stored graph wasn't
+    # computed from the current question specifications, (re-)compute it and
+    # store it. Update it with a query so that Module.updated isn't bumped.
+    questions = list(module.questions.order_by("definition_order"))
+    if not graph or graph["version"] != get_question_specs_version(questions):
+        from .models import Module
+        graph = build_question_dependency_graph(module)
+        module.question_dependencies = graph
+        Module.objects.filter(id=module.id).update(question_dependencies=graph)
+    questions = { q.key: q for q in questions }
 
-    # Compute all of the dependencies of all of the questions.
     dependencies = {
-        q: get_question_dependencies_with_skippable_flag(q, get_from_question_id=all_questions)
-        for q in all_questions.values()
+        questions[key]: { questions[dep]: skippable for dep, skippable in deps.items() }
+        for key, deps in graph["dependencies"].items()
     }
-
-    # Find the questions that are at the root of the dependency tree.
     is_dependency_of_something = set()
     for deps in dependencies.values():
         is_dependency_of_something |= set(deps.keys())
-    root_questions = { q for q in dependencies if q not in is_dependency_of_something }
-
-    ret = (dependencies, root_questions)
-
-    # Save to in-memory (in-process) cache. Never in debugging.
-    if not settings.DEBUG:
-        get_all_question_dependencies.cache[module.id] = ret
+    ret = {
+        "dependencies": dependencies,
+        "sorted_dependencies": {
+            questions[key]: [questions[dep] for dep in deps]
+            for key, deps in graph["dependencies"].items()
+        },
+        "root_questions": { q for q in dependencies if q not in is_dependency_of_something },
+        "walk_order": [questions[key] for key in (graph["walk_order"] or [])],
+        "error": graph["error"],
+    }
 
+    key = (module.id, graph["version"])
+    with _question_dependency_graph_cache_lock:
+        _question_dependency_graph_cache[key] = ret
+        while len(_question_dependency_graph_cache) > QUESTION_DEPENDENCY_GRAPH_CACHE_MAX_SIZE:
+            _question_dependency_graph_cache.popitem(last=False)
     return ret
 
+def get_all_question_dependencies(module):
+    # Returns a tuple of a dict mapping each ModuleQuestion in the module to a
+    # dict of the ModuleQuestions it depends on (mapped to whether the dependency
+    # is skippable), and a set of the ModuleQuestions that no question depends on.
+    graph = get_question_dependency_graph(module)
+    return (graph["dependencies"], graph["root_questions"])
+
 def get_question_dependencies(question, get_from_question_id=None):
     return set(edge[1] for edge in get_question_dependencies_with_type(question, get_from_question_id))
 
@@ -852,12 +1251,29 @@ def run_impute_conditions(conditions, context):
     # the imputed value. Be careful about values like 0 that
     # are false-y --- must check for "is None" to know if
     # something was imputed or not.
-    env = Jinja2Environment()
+    #
+    # conditions is either the list of impute rules from a question
+    # specification or a list of CompiledImputeRules returned by
+    # compile_impute_rules, which avoids re-compiling the rules'
+    # expressions and templates on every call.
+    context_keys = None
+    def get_variables(varnames):
+        # Jinja2 copies every item of the context when an expression or
+        # template is executed, which means wrapping every answer in the
+        # context. Only pass the variables the expression or template uses.
+        nonlocal context_keys
+        if context_keys is None:
+            context_keys = set(context)
+        return { name: context[name] for name in varnames if name in context_keys }
+
     for rule in conditions:
-        if "condition" in rule:
-            condition_func = env.compile_expression(rule["condition"])
+        if not isinstance(rule, CompiledImputeRule):
+            rule = CompiledImputeRule(rule)
+
+        if rule.has_condition:
+            condition_func, varnames = rule.get_condition()
             try:
-                value = condition_func(context)
+                value = condition_func(get_variables(varnames))
             except:
                 value = None
         else:
@@ -865,11 +1281,12 @@ def run_impute_conditions(conditions, context):
 
         if value:
             # The condition is met. Compute the imputed value.
-            if rule.get("value-mode", "raw") == "raw":
+            if rule.value_mode == "raw":
                 # Imputed value is the raw YAML value.
-                value = rule["value"]
-            elif rule.get("value-mode", "raw") == "expression":
-                value = env.compile_expression(rule["value"])(context)
+                value = rule.rule["value"]
+            elif rule.value_mode == "expression":
+                value_func, varnames = rule.get_value()
+                value = value_func(get_variables(varnames))
                 if isinstance(value, RenderedAnswer):
                     # Unwrap.
                     value =  value.answer
@@ -880,13 +1297,9 @@ def run_impute_conditions(conditions, context):
                 elif hasattr(value, "as_raw_value"):
                     # RenderedProject, RenderedOrganization
                     value = value.as_raw_value()
-            elif rule.get("value-mode", "raw") == "template":
-                env = Jinja2Environment(autoescape=True)
-                try:
-                    template = env.from_string(rule["value"])
-                except jinja2.TemplateSyntaxError as e:
-                    raise ValueError("There was an error loading the template %s: %s" % (rule["value"], str(e)))
-                value = template.render(context)
+            elif rule.value_mode == "template":
+                template, varnames = rule.get_value()
+                value = template.render(get_variables(varnames))
             else:
                 raise ValueError("Invalid impute condition value-mode.")
 
@@ -897,12 +1310,225 @@ def run_impute_conditions(conditions, context):
     return None
 
 
+# Impute conditions are evaluated very frequently --- once per question every
+# time the state of a module is evaluated --- so the Jinja2 expressions and
+# templates in them are compiled once and reused. The environments are shared
+# because compiled expressions and templates don't depend on anything but
+# the environment's settings.
+_impute_environments = { }
+def get_impute_environment(autoescape):
+    if autoescape not in _impute_environments:
+        _impute_environments[autoescape] = Jinja2Environment(autoescape=autoescape)
+    return _impute_environments[autoescape]
+
+class CompiledImputeRule:
+    # Wraps an impute rule from a question specification. The condition
+    # expression and the value expression or template are compiled the first
+    # time they are needed (so that an invalid value is only an error if the
+    # rule's condition is met, as it would be if it were not compiled ahead
+    # of time) and then remembered along with the names of the context
+    # variables they use.
+
+    def __init__(self, rule):
+        self.rule = rule
+        self.has_condition = "condition" in rule
+        self.value_mode = rule.get("value-mode", "raw")
+        self._condition = None
+        self._value = None
+
+    def get_condition(self):
+        if self._condition is None:
+            self._condition = compile_impute_expression(self.rule["condition"])
+        return self._condition
+
+    def get_value(self):
+        if self._value is None:
+            if self.value_mode == "expression":
+                self._value = compile_impute_expression(self.rule["value"])
+            elif self.value_mode == "template":
+                import jinja2
+                from jinja2 import meta
+                env = get_impute_environment(True)
+                try:
+                    template = env.from_string(self.rule["value"])
+                    varnames = meta.find_undeclared_variables(env.parse(self.rule["value"]))
+                except jinja2.TemplateSyntaxError as e:
+                    raise ValueError("There was an error loading the template %s: %s" % (self.rule["value"], str(e)))
+                self._value = (template, varnames)
+        return self._value
+
+def compile_impute_expression(expression):
+    # Compile the expression and find the undeclared variables it references.
+    # compile_expression doesn't expose its parsed AST so the expression is
+    # parsed a second time, the same way compile_expression parses it.
+    from jinja2 import meta, nodes
+    from jinja2.parser import Parser
+    env = get_impute_environment(False)
+    func = env.compile_expression(expression)
+    expr = Parser(env, expression, state='variable').parse_expression()
+    varnames = meta.find_undeclared_variables(nodes.Template([nodes.Output([expr])], lineno=1).set_environment(env))
+    return (func, varnames)
+
+def compile_impute_rules(conditions):
+    return [CompiledImputeRule(rule) for rule in conditions]
+
+# The tables of compiled impute rules are kept in a bounded, in-process LRU
+# cache keyed by Module ID.
+IMPUTE_RULES_CACHE_MAX_SIZE = 256
+_impute_rules_cache = OrderedDict()
+_impute_rules_cache_lock = threading.Lock()
+
+def get_module_impute_rules(module):
+    # Returns a dict mapping ModuleQuestion ids to lists of CompiledImputeRules
+    # for the questions of a Module. The table is built once per Module and is
+    # rebuilt if the Module is updated. Since questions can be edited without
+    # updating the Module (e.g. by the authoring tool), each question's rules
+    # are also checked against the question's current specification when they
+    # are fetched with get_question_impute_rules.
+    key = (module.id, module.updated)
+    with _impute_rules_cache_lock:
+        entry = _impute_rules_cache.get(module.id)
+        if entry is None or entry[0] != key:
+            entry = (key, { })
+            _impute_rules_cache[module.id] = entry
+        _impute_rules_cache.move_to_end(module.id)
+        while len(_impute_rules_cache) > IMPUTE_RULES_CACHE_MAX_SIZE:
+            _impute_rules_cache.popitem(last=False)
+        return entry[1]
+
+def clear_impute_rules_cache():
+    with _impute_rules_cache_lock:
+        _impute_rules_cache.clear()
+
+def get_question_impute_rules(question, module_rules):
+    conditions = question.spec.get("impute", [])
+    entry = module_rules.get(question.id)
+    if entry is None or entry[0] != conditions:
+        entry = (conditions, compile_impute_rules(conditions))
+        module_rules[question.id] = entry
+    return entry[1]
+
+
 def get_question_choice(question, key):
     for choice in question.spec["choices"]:
         if choice["key"] == key:
             return choice
     raise KeyError(repr(key) + " is not a choice")
 
+# Read sets. When state that is derived from answers is cached (see
+# Task._get_cached_state), the Tasks whose answers (or cached state) were
+# read while computing it are recorded so that when a Task's answers change,
+# only the cached state that actually read that Task needs to be cleared.
+# ModuleAnswers and TemplateContext record reads into every read set that is
+# being collected at the time, since nested computations are also read by
+# the computations they are nested in.
+import threading
+_read_sets = threading.local()
+
+class TaskReadSet:
+    # A context manager that collects the ids of the Tasks read in its block.
+    def __init__(self):
+        self.task_ids = set()
+    def __enter__(self):
+        if not hasattr(_read_sets, "stack"):
+            _read_sets.stack = []
+        _read_sets.stack.append(self)
+        return self
+    def __exit__(self, *exc_info):
+        _read_sets.stack.remove(self)
+
+def record_task_read(task, cached_reads=None):
+    # Record that task was read by whatever is being computed. When the
+    # read is served from one of task's cache entries, cached_reads is the
+    # read set of that entry, which is recorded too so that the Tasks it
+    # was computed from are still known after the cache hit.
+    if task.id is None:
+        return
+    for read_set in getattr(_read_sets, "stack", []):
+        read_set.task_ids.add(task.id)
+        read_set.task_ids.update(cached_reads or [])
+
+# Answer snapshots. Rendering a page reads the answers of the same Tasks many
+# times, e.g. through the ModuleAnswers of module-type answers, which load
+# their Task's answers lazily. While an AnswerSnapshot is active (during each
+# request, see guidedmodules.middleware.AnswerSnapshotMiddleware), the first
+# time the answers of a Task are read the current answers of every Task in its
+# Project are loaded at once, and later reads are served from the snapshot.
+# Snapshots are cleared when any answer is saved (see Task.on_answer_changed).
+_answer_snapshots = threading.local()
+
+class AnswerSnapshot:
+    # A context manager that serves Task answers from a snapshot in its block.
+    def __init__(self):
+        self.answertuples = { } # Task ID => answer tuples
+        self.project_ids = set() # Projects whose Tasks have been loaded
+    def __enter__(self):
+        if not hasattr(_answer_snapshots, "stack"):
+            _answer_snapshots.stack = []
+        _answer_snapshots.stack.append(self)
+        return self
+    def __exit__(self, *exc_info):
+        _answer_snapshots.stack.remove(self)
+
+    def get_answertuples(self, task):
+        from .models import Task
+        if task.id not in self.answertuples and task.project_id not in self.project_ids:
+            # Load the answers of all of the Tasks in the Project in one go.
+            self.project_ids.add(task.project_id)
+            self.answertuples.update(Task.get_all_answertuples(
+                Task.objects.filter(project_id=task.project_id).select_related("module")))
+        if task.id not in self.answertuples:
+            # The Task was created after its Project was loaded.
+            self.answertuples.update(Task.get_all_answertuples([task]))
+        return self.answertuples[task.id]
+
+    def clear(self):
+        self.answertuples.clear()
+        self.project_ids.clear()
+
+def get_answer_snapshot():
+    stack = getattr(_answer_snapshots, "stack", [])
+    return stack[-1] if stack else None
+
+def clear_answer_snapshots():
+    for snapshot in getattr(_answer_snapshots, "stack", []):
+        snapshot.clear()
+
+# Deferred rollup updates. Saving an answer brings the rollups of its Task and
+# of the Tasks above it up to date (see Task.on_answer_changed). When many
+# answers are saved at once, e.g. in an import or an API call, while a
+# DeferredRollups is active (during each request, see
+# guidedmodules.middleware.DeferredRollupsMiddleware) the Tasks are collected
+# and updated once at the end of the block instead of once per answer. If the
+# block raises an exception the update is skipped --- the rollups were already
+# cleared and are computed again when they are next read.
+_deferred_rollups = threading.local()
+
+class DeferredRollups:
+    # A context manager that defers rollup updates to the end of its block.
+    def __init__(self):
+        self.task_ids = set()
+    def __enter__(self):
+        if not hasattr(_deferred_rollups, "stack"):
+            _deferred_rollups.stack = []
+        _deferred_rollups.stack.append(self)
+        return self
+    def __exit__(self, exc_type, *exc_info):
+        _deferred_rollups.stack.remove(self)
+        if exc_type is None and self.task_ids:
+            update_rollups(self.task_ids)
+
+def update_rollups(task_ids):
+    # Update the rollups of the Tasks now, or at the end of the innermost
+    # active DeferredRollups block.
+    stack = getattr(_deferred_rollups, "stack", [])
+    if stack:
+        stack[-1].task_ids |= set(task_ids)
+        return
+    from .models import Task
+    Task.update_rollups(task_ids)
+
+
 class ModuleAnswers(object):
     """Represents a set of answers to a Task."""
 
@@ -925,6 +1551,9 @@ class ModuleAnswers(object):
                 self.answertuples = self.task.get_answers().answertuples
         if self.answers_dict is None:
             self.answers_dict = { q.key: value for q, is_ans, ansobj, value in self.answertuples.values() if is_ans }
+        if self.task is not None:
+            # Anything computed from these answers depends on the Task.
+            record_task_read(self.task)
         return self.answers_dict
 
     def with_extended_info(self, parent_context=None):
@@ -1018,11 +1647,6 @@ class ModuleAnswers(object):
                         doc_name = "'%s' output document '%s'" % (self.module_answers.module.module_name, doc_name)
 
                         # Try to render it.
-                        task_cache_key = "output_r1_{}_{}_{}".format(
-                            self.index,
-                            key,
-                            1 if use_data_urls else 0,
-                        )
                         def do_render():
                             try:
                                 return render_content(self.document, self.module_answers, key, doc_name, show_answer_metadata=True, use_data_urls=use_data_urls)
@@ -1034,7 +1658,8 @@ class ModuleAnswers(object):
                                     import html
                                     ret = "<p class=text-danger>" + html.escape(ret) + "</p>"
                                 return ret
-                        self.rendered_content[key] = self.module_answers.task._get_cached_state(task_cache_key, do_render)
+                        self.rendered_content[key] = self.module_answers.task._get_cached_output(
+                            self.index, key, "data-urls" if use_data_urls else "", do_render)
 
                     return self.rendered_content[key]
 
@@ -1095,6 +1720,9 @@ class TemplateContext(Mapping):
         return self._cache[item]
 
     def _execute_lazy_module_answers(self):
+        # This is called on every item lookup, so only do it once.
+        if hasattr(self, "_module_questions"):
+            return
         if self.module_answers is None:
             # This is a TemplateContext for an unanswered question with an unknown
             # module type. We treat this as if it were a Task that had no questions but
@@ -1140,6 +1768,7 @@ class TemplateContext(Mapping):
                 # recursion. Figuring out if a module is finished
                 # requires imputing all question answers, which calls
                 # into templates, and we can end up back here.
+                record_task_read(self.module_answers.task)
                 return getattr(self.module_answers.task, item)
         else:
             # If there is no Task associated with this context, then we're
@@ -1250,6 +1879,8 @@ class RenderedProject(TemplateContext):
             # When we're computing the title for "instance-name", prevent
             # infinite recursion.
             return self.project.root_task.module.spec['title']
+        if self.project.root_task:
+            record_task_read(self.project.root_task)
         return self.project.title
     def __html__(self):
         return self.escapefunc(None, None, None, None, self.as_raw_value())
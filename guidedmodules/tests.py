@@ -233,6 +233,534 @@ class ImputeConditionTests(TestCaseWithFixtureData):
         self.assertEqual(answers.get("im_templ_1"), '1')
         self.assertEqual(answers.get("im_templ_2"), '2')
 
+        # The compiled impute conditions are reused on the next evaluation.
+        rules = get_module_impute_rules(m)
+        compiled = { qid: entry[1] for qid, entry in rules.items() }
+        self.assertEqual(len(compiled), m.questions.count())
+        ModuleAnswers(m, None, { }).with_extended_info()
+        for qid, entry in get_module_impute_rules(m).items():
+            self.assertIs(entry[1], compiled[qid])
+
+        # The cache of compiled impute conditions is bounded.
+        from unittest import mock
+        import guidedmodules.module_logic
+        with mock.patch("guidedmodules.module_logic.IMPUTE_RULES_CACHE_MAX_SIZE", 1):
+            get_module_impute_rules(self.getModule("simple"))
+            self.assertEqual(list(guidedmodules.module_logic._impute_rules_cache), [self.getModule("simple").id])
+
+    def test_benchmark_impute_rules(self):
+        import io
+        from django.core.management import call_command
+        out = io.StringIO()
+        call_command("benchmark_impute_rules", questions=20, iterations=2, stdout=out)
+        self.assertIn("20 questions, 2 iterations", out.getvalue())
+        self.assertIn("speedup:", out.getvalue())
+
+
+class ModuleStateTests(TestCaseWithFixtureData):
+    # Tests the evaluation of module state and the caches of
+    # answers and evaluated answers.
+
+    def test_question_dependency_graph(self):
+        # The dependency graph between questions is stored with the Module
+        # when it is loaded.
+        m = self.getModule("impute_conditions")
+        graph = m.question_dependencies
+        self.assertEqual(graph["dependencies"]["im_templ_2"], { "im_expr_1": True })
+        self.assertEqual(graph["walk_order"], ["_introduction", "im_templ_1", "im_expr_1", "im_templ_2"])
+        self.assertIsNone(graph["error"])
+
+        # It's re-computed when the Module's questions change.
+        q = m.questions.get(key="im_templ_1")
+        q.spec["impute"][0] = { "value": "{{im_templ_2}}", "value-mode": "template" }
+        q.save()
+        m = Module.objects.get(id=m.id)
+        self.assertIsNone(m.question_dependencies)
+        dependencies, root_questions = get_all_question_dependencies(m)
+        self.assertEqual({ q.key for q in root_questions }, { "_introduction", "im_templ_1" })
+        self.assertNotEqual(m.question_dependencies["version"], graph["version"])
+        self.assertEqual(m.question_dependencies["walk_order"], ["_introduction", "im_expr_1", "im_templ_2", "im_templ_1"])
+
+        # A stored graph that doesn't match the question specifications is
+        # also re-computed when it is loaded.
+        import guidedmodules.module_logic
+        guidedmodules.module_logic._question_dependency_graph_cache.clear()
+        Module.objects.filter(id=m.id).update(question_dependencies=graph)
+        m = Module.objects.get(id=m.id)
+        dependencies, root_questions = get_all_question_dependencies(m)
+        self.assertEqual({ q.key for q in root_questions }, { "_introduction", "im_templ_1" })
+
+    def test_incremental_module_state(self):
+        # After an answer changes, evaluating the state of a Task only
+        # re-evaluates the questions that depend on the changed answer,
+        # and the result is the same as a full evaluation.
+        m = self.getModule("question_types_text")
+        task = Task.objects.create(module=m, editor=self.user, project=self.project)
+        ta = TaskAnswer.objects.create(task=task, question=m.questions.get(key="q_text"))
+        ta.save_answer("Hello", [], None, self.user, "web")
+        task.get_answers().with_extended_info()
+
+        # Saving the answer also evaluates the module state to update the
+        # Task's rollups, so count the impute conditions run by both.
+        from unittest import mock
+        import guidedmodules.module_logic
+        with mock.patch("guidedmodules.module_logic.run_impute_conditions",
+                        wraps=guidedmodules.module_logic.run_impute_conditions) as f:
+            ta.save_answer("Goodbye", [], None, self.user, "web")
+            answers = task.get_answers().with_extended_info()
+        self.assertEqual(f.call_count, 1)
+        self.assertEqual(answers.as_dict()["q_text"], "Goodbye")
+
+        clear_module_state_cache()
+        full_answers = task.get_answers().with_extended_info()
+        self.assertEqual(list(answers.answertuples.items()), list(full_answers.answertuples.items()))
+        self.assertEqual(answers.can_answer, full_answers.can_answer)
+        self.assertEqual(answers.unanswered, full_answers.unanswered)
+        self.assertEqual(answers.was_imputed, full_answers.was_imputed)
+
+    def test_answer_snapshot(self):
+        # Within an AnswerSnapshot, the answers of all of the Tasks in a
+        # Project are loaded at once, so the number of queries to read the
+        # answers of Tasks and their sub-tasks doesn't depend on how many
+        # there are.
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        from .module_logic import AnswerSnapshot
+        def add_task():
+            task = Task.objects.create(module=self.getModule("question_types_module"), editor=self.user, project=self.project)
+            subtask = task.get_or_create_subtask(self.user, "q_module")
+            ta = TaskAnswer.objects.create(task=subtask, question=subtask.module.questions.get(key="q1"))
+            ta.save_answer(str(task.id), [], None, self.user, "web")
+            return ta
+        def read_answers():
+            with AnswerSnapshot(), CaptureQueriesContext(connection) as queries:
+                answers = [
+                    task.get_answers().as_dict()["q_module"].as_dict()["q1"]
+                    for task in Task.objects.filter(project=self.project, module__module_name="question_types_module").select_related("module")
+                ]
+            return answers, len(queries)
+
+        add_task()
+        answers1, num_queries = read_answers()
+        tasks = [add_task() for i in range(3)]
+        answers2, num_queries2 = read_answers()
+        self.assertEqual(len(answers2), 4)
+        self.assertEqual(answers1[0], answers2[0])
+        self.assertEqual(num_queries, num_queries2)
+
+        # Saving an answer clears the snapshot.
+        with AnswerSnapshot():
+            subtask = tasks[0].task
+            self.assertNotEqual(subtask.get_answers().as_dict()["q1"], "changed")
+            tasks[0].save_answer("changed", [], None, self.user, "web")
+            self.assertEqual(subtask.get_answers().as_dict()["q1"], "changed")
+
+    def test_evaluated_answers_cache(self):
+        # Evaluated answers are cached until the Task or a Task that was
+        # read while evaluating them changes.
+        from unittest import mock
+        from django.core.cache import cache
+        from .module_logic import get_evaluated_answers
+        cache.clear()
+        task = Task.objects.create(module=self.getModule("question_types_module"), editor=self.user, project=self.project)
+        subtask = task.get_or_create_subtask(self.user, "q_module")
+        ta = TaskAnswer.objects.create(task=subtask, question=subtask.module.questions.get(key="q1"))
+        ta.save_answer("first", [], None, self.user, "web")
+
+        def get():
+            # Load the Task the way a view does.
+            return get_evaluated_answers(Task.objects.get(id=task.id))
+        answers = get()
+        self.assertEqual(answers.as_dict()["q_module"].as_dict()["q1"], "first")
+        with mock.patch("guidedmodules.module_logic.evaluate_module_state") as evaluate:
+            answers = get()
+            self.assertFalse(evaluate.called)
+        self.assertEqual(answers.task.id, task.id)
+        self.assertEqual([q.key for q in answers.can_answer], [q.key for q in task.get_answers().with_extended_info().can_answer])
+
+        # Changing the sub-task's answer invalidates the parent's answers.
+        ta.save_answer("second", [], None, self.user, "web")
+        self.assertEqual(get().as_dict()["q_module"].as_dict()["q1"], "second")
+
+
+class TaskStateTests(TestCaseWithFixtureData):
+    # Tests the cached state, rollups, and rendered output documents
+    # of Tasks and how they are cleared when answers change.
+
+    def test_cached_state_invalidation(self):
+        # Changing an answer clears the cached state of the Task and of the
+        # Tasks that read it, but not of other Tasks in the same project.
+        def make_task(module_name):
+            return Task.objects.create(module=self.getModule(module_name), editor=self.user, project=self.project)
+        def answer(task, key, value, answered_by_tasks=[]):
+            ta, _ = TaskAnswer.objects.get_or_create(task=task, question=task.module.questions.get(key=key))
+            ta.save_answer(value, answered_by_tasks, None, self.user, "web")
+        def cached_keys(task):
+            task.refresh_from_db()
+            return set(task.cached_state or {}) - { "_reads" }
+
+        parent = make_task("question_types_module")
+        child = make_task("simple")
+        other = make_task("simple")
+        answer(child, "q1", "Hello")
+        answer(other, "q1", "Other")
+        answer(parent, "q_module", None, [child])
+
+        parent.get_progress_percent_tuple()
+        self.assertEqual(other.title, "Other")
+        self.assertEqual(cached_keys(parent), { "rollups" })
+        self.assertEqual(set(parent.cached_state_reads.all()), { child })
+
+        # The parent's rollups are cleared and, since the child is an answer
+        # to one of the parent's questions, computed again right away.
+        parent_updated = parent.updated
+        answer(child, "q1", "Goodbye")
+        self.assertEqual(cached_keys(parent), { "rollups" })
+        self.assertGreater(parent.updated, parent_updated)
+        self.assertEqual(cached_keys(other), { "title" })
+        self.assertEqual(Task.objects.get(id=child.id).title, "Goodbye")
+
+    def test_task_rollups(self):
+        # Finished and progress rollups are stored on Tasks and are updated
+        # up the tree of Tasks when answers are saved.
+        def make_task(module_name):
+            return Task.objects.create(module=self.getModule(module_name), editor=self.user, project=self.project)
+        def answer(task, key, value, answered_by_tasks=[]):
+            ta, _ = TaskAnswer.objects.get_or_create(task=task, question=task.module.questions.get(key=key))
+            ta.save_answer(value, answered_by_tasks, None, self.user, "web")
+        def rollups(task):
+            task = Task.objects.get(id=task.id)
+            return (task.finished, task.progress_answered, task.progress_total)
+
+        parent = make_task("question_types_module")
+        child = make_task("simple")
+        self.assertEqual(rollups(child), (None, None, None))
+        answer(parent, "q_module", None, [child])
+        self.assertEqual(rollups(child), (False, 0, 2))
+        finished, answered, total = rollups(parent)
+        self.assertFalse(finished)
+
+        # Answering the child updates the parent without it being read.
+        answer(child, "q1", "Hello")
+        answer(child, "_introduction", None)
+        self.assertEqual(rollups(child), (True, 2, 2))
+        self.assertEqual(rollups(parent), (False, answered + 2, total))
+        self.assertEqual(Task.objects.get(id=parent.id).get_progress_percent_tuple(), (answered + 2, total))
+
+        # Finished Tasks are not open.
+        self.assertEqual(self.project.get_open_tasks(self.user), [Task.objects.get(id=parent.id)])
+
+        # When many answers are saved at once, each Task is updated once.
+        from unittest import mock
+        with mock.patch("guidedmodules.models.Task.compute_rollups", autospec=True,
+                        side_effect=Task.compute_rollups) as compute_rollups:
+            with DeferredRollups():
+                answer(child, "q1", "Goodbye")
+                answer(child, "q1", "Hello again")
+                self.assertEqual(rollups(parent), (None, None, None))
+            self.assertEqual(compute_rollups.call_count, 2)
+        self.assertEqual(rollups(parent), (False, answered + 2, total))
+
+    def test_project_lifecycle_stage(self):
+        # The Project lifecycle stage is stored when answers are saved so
+        # that listing projects doesn't render any output documents.
+        from unittest import mock
+        from siteapp.views import assign_project_lifecycle_stage
+        m = self.project.root_task.module
+        m.spec["output"] = [{
+            "format": "markdown",
+            "template": "# Report",
+        }, {
+            "id": "govready_lifecycle_stage_code",
+            "format": "text",
+            "template": "{% if simple_module.q1 == 'select' %}us_nist_rmf_2_select{% else %}us_nist_rmf_1_categorize{% endif %}",
+        }]
+        m.save()
+        self.assertEqual(self.project.get_lifecycle_stage_code(), "us_nist_rmf_1_categorize")
+
+        subtask = self.project.root_task.get_or_create_subtask(self.user, "simple_module")
+        ta = TaskAnswer.objects.create(task=subtask, question=subtask.module.questions.get(key="q1"))
+        ta.save_answer("select", [], None, self.user, "web")
+        project = Project.objects.get(id=self.project.id)
+        self.assertEqual(project.lifecycle_stage_code, "us_nist_rmf_2_select")
+
+        with mock.patch("guidedmodules.models.Task.render_output_documents") as render:
+            assign_project_lifecycle_stage([project])
+            self.assertFalse(render.called)
+
+        # Only the lifecycle stage document is rendered.
+        from .models import TaskRenderedOutput
+        project.update_lifecycle_stage_code()
+        self.assertEqual(list(TaskRenderedOutput.objects.filter(task=project.root_task).values_list("document", "format")),
+            [(len(m.spec["output"]) - 1, "text")])
+        self.assertEqual((project.lifecycle_stage[0]["id"], project.lifecycle_stage[1]["id"]), ("us_nist_rmf", "2_select"))
+
+    def test_rendered_output_cache(self):
+        # Rendered output documents are cached one per row and are
+        # deleted when the answers they were rendered from change.
+        from .models import TaskRenderedOutput
+        def make_task(value):
+            task = Task.objects.create(module=self.getModule("simple"), editor=self.user, project=self.project)
+            ta = TaskAnswer.objects.create(task=task, question=task.module.questions.get(key="q1"))
+            ta.save_answer(value, [], None, self.user, "web")
+            return task, ta
+        task, ta = make_task("42")
+        other_task, _ = make_task("41")
+
+        html = task.render_output_documents()[0]["html"]
+        self.assertIn(">42</span>", html)
+        other_task.render_output_documents(use_data_urls=True)[0]["html"]
+        entry = TaskRenderedOutput.objects.get(task=task)
+        self.assertEqual((entry.document, entry.format, entry.variant), (0, "html", ""))
+        self.assertEqual(entry.size, len(html.encode("utf8")))
+        self.assertEqual(TaskRenderedOutput.get_cache_size(task=task), (1, entry.size))
+        self.assertEqual(TaskRenderedOutput.objects.get(task=other_task).variant, "data-urls")
+
+        # A second render is served from the cache.
+        entry.content = "cached"
+        entry.save()
+        self.assertEqual(task.render_output_documents()[0]["html"], "cached")
+
+        ta.save_answer("43", [], None, self.user, "web")
+        self.assertFalse(TaskRenderedOutput.objects.filter(task=task).exists())
+        self.assertTrue(TaskRenderedOutput.objects.filter(task=other_task).exists())
+        self.assertIn(">43</span>", task.render_output_documents()[0]["html"])
+
+    def test_rendered_output_invalidation(self):
+        # A rendered output document of a Task is deleted when the answers of
+        # a Task it read change, and so is cached state computed from another
+        # cached entry of the same Task.
+        from .models import TaskRenderedOutput
+        def answer(task, key, value, answered_by_tasks=[]):
+            ta, _ = TaskAnswer.objects.get_or_create(task=task, question=task.module.questions.get(key=key))
+            ta.save_answer(value, answered_by_tasks, None, self.user, "web")
+        parent = Task.objects.create(module=self.getModule("question_types_module"), editor=self.user, project=self.project)
+        child = Task.objects.create(module=self.getModule("simple"), editor=self.user, project=self.project)
+        answer(child, "q1", "Hello")
+        answer(parent, "q_module", None, [child])
+
+        parent = Task.objects.get(id=parent.id)
+        self.assertIn("Hello", parent.render_output_documents()[0]["html"])
+        self.assertTrue(TaskRenderedOutput.objects.filter(task=parent).exists())
+        parent._get_cached_state("x", lambda : Task.objects.get(id=child.id).title)
+        parent._get_cached_state("y", lambda : parent._get_cached_state("x", None))
+        self.assertIn(child.id, parent.cached_state["_reads"]["y"])
+
+        answer(child, "q1", "Goodbye")
+        self.assertFalse(TaskRenderedOutput.objects.filter(task=parent).exists())
+        parent.refresh_from_db()
+        self.assertNotIn("x", parent.cached_state or {})
+        self.assertNotIn("y", parent.cached_state or {})
+
+
+class TaskAnswerTests(TestCaseWithFixtureData):
+    # Tests saving answers and the tree of sub-tasks that answers form.
+
+    def test_current_answer(self):
+        # TaskAnswer.current_answer follows saved and cleared answers.
+        task = Task.objects.create(module=self.getModule("simple"), editor=self.user, project=self.project)
+        ta = TaskAnswer.objects.create(task=task, question=task.module.questions.get(key="q1"))
+        self.assertIsNone(ta.get_current_answer())
+        ta.save_answer("first", [], None, self.user, "web")
+        ta.save_answer("second", [], None, self.user, "web")
+        ta = TaskAnswer.objects.get(id=ta.id)
+        self.assertEqual(ta.current_answer, ta.answer_history.order_by('-id').first())
+        self.assertEqual(ta.get_current_answer().stored_value, "second")
+        self.assertEqual(task.get_answers().as_dict(), { "q1": "second" })
+        ta.clear_answer(self.user)
+        ta = TaskAnswer.objects.get(id=ta.id)
+        self.assertTrue(ta.get_current_answer().cleared)
+        self.assertTrue(ta.current_answer.is_latest())
+        self.assertEqual(task.get_answers().as_dict(), { })
+
+    def test_file_answer_derivatives(self):
+        # The metadata about uploaded files is computed when the answer is
+        # saved, not each time the answer's value is used.
+        from django.core.files.base import ContentFile
+        task = Task.objects.create(module=self.getModule("question_types_media"), editor=self.user, project=self.project)
+        ta = TaskAnswer.objects.create(task=task, question=task.module.questions.get(key="q_file"))
+        f = ContentFile(b"Hello!")
+        f.name = "hello.txt"
+        ta.save_answer(None, [], f, self.user, "web")
+        answer = ta.get_current_answer()
+        self.assertEqual(answer.extra["file"]["size"], 6)
+
+        from unittest import mock
+        with mock.patch("dbstorage.models.StoredFile.objects") as sf:
+            value = answer.get_value()
+        self.assertFalse(sf.mock_calls)
+        self.assertEqual((value["size"], value["type"], value["type_display"]), (6, "text/plain", "plain text"))
+        self.assertIsNone(value["thumbnail_url"])
+        self.assertTrue(value["url"].endswith("/question/q_file/history/%d/media" % answer.id))
+
+    def test_task_access_through_ancestors(self):
+        # Users with access to a Task have access to the Tasks that are
+        # answers to its questions, recursively.
+        from .models import TaskAncestor
+        other_user = User.objects.create(username="other.user")
+        other_project = Project.objects.create(organization=self.organization)
+        def make_task(module_name, project, editor):
+            return Task.objects.create(module=self.getModule(module_name), project=project, editor=editor)
+        def answer(task, key, subtasks):
+            ta, _ = TaskAnswer.objects.get_or_create(task=task, question=task.module.questions.get(key=key))
+            ta.save_answer(None, subtasks, None, self.user, "web")
+            return ta
+        root = make_task("app", other_project, other_user)
+        middle = make_task("question_types_module", self.project, self.user)
+        leaf = middle.get_or_create_subtask(self.user, "q_module")
+        self.assertIsNone(leaf.get_access_level(other_user))
+        self.assertFalse(Task.get_all_tasks_readable_by(other_user, self.organization, recursive=True).filter(id=leaf.id).exists())
+
+        ta = answer(root, "question_types_module", [middle])
+        self.assertEqual(set(TaskAncestor.objects.filter(task=leaf).values_list("ancestor", flat=True)), { middle.id, root.id })
+        self.assertEqual(leaf.get_access_level(other_user), "WRITE")
+        self.assertTrue(self.project.has_read_priv(other_user))
+        self.assertTrue(Task.get_all_tasks_readable_by(other_user, self.organization, recursive=True).filter(id=leaf.id).exists())
+
+        ta.clear_answer(self.user)
+        self.assertEqual(set(TaskAncestor.objects.filter(task=leaf).values_list("ancestor", flat=True)), { middle.id })
+        self.assertIsNone(leaf.get_access_level(other_user))
+        self.assertFalse(self.project.has_read_priv(other_user))
+
+
+class AppLoadingTests(TestCaseWithFixtureData):
+    # Tests loading apps into the database.
+
+    def test_shared_app_instances(self):
+        # Projects started from identical app content share an AppInstance,
+        # and changing it for one Project copies it first.
+        from .models import AppSource
+        from .app_loading import get_app_instance_for_project_update
+        with AppSource.objects.get(slug="fixture").open() as store:
+            appinst = load_app_into_database(store.get_app("simple_project"), reuse_identical=True)
+            self.assertEqual(load_app_into_database(store.get_app("simple_project"), reuse_identical=True), appinst)
+            self.assertNotEqual(load_app_into_database(store.get_app("simple_project")), appinst)
+        self.assertEqual(appinst.content_hash, self.fixture_app.content_hash)
+
+        projects = []
+        for i in range(2):
+            project = Project.objects.create(organization=self.organization)
+            project.set_root_task(appinst.modules.get(module_name="app"), self.user)
+            task = Task.objects.create(module=appinst.modules.get(module_name="question_types_module"), editor=self.user, project=project)
+            subtask = task.get_or_create_subtask(self.user, "q_module")
+            ta = TaskAnswer.objects.create(task=subtask, question=subtask.module.questions.get(key="q1"))
+            ta.save_answer(str(i), [], None, self.user, "web")
+            projects.append((project, task, subtask))
+
+        # Only the second Project's Tasks move to the copy.
+        project, task, subtask = projects[1]
+        new_appinst = get_app_instance_for_project_update(appinst, project)
+        self.assertNotEqual(new_appinst, appinst)
+        self.assertIsNone(new_appinst.content_hash)
+        self.assertEqual(Task.objects.get(id=project.root_task.id).module.app, new_appinst)
+        task = Task.objects.get(id=task.id)
+        subtask = Task.objects.get(id=subtask.id)
+        self.assertEqual(subtask.module.app, new_appinst)
+        q_module = task.module.questions.get(key="q_module")
+        self.assertEqual(q_module.answer_type_module, subtask.module)
+        self.assertEqual(q_module.spec["module-id"], subtask.module.id)
+        self.assertEqual(task.get_answers().as_dict()["q_module"].as_dict(), { "q1": "1" })
+        self.assertEqual(Task.objects.get(id=projects[0][2].id).module.app, appinst)
+        self.assertEqual(projects[0][1].get_answers().as_dict()["q_module"].as_dict(), { "q1": "0" })
+
+        # Now the copy isn't shared, so it isn't copied again.
+        self.assertEqual(get_app_instance_for_project_update(new_appinst, project), new_appinst)
+
+    def test_app_update_invalidation(self):
+        # Updating an app in place clears the cached state of the Tasks of
+        # the Modules that changed, and reports what it did.
+        from .models import AppSource
+        from .app_loading import AppImportUpdateMode
+        with AppSource.objects.get(slug="fixture").open() as store:
+            appinst = load_app_into_database(store.get_app("simple_project"))
+            changed_task = Task.objects.create(module=appinst.modules.get(module_name="simple"), editor=self.user, project=self.project)
+            other_task = Task.objects.create(module=appinst.modules.get(module_name="question_types_text"), editor=self.user, project=self.project)
+            for task in (changed_task, other_task):
+                task.get_progress_percent_tuple()
+                self.assertTrue(Task.objects.get(id=task.id).cached_state)
+
+            # Nothing changed.
+            stats = { }
+            load_app_into_database(store.get_app("simple_project"), AppImportUpdateMode.CompatibleUpdate, appinst, stats=stats)
+            self.assertEqual((stats["modules_updated"], stats["tasks_invalidated"]), (0, 0))
+
+            # Change one module.
+            m = changed_task.module
+            m.spec = dict(m.spec, title="Changed")
+            m.save()
+            load_app_into_database(store.get_app("simple_project"), AppImportUpdateMode.CompatibleUpdate, appinst, stats=stats)
+            self.assertEqual((stats["modules_updated"], stats["tasks_invalidated"]), (1, 1))
+            self.assertEqual(Task.objects.get(id=changed_task.id).module.spec["title"], "A Simple Module")
+            self.assertFalse(Task.objects.get(id=changed_task.id).cached_state)
+            self.assertTrue(Task.objects.get(id=other_task.id).cached_state)
+
+            # Change the assets. Every Task of the app is cleared.
+            changed_task.get_progress_percent_tuple()
+            appinst.asset_paths = dict(appinst.asset_paths, **{ "removed.png": "0" })
+            appinst.save()
+            load_app_into_database(store.get_app("simple_project"), AppImportUpdateMode.CompatibleUpdate, appinst, stats=stats)
+            self.assertEqual((stats["modules_updated"], stats["assets_changed"]), (0, True))
+            self.assertFalse(Task.objects.get(id=changed_task.id).cached_state)
+            self.assertFalse(Task.objects.get(id=other_task.id).cached_state)
+
+    def test_parallel_module_validation(self):
+        # Module specifications validated in worker processes, which are
+        # only used when asked for, come out the same as when validated
+        # in-process, and errors are raised in order.
+        from unittest import mock
+        from collections import OrderedDict
+        from django.test import override_settings
+        from .models import AppSource
+        from .app_loading import validate_app_modules, ValidationError
+        with AppSource.objects.get(slug="fixture").open() as store:
+            app = store.get_app("simple_project")
+            with override_settings(APP_LOADING_WORKERS=1):
+                serial = validate_app_modules(app, dict(app.get_modules()))
+            with override_settings(APP_LOADING_WORKERS=2), \
+                 mock.patch("guidedmodules.app_loading.PARALLEL_VALIDATION_MIN_MODULES", 1):
+                with mock.patch("concurrent.futures.ProcessPoolExecutor") as pool:
+                    validate_app_modules(app, dict(app.get_modules()))
+                    self.assertFalse(pool.called)
+                parallel = validate_app_modules(app, dict(app.get_modules()), parallel=True)
+
+                modules = OrderedDict(app.get_modules())
+                first, second = list(modules)[:2]
+                del modules[first]["title"]
+                modules[second]["id"] = "wrong"
+                with self.assertRaisesRegex(ValidationError, "error in %s " % first):
+                    validate_app_modules(app, modules, parallel=True)
+        self.assertEqual(list(parallel.keys()), list(serial.keys()))
+        self.assertEqual(parallel, serial)
+
+    def test_asset_loading(self):
+        # Assets are stored once per content hash, in the same format and
+        # under the same name that dbstorage gives files.
+        import io, os
+        from dbstorage.models import StoredFile
+        from dbstorage.storage import DatabaseStorage
+        from .models import AppSource
+        from .app_loading import create_stored_file
+        content = os.urandom(100000) + b"x" * 100000
+        sf = create_stored_file("guidedmodules/module-assets", io.BytesIO(content))
+        self.assertEqual(sf.get_blob(), content)
+        self.assertEqual(sf.size, len(content))
+        self.assertEqual(sf.path, DatabaseStorage.generate_name("guidedmodules/module-assets/file", content))
+
+        with AppSource.objects.get(slug="fixture").open() as store:
+            app = store.get_app("simple_project")
+            appinst = load_app_into_database(app)
+            asset = appinst.asset_files.get()
+            self.assertEqual(asset, self.fixture_app.asset_files.get())
+            with app.fs.open("assets/test_asset.png", "rb") as f:
+                self.assertEqual(StoredFile.objects.get(path=asset.file.name).get_blob(), f.read())
+
+        # Files stored by a concurrent load are skipped.
+        from .app_loading import bulk_create_ignoring_conflicts
+        other_sf = create_stored_file("guidedmodules/module-assets", io.BytesIO(b"other"))
+        bulk_create_ignoring_conflicts(StoredFile, [sf])
+        bulk_create_ignoring_conflicts(StoredFile, [create_stored_file("guidedmodules/module-assets", io.BytesIO(content)), other_sf])
+        self.assertEqual(StoredFile.objects.filter(path__in=[sf.path, other_sf.path]).count(), 2)
+
 
 class RenderTests(TestCaseWithFixtureData):
     ## GENERAL RENDER TESTS ##
@@ -400,6 +928,41 @@ class RenderTests(TestCaseWithFixtureData):
             str(self), # source
         ).strip()
 
+    def test_template_cache(self):
+        # Rendering the same template twice compiles it only once, and
+        # templates that differ only in how Markdown headings are rendered
+        # are cached separately.
+        clear_template_cache()
+        def test(demote_headings, expected):
+            m = self.getModule("question_types_text")
+            actual = render_content(
+                { "format": "markdown", "template": "# {{q_text}}" },
+                ModuleAnswers(m, None, { "q_text": (m.questions.get(key="q_text"), True, None, "hello") }),
+                "html",
+                str(self), # source
+                demote_headings=demote_headings,
+            ).strip()
+            self.assertEqual(actual, expected)
+        test(True, "<h2>hello</h2>")
+        test(True, "<h2>hello</h2>")
+        test(False, "<h1>hello</h1>")
+        stats = get_template_cache_stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 2)
+        self.assertEqual(stats["size"], 2)
+
+        # The counters can be read by staff on the analytics page.
+        import json
+        from django.test import RequestFactory
+        from guidedmodules.views import analytics
+        request = RequestFactory().get("/tasks/analytics", { "format": "json" })
+        request.user = self.user
+        self.assertEqual(analytics(request).status_code, 403)
+        self.user.is_staff = True
+        response = analytics(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content.decode("utf8")), { "template_cache": stats })
+
     ## RENDERING ANSWERS ##
     #
     # Render {{question}}, which yields (a display form of) the raw value,
@@ -643,6 +1206,240 @@ class RenderTests(TestCaseWithFixtureData):
         self.assertEqual(actual, expected_impute_value, msg="impute value expression %s" % expression)
 
 
+class DocumentConversionTests(TestCase):
+    def test_conversion_cache(self):
+        # Converted documents are cached on disk by content, format and
+        # converter version.
+        import os, tempfile
+        from unittest import mock
+        from django.test import override_settings
+        from . import document_conversion
+        with tempfile.TemporaryDirectory() as cache_dir, \
+             override_settings(DOCUMENT_CONVERSION_CACHE_DIR=cache_dir), \
+             mock.patch.object(document_conversion, "get_converter_version", return_value="pandoc 1.0"), \
+             mock.patch.object(document_conversion, "run_pandoc", return_value=b"converted") as run_pandoc:
+            self.assertEqual(document_conversion.convert_html("<p>Hello</p>", "docx"), b"converted")
+            self.assertEqual(document_conversion.convert_html("<p>Hello</p>", "docx"), b"converted")
+            self.assertEqual(run_pandoc.call_count, 1)
+            document_conversion.convert_html("<p>Hello</p>", "odt")
+            document_conversion.convert_html("<p>Goodbye</p>", "docx")
+            self.assertEqual(run_pandoc.call_count, 3)
+
+            document_conversion.get_converter_version.return_value = "pandoc 2.0"
+            document_conversion.convert_html("<p>Hello</p>", "docx")
+            self.assertEqual(run_pandoc.call_count, 4)
+
+            # Pruning the cache deletes the least recently used files.
+            keys = [document_conversion.get_cache_key(str(i).encode("ascii"), "docx", "pandoc 2.0") for i in range(3)]
+            for i, key in enumerate(keys):
+                document_conversion.write_cache(key, b"x" * 100)
+                os.utime(document_conversion.get_cache_path(key), (1000 + i, 1000 + i))
+            document_conversion.read_cache(keys[0])
+            document_conversion.prune_cache(300)
+            self.assertEqual([document_conversion.read_cache(key) is not None for key in keys], [True, False, True])
+
+
+class YamlLoadingTests(TestCase):
+    def test_parsed_yaml_cache(self):
+        from unittest import mock
+        from collections import OrderedDict
+        from .app_source_connections import parse_yaml, read_yaml_file_from_fs, clear_yaml_cache, AppSourceConnectionError
+        clear_yaml_cache()
+
+        # Key order is preserved, and each call returns a fresh copy.
+        doc = parse_yaml("b: 1\na: [1, 2]\nc: { z: 1, y: 2 }\n")
+        self.assertIsInstance(doc, OrderedDict)
+        self.assertEqual(list(doc.keys()), ["b", "a", "c"])
+        self.assertEqual(list(doc["c"].keys()), ["z", "y"])
+        doc["a"].append(3)
+        with mock.patch("yaml.load") as load:
+            self.assertEqual(parse_yaml(b"b: 1\na: [1, 2]\nc: { z: 1, y: 2 }\n")["a"], [1, 2])
+            self.assertFalse(load.called)
+
+        with self.assertRaises(AppSourceConnectionError):
+            parse_yaml("a: [")
+
+        # Files with a git blob hash aren't read again.
+        import fs.memoryfs
+        memfs = fs.memoryfs.MemoryFS()
+        memfs.settext("module.yaml", "id: module\n")
+        self.assertEqual(read_yaml_file_from_fs(memfs, "module.yaml", blob_hash="1234"), { "id": "module" })
+        memfs.remove("module.yaml")
+        self.assertEqual(read_yaml_file_from_fs(memfs, "module.yaml", blob_hash="1234"), { "id": "module" })
+
+
+class GitRepositoryFilesystemTests(TestCase):
+    def test_git_mirror(self):
+        # Git repositories are read from a mirror on disk that is
+        # refreshed only when it is older than the freshness window.
+        import tempfile, os.path, subprocess
+        from django.test import override_settings
+        from .app_source_connections import GitRepositoryFilesystem
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            # Create a repository.
+            repo_dir = os.path.join(tempdir, "repo")
+            def git(*args):
+                subprocess.check_call(["git", "-C", repo_dir,
+                    "-c", "user.name=Test", "-c", "user.email=test@example.com"] + list(args),
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            def commit(content):
+                with open(os.path.join(repo_dir, "apps", "app.yaml"), "w") as f:
+                    f.write(content)
+                git("add", "apps/app.yaml")
+                git("commit", "-m", "update")
+            os.makedirs(os.path.join(repo_dir, "apps"))
+            git("init")
+            commit("version: 1")
+            url = "file://" + repo_dir
+
+            def read():
+                gitfs = GitRepositoryFilesystem(url, None, "apps")
+                try:
+                    return ([entry.name for entry in gitfs.scandir("")], gitfs.openbin("app.yaml").read())
+                finally:
+                    gitfs.close()
+
+            cache_dir = os.path.join(tempdir, "cache")
+            with override_settings(GIT_MIRROR_CACHE_DIR=cache_dir, GIT_MIRROR_FRESHNESS=3600):
+                self.assertEqual(read(), (["app.yaml"], b"version: 1"))
+                self.assertEqual(len([fn for fn in os.listdir(cache_dir) if fn.endswith(".git")]), 1)
+
+                # The mirror is still fresh so the new commit isn't seen yet.
+                commit("version: 2")
+                self.assertEqual(read(), (["app.yaml"], b"version: 1"))
+
+            with override_settings(GIT_MIRROR_CACHE_DIR=cache_dir, GIT_MIRROR_FRESHNESS=0):
+                self.assertEqual(read(), (["app.yaml"], b"version: 2"))
+
+            # Invalid repositories fail.
+            import fs.errors
+            with override_settings(GIT_MIRROR_CACHE_DIR=cache_dir, GIT_MIRROR_FRESHNESS=0):
+                with self.assertRaises(fs.errors.CreateFailed):
+                    GitRepositoryFilesystem("file://" + os.path.join(tempdir, "does-not-exist"), None, "")
+
+
+class AppsCatalogTests(TestCaseWithFixtureData):
+    def test_stale_catalog_is_served(self):
+        # The catalog is built the first time it's needed. After that
+        # the last known catalog is served while a stale one is rebuilt
+        # in the background.
+        from unittest import mock
+        from django.core.cache import cache
+        from django.core.management import call_command
+        from .models import AppSource
+        from siteapp.views import get_compliance_apps_catalog, get_app_catalog_cache_key, is_app_catalog_stale
+        src = AppSource.objects.get(slug="fixture")
+        cache.delete(get_app_catalog_cache_key(src))
+
+        catalog = get_compliance_apps_catalog(self.organization)
+        self.assertIn("fixture/simple_project", [app["key"] for app in catalog])
+        src.refresh_from_db()
+        self.assertEqual(src.get_catalog_build_info()["apps"], len(catalog))
+        self.assertFalse(is_app_catalog_stale(src))
+
+        # Make the cached catalog stale.
+        src.spec = dict(src.spec, extra_key="changed")
+        src.save()
+        self.assertTrue(is_app_catalog_stale(src))
+        with mock.patch("siteapp.views.refresh_app_catalog_in_background") as refresh:
+            self.assertEqual(get_compliance_apps_catalog(self.organization), catalog)
+            self.assertEqual([call[0][0].id for call in refresh.call_args_list], [src.id])
+        self.assertTrue(is_app_catalog_stale(src))
+
+        # The warm_apps_catalog command rebuilds stale catalogs, but only
+        # if the cache is shared with the web server processes.
+        from django.core.management.base import CommandError
+        with self.assertRaises(CommandError):
+            call_command("warm_apps_catalog", once=True)
+        import tempfile
+        from django.test import override_settings
+        with tempfile.TemporaryDirectory() as cache_dir:
+            with override_settings(CACHES={ "default": { "BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": cache_dir } }):
+                self.assertTrue(is_app_catalog_stale(src))
+                call_command("warm_apps_catalog", once=True)
+                self.assertFalse(is_app_catalog_stale(src))
+
+    def test_catalog_index(self):
+        from siteapp.app_catalog_index import AppCatalogIndex
+        def make_app(source, name, title, protocol=None, published=None):
+            return { "key": source + "/" + name, "name": name, "title": title, "appsource_id": source,
+                     "description": { "short": "<p>A <b>" + title + "</b> app.</p>", "long": "" },
+                     "protocol": protocol, "published": published }
+        index = AppCatalogIndex.combine([
+            AppCatalogIndex([
+                make_app("a", "ssp", "System Security Plan", protocol=["ssp", "doc"]),
+                make_app("a", "policy", "Access Policy", protocol="doc"),
+            ]),
+            AppCatalogIndex([
+                make_app("b", "scanner", "Security Scanner", published="unpublished"),
+            ]),
+        ])
+        self.assertEqual(index.search("secur"), { "a/ssp", "b/scanner" })
+        self.assertEqual(index.search("security pla"), { "a/ssp" })
+        self.assertEqual(index.search("b"), set()) # HTML tags are not indexed
+        self.assertEqual(index.search(""), { "a/ssp", "a/policy", "b/scanner" })
+        self.assertEqual(index.get_apps_implementing(["doc"]), { "a/ssp", "a/policy" })
+        self.assertEqual(index.get_apps_implementing(["doc", "ssp"]), { "a/ssp" })
+        self.assertEqual(index.get_app("b/scanner")["title"], "Security Scanner")
+        self.assertFalse(index.is_app_published(index.get_app("b/scanner")))
+        index.approved_apps = { "b": { "scanner": "published" } }
+        self.assertTrue(index.is_app_published(index.get_app("b/scanner")))
+
+    def test_catalog_pages(self):
+        # The catalog is shown APPS_CATALOG_PAGE_SIZE apps at a time.
+        from unittest import mock
+        from django.test import RequestFactory
+        from siteapp.views import apps_catalog
+        def get_page(page_size):
+            request = RequestFactory().get("/store")
+            request.user = self.user
+            request.organization = self.organization
+            with mock.patch("siteapp.views.APPS_CATALOG_PAGE_SIZE", page_size), \
+                 mock.patch("siteapp.views.render") as render:
+                apps_catalog(request)
+            return render.call_args[0][2]["page"]
+        page = get_page(30)
+        self.assertEqual(page.paginator.per_page, 30)
+        self.assertFalse(page.has_next())
+        num_apps = page.paginator.count
+        self.assertGreater(num_apps, 0)
+        page = get_page(1)
+        self.assertEqual(len(page.object_list), 1)
+        self.assertEqual(page.paginator.num_pages, num_apps)
+
+
+class DocumentExportJobTests(TestCaseWithFixtureData):
+    def test_process_export_jobs(self):
+        # Queued exports are processed by the process_export_jobs
+        # management command.
+        from django.core.management import call_command
+        from .models import DocumentExportJob
+        task = Task.objects.create(module=self.getModule("simple"), editor=self.user, project=self.project)
+        ta = TaskAnswer.objects.create(task=task, question=task.module.questions.get(key="q1"))
+        ta.save_answer("42", [], None, self.user, "web")
+
+        job = DocumentExportJob.enqueue(task, self.user, "your_answers", "markdown")
+        self.assertEqual(DocumentExportJob.enqueue(task, self.user, "your_answers", "markdown"), job)
+        bad_job = DocumentExportJob.enqueue(task, self.user, "not_a_document", "markdown")
+        self.assertEqual(job.get_status_dict(), { "status": "queued", "status_url": job.get_status_url() })
+
+        call_command("process_export_jobs", once=True)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, "finished")
+        self.assertEqual(job.get_status_dict()["download_url"], job.get_download_url())
+        self.assertEqual((job.filename, job.mime_type), ("your_answers.md", "text/plain"))
+        self.assertIn(b"The Answer: 42", bytes(job.content))
+        bad_job.refresh_from_db()
+        self.assertEqual(bad_job.status, "failed")
+        self.assertEqual(bad_job.get_status_dict()["message"], "Invalid document_id.")
+        self.assertIsNone(DocumentExportJob.claim_next())
+
+        # A new export is queued after the last one finished.
+        self.assertNotEqual(DocumentExportJob.enqueue(task, self.user, "your_answers", "markdown"), job)
+
+
 class ImportExportTests(TestCaseWithFixtureData):
     ## IMPORT/EXPORT TASK DATA TESTS ##
 
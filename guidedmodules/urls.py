@@ -16,6 +16,8 @@ urlpatterns = [
     url(r'^start$', guidedmodules.views.new_task),
     url(r'^_delete_task$', guidedmodules.views.delete_task, name="delete_task"),
     url(r'^_get_task_timetamp$', guidedmodules.views.get_task_timetamp, name="task_get_timestamp"),
+    url(r'^_export/(\d+)$', guidedmodules.views.document_export_status, name="document_export_status"),
+    url(r'^_export/(\d+)/download$', guidedmodules.views.download_document_export, name="download_document_export"),
     url(r'^_instrumentation_record_interaction$', guidedmodules.views.instrumentation_record_interaction, name="task_instrumentation_record_interaction"),
     url(r'^_start_discussion', guidedmodules.views.start_a_discussion, name="start_a_discussion"),
     url(r'^analytics$', guidedmodules.views.analytics, name="guidedmodules_analytics"),
@@ -7,7 +7,7 @@ from django.db import transaction
 
 import re
 
-from .models import Module, ModuleQuestion, Task, TaskAnswer, TaskAnswerHistory, InstrumentationEvent
+from .models import Module, ModuleQuestion, Task, TaskAnswer, TaskAnswerHistory, InstrumentationEvent, DocumentExportJob
 import guidedmodules.module_logic as module_logic
 import guidedmodules.answer_validation as answer_validation
 from discussion.models import Discussion
@@ -134,8 +134,9 @@ def task_view(view_func):
             return HttpResponseRedirect(task.get_absolute_url() + pagepath + question_key)
 
         # Load the answers the user has saved so far, and fetch imputed
-        # answers and next-question info.
-        answered = task.get_answers().with_extended_info()
+        # answers and next-question info. They're cached across requests
+        # until the Task (or anything they depend on) changes.
+        answered = module_logic.get_evaluated_answers(task)
 
         # Common context variables.
         context = {
@@ -599,6 +600,7 @@ def task_finished(request, task, answered, context, *unused_args):
         "all_answers": answered.render_answers(show_metadata=True, show_imputed_nulls=False),
         "can_review": task.has_review_priv(request.user),
         "authoring_tool_enabled": task.module.is_authoring_tool_enabled(request.user),
+        "async_download_formats": list(DocumentExportJob.ASYNC_FORMATS),
     })
     return render(request, "module-finished.html", context)
 
@@ -657,6 +659,18 @@ def download_answer_file(request, task, answered, context, q, history_id):
 def download_module_output(request, task, answered, context, question, document_id, download_format):
     if document_id in (None, ""):
         raise Http404()
+
+    # Conversions to some formats can take a while. Rather than tying up the
+    # request, queue a job to do the export and return a URL where the client
+    # can poll for the status of the job.
+    if download_format in DocumentExportJob.ASYNC_FORMATS:
+        if request.method != "POST":
+            return HttpResponseNotAllowed(["POST"])
+        if not any(d.get("id") == document_id for d in task.module.spec.get("output", [])):
+            raise Http404()
+        job = DocumentExportJob.enqueue(task, request.user, document_id, download_format)
+        return JsonResponse(job.get_status_dict())
+
     try:
         blob, filename, mime_type= task.download_output_document(document_id, download_format, answers=answered)
     except ValueError:
@@ -666,6 +680,28 @@ def download_module_output(request, task, answered, context, question, document_
     resp['Content-Disposition'] = 'inline; filename=' + filename
     return resp
 
+def get_document_export_job(request, job_id):
+    # Only the user who requested the export can see it, and only if they
+    # can still see the Task.
+    job = get_object_or_404(DocumentExportJob, id=job_id, user=request.user, task__project__organization=request.organization)
+    if not job.task.has_read_priv(request.user):
+        raise Http404()
+    return job
+
+@login_required
+def document_export_status(request, job_id):
+    job = get_document_export_job(request, job_id)
+    return JsonResponse(job.get_status_dict())
+
+@login_required
+def download_document_export(request, job_id):
+    job = get_document_export_job(request, job_id)
+    if job.status != "finished":
+        raise Http404()
+    resp = HttpResponse(bytes(job.content), job.mime_type)
+    resp['Content-Disposition'] = 'inline; filename=' + job.filename
+    return resp
+
 @login_required
 def instrumentation_record_interaction(request):
     if request.method != "POST":
@@ -731,6 +767,13 @@ def authoring_tool_auth(f):
         if not task.module.is_authoring_tool_enabled(request.user):
             return HttpResponseForbidden()
 
+        # The task's AppInstance may be shared with other projects. Since
+        # authoring tools change it in place, make a copy for this task's
+        # project first if needed and re-load the task so it sees the copy.
+        from .app_loading import get_app_instance_for_project_update
+        get_app_instance_for_project_update(task.module.app, task.project)
+        task = Task.objects.get(id=task.id)
+
         # Run inner function.
         return f(request, task)
 
@@ -748,10 +791,17 @@ def upgrade_app(request):
 
     from .models import AppInstance
     appinst = get_object_or_404(AppInstance, id=request.POST["app"])
-    if not appinst.has_upgrade_priv(request.user):
+    project = get_object_or_404(Project, id=request.POST["project"], organization=request.organization)
+    if not appinst.has_upgrade_priv(request.user, project):
         return HttpResponseForbidden()
 
-    from .app_loading import load_app_into_database, AppImportUpdateMode, ModuleDefinitionError, IncompatibleUpdate
+    from .app_loading import load_app_into_database, AppImportUpdateMode, ModuleDefinitionError, IncompatibleUpdate, \
+        get_app_instance_for_project_update
+
+    # The AppInstance may be shared with other Projects. Upgrade a copy
+    # that only this Project uses.
+    appinst = get_app_instance_for_project_update(appinst, project)
+
     with appinst.source.open() as store:
             # Load app.
             try:
@@ -767,24 +817,18 @@ def upgrade_app(request):
                 and request.POST.get("force") == "true":
                 mode = AppImportUpdateMode.ForceUpdate
 
-            # Import.
+            # Import. The cached state of the Tasks of any Modules that
+            # changed is cleared as a part of the import.
+            stats = { }
             try:
-                load_app_into_database(app, mode, appinst)
+                load_app_into_database(app, mode, appinst, stats=stats)
             except (ModuleDefinitionError, IncompatibleUpdate) as e:
                 return JsonResponse({ "status": "error", "message": str(e) })
 
-    # Since ModuleQuestions may have changed...
-    from .module_logic import clear_module_question_cache
-    clear_module_question_cache()
-
-    # Since impute conditions, output documents, and other generated
-    # data may have changed, clear all cached Task state.
-    Task.clear_state(Task.objects.filter(module__app=appinst))
-
     from django.contrib import messages
-    messages.add_message(request, messages.INFO, 'App upgraded.')
+    messages.add_message(request, messages.INFO, 'App upgraded. {modules_updated} of {modules} modules changed and {tasks_invalidated} tasks were refreshed in {time:.1f} seconds.'.format(**stats))
 
-    return JsonResponse({ "status": "ok" })
+    return JsonResponse({ "status": "ok", "stats": stats })
 
 @authoring_tool_auth
 def authoring_new_question(request, task):
@@ -822,6 +866,9 @@ def authoring_new_question(request, task):
         )
     question.save()
 
+    # Update the Module's question dependency graph.
+    question.module.update_question_dependencies()
+
     # Write to disk. Errors writing should not be suppressed because
     # saving to disk is a part of the contract of how app editing works.
     try:
@@ -829,10 +876,6 @@ def authoring_new_question(request, task):
     except Exception as e:
         return JsonResponse({ "status": "error", "message": "Could not update local YAML file: " + str(e) })
 
-    # Clear cache...
-    from .module_logic import clear_module_question_cache
-    clear_module_question_cache()
-
     # Return status. The browser will reload/redirect --- if the question key
     # changed, this sends the new key.
     return JsonResponse({ "status": "ok", "redirect": task.get_absolute_url_to_question(question) })
@@ -846,10 +889,11 @@ def authoring_edit_question(request, task):
     if request.POST.get("delete") == "1":
         try:
             question.delete()
-            return JsonResponse({ "status": "ok", "redirect": task.get_absolute_url() })
         except Exception as e:
             # The only reason it would fail is a protected foreign key.
             return JsonResponse({ "status": "error", "message": "The question cannot be deleted because it has already been answered." })
+        task.module.update_question_dependencies()
+        return JsonResponse({ "status": "ok", "redirect": task.get_absolute_url() })
 
     # Update the question...
 
@@ -943,6 +987,9 @@ def authoring_edit_question(request, task):
     question.spec = spec
     question.save()
 
+    # Update the Module's question dependency graph.
+    question.module.update_question_dependencies()
+
     # Write to disk. Errors writing should not be suppressed because
     # saving to disk is a part of the contract of how app editing works.
     try:
@@ -950,10 +997,6 @@ def authoring_edit_question(request, task):
     except Exception as e:
         return JsonResponse({ "status": "error", "message": "Could not update local YAML file: " + str(e) })
 
-    # Clear cache...
-    from .module_logic import clear_module_question_cache
-    clear_module_question_cache()
-
     # Return status. The browser will reload/redirect --- if the question key
     # changed, this sends the new key.
     return JsonResponse({ "status": "ok", "redirect": task.get_absolute_url_to_question(question) })
@@ -990,10 +1033,6 @@ def authoring_edit_module(request, task):
     except Exception as e:
         return JsonResponse({ "status": "error", "message": "Could not update local YAML file: " + str(e) })
 
-    # Clear cache...
-    from .module_logic import clear_module_question_cache
-    clear_module_question_cache()
-
     # Return status. The browser will reload/redirect --- if the question key
     # changed, this sends the new key.
     return JsonResponse({ "status": "ok", "redirect": task.get_absolute_url() })
@@ -1162,6 +1201,12 @@ def analytics(request):
     if not request.user.is_staff:
         return HttpResponseForbidden()
 
+    # The compiled template cache counters are kept per process, so they
+    # describe the web worker that served this request.
+    template_cache_stats = module_logic.get_template_cache_stats()
+    if request.GET.get("format") == "json":
+        return JsonResponse({ "template_cache": template_cache_stats })
+
     def compute_table(opt):
         qs = InstrumentationEvent.objects\
             .filter(event_type=opt["event_type"])\
@@ -1205,6 +1250,7 @@ def analytics(request):
 
     return render(request, "analytics.html", {
         "base_template": "base.html" if hasattr(request, "organization") else "base-landing.html",
+        "template_cache": template_cache_stats,
         "tables": [
             compute_table({
                 "event_type": "task-done",
@@ -0,0 +1,140 @@
+# An inverted index over the compliance apps catalog so that the app
+# store can search apps and find the apps that implement a protocol
+# without testing every app in the catalog on every request.
+#
+# An index is built for each AppSource when its catalog is built, and
+# it is cached along with the catalog (see build_app_catalog_for_source
+# in siteapp.views). The indexes of the sources an organization can see
+# are then combined for each request, which is cheap because combining
+# doesn't copy the per-source tables.
+
+import bisect
+import re
+
+def tokenize(text):
+    # Split text into lowercase word tokens, ignoring HTML tags since
+    # app descriptions are indexed after being rendered to HTML.
+    text = re.sub(r"<[^>]*>", " ", text or "")
+    return re.findall(r"\w+", text.lower())
+
+def get_app_protocols(app):
+    # Get the protocols implemented by an app from its catalog info.
+    if isinstance(app.get("protocol"), str):
+        return { app["protocol"] }
+    elif isinstance(app.get("protocol"), list):
+        return set(app["protocol"])
+    else:
+        # no protocol or invalid data type
+        return set()
+
+def get_app_categories(app):
+    return app.get("categories", [app.get("category")])
+
+class AppCatalogIndex:
+    def __init__(self, apps=[]):
+        # Each part is the index of one AppSource's apps.
+        self.parts = []
+        self.approved_apps = { } # AppSource id => AppSource.approved_apps
+        if apps:
+            self.parts.append(self.build_part(apps))
+
+    @staticmethod
+    def build_part(apps):
+        apps_by_key = { }
+        tokens = { } # token => set of app keys
+        protocols = { } # protocol => set of app keys
+        for app in apps:
+            key = app["key"]
+            apps_by_key[key] = app
+
+            # Index the same text that the app store used to search on.
+            text = " ".join([
+                app["name"],
+                app["title"],
+                app.get("vendor", ""),
+                app["description"]["short"],
+                app["description"]["long"],
+            ] + [category or "" for category in get_app_categories(app)])
+            for token in tokenize(text):
+                tokens.setdefault(token, set()).add(key)
+
+            for protocol in get_app_protocols(app):
+                protocols.setdefault(protocol, set()).add(key)
+
+        return {
+            "apps": apps_by_key,
+            "tokens": tokens,
+            "sorted_tokens": sorted(tokens), # for prefix search
+            "protocols": protocols,
+        }
+
+    @staticmethod
+    def combine(indexes):
+        # Combine the indexes of several AppSources.
+        ret = AppCatalogIndex()
+        for index in indexes:
+            ret.parts.extend(index.parts)
+            ret.approved_apps.update(index.approved_apps)
+        return ret
+
+    def get_app(self, key):
+        for part in self.parts:
+            if key in part["apps"]:
+                return part["apps"][key]
+        return None
+
+    def get_apps_implementing(self, filter_protocols):
+        # Return the keys of the apps that implement every one of the
+        # protocols in filter_protocols.
+        filter_protocols = set(filter_protocols)
+        ret = set()
+        for part in self.parts:
+            keys = None
+            for protocol in filter_protocols:
+                protocol_keys = part["protocols"].get(protocol, set())
+                keys = protocol_keys if keys is None else (keys & protocol_keys)
+            if keys is None:
+                # No protocols were given, so every app matches.
+                keys = set(part["apps"])
+            ret |= keys
+        return ret
+
+    def get_apps_implementing_question(self, question):
+        # Return the keys of the apps that can answer a module-type question.
+        if not isinstance(question.spec.get("protocol"), list):
+            raise ValueError("Question {} does not expect a protocol.".format(question))
+        return self.get_apps_implementing(question.spec["protocol"])
+
+    def search(self, query):
+        # Return the keys of the apps matching every word in the query.
+        # Words match tokens they are a prefix of, so that partially typed
+        # words match too.
+        ret = set()
+        query = tokenize(query)
+        for part in self.parts:
+            keys = None
+            for word in query:
+                word_keys = set()
+                sorted_tokens = part["sorted_tokens"]
+                i = bisect.bisect_left(sorted_tokens, word)
+                while i < len(sorted_tokens) and sorted_tokens[i].startswith(word):
+                    word_keys |= part["tokens"][sorted_tokens[i]]
+                    i += 1
+                keys = word_keys if keys is None else (keys & word_keys)
+            if keys is None:
+                # The query has no words, so every app matches.
+                keys = set(part["apps"])
+            ret |= keys
+        return ret
+
+    def is_app_published(self, app):
+        # Query the AppSource for whether this app is considered
+        # published or not.
+        try:
+            published = self.approved_apps[app["appsource_id"]][app["name"]]
+
+        # Fall back to the app's catalog information.
+        except KeyError:
+            published = app.get("published")
+
+        return published != "unpublished"
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import time
+
+from guidedmodules.models import AppSource
+from siteapp.views import is_app_catalog_stale, build_app_catalog_for_source
+
+class Command(BaseCommand):
+    help = 'Builds the compliance apps catalog for every AppSource whose cached catalog is missing or stale, so that requests never wait on a remote AppSource. Only useful when the cache is shared between processes (i.e. memcached).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Exit after one pass over the AppSources instead of checking them periodically.")
+        parser.add_argument('--poll-interval', type=float, default=60.0, help="How often to check the AppSources for stale catalogs, in seconds.")
+        parser.add_argument('--force', action='store_true', help="Rebuild the catalog of every AppSource even if it is not stale.")
+
+    def handle(self, *args, **options):
+        # The catalogs are stored in the cache. If it isn't shared with the
+        # web server processes, they would never see what this builds.
+        from django.conf import settings
+        backend = settings.CACHES["default"]["BACKEND"]
+        if backend in ("django.core.cache.backends.locmem.LocMemCache", "django.core.cache.backends.dummy.DummyCache"):
+            raise CommandError("The cache ({}) is not shared between processes. Enable the 'memcached' setting to use this command.".format(backend))
+
+        while True:
+            for appsrc in AppSource.objects.filter(is_system_source=False):
+                if not options["force"] and not is_app_catalog_stale(appsrc):
+                    continue
+
+                # Build the catalog. Errors are recorded on the AppSource,
+                # and the last known catalog continues to be served.
+                try:
+                    build_app_catalog_for_source(appsrc)
+                except Exception as e:
+                    self.stderr.write("{}: {}".format(appsrc.slug, e))
+                    continue
+
+                if options["verbosity"] > 1:
+                    info = appsrc.get_catalog_build_info()
+                    self.stdout.write("{}: {} apps in {:.1f}s".format(appsrc.slug, info["apps"], info["duration"]))
+
+            if options["once"]:
+                break
+
+            # --force only applies to the first pass.
+            options["force"] = False
+            time.sleep(options["poll_interval"])
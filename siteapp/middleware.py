@@ -95,20 +95,17 @@ class OrganizationSubdomainMiddleware:
                 subdomain = settings.SINGLE_ORGANIZATION_KEY
 
             # Does this subdomain correspond with a known organization?
-            org = Organization.objects.filter(subdomain=subdomain).first()
+            org = Organization.get_by_subdomain(subdomain)
             if org:
                 request.unauthenticated_organization_subdomain = org
-                if request.user.is_authenticated and org.can_read(request.user):
-                    # This request is from an authenticated user who is
-                    # authorized to participate in the organization.
 
+                # If the user is logged in and is authorized to participate in
+                # the organization, pre-load the user's settings task so that
+                # we have global access to it. (Both are cached.)
+                if request.user.is_authenticated and request.user.localize_to_org_if_can_read(org):
                     # Set the Organiation on the request object.
                     request.organization = org
 
-                    # Pre-load the user's settings task if the user is logged in,
-                    # so that we have global access to it.
-                    request.user.localize_to_org(request.organization)
-
                     # Continue with normal request processing.
                     return None
 
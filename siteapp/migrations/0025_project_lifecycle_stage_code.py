@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0024_auto_20180315_1241'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='project',
+            name='lifecycle_stage_code',
+            field=models.CharField(blank=True, help_text="The lifecycle stage code computed by the root Task's govready_lifecycle_stage_code output document, or null if it needs to be computed because the answers it was computed from have changed.", max_length=64, null=True),
+        ),
+    ]
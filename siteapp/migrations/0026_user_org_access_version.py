@@ -0,0 +1,18 @@
+# Generated by Django 2.0.13 on 2026-10-18 04:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('siteapp', '0025_project_lifecycle_stage_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='org_access_version',
+            field=models.PositiveIntegerField(default=0, help_text="Incremented when the user's access to Organizations or account settings may have changed, so that cached access checks are no longer used."),
+        ),
+    ]
@@ -20,8 +20,19 @@ class User(AbstractUser):
     api_key_rw = models.CharField(max_length=32, blank=True, null=True, unique=True, help_text="The user's API key with read-write permission.")
     api_key_wo = models.CharField(max_length=32, blank=True, null=True, unique=True, help_text="The user's API key with write-only permission.")
 
+    org_access_version = models.PositiveIntegerField(default=0, help_text="Incremented when the user's access to Organizations or account settings may have changed, so that cached access checks are no longer used.")
+
     # Methods
 
+    def save(self, *args, **kwargs):
+        # org_access_version is only changed by clear_org_access_cache, with an
+        # UPDATE statement. Don't overwrite it with the possibly stale value
+        # on this instance.
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != "org_access_version"]
+        super().save(*args, **kwargs)
+
     def __str__(self):
         name = self._get_setting("name")
         if name: # question might be skipped
@@ -105,6 +116,42 @@ class User(AbstractUser):
         # Prep this user's cached state when viewed from a particular Organization.
         User.localize_users_to_org(org, [self])
 
+    def localize_to_org_if_can_read(self, org):
+        # Check that this user can read the Organization and, if so, localize
+        # the user to it and return True. This runs on every request to an
+        # organization subdomain, so the result is cached. Only successful
+        # checks are cached so that a user who gains access to an Organization
+        # sees it right away. The cache key includes the user's
+        # org_access_version, which is stored in the database and incremented
+        # when the user's project memberships or account settings change, so
+        # that no process uses a stale entry even when the cache is not
+        # shared between processes. Entries otherwise expire after a few minutes.
+        from django.core.cache import cache
+        cache_key = User.get_org_access_cache_key(self.id, self.org_access_version)
+        org_access = cache.get(cache_key) or { }
+        if org.id in org_access:
+            user_settings_task, user_settings_task_answers, can_see_org_settings = org_access[org.id]
+            self.localized_to = org
+            self.user_settings_task = user_settings_task
+            self.user_settings_task_answers = user_settings_task_answers
+            self.can_see_org_settings = can_see_org_settings
+            return True
+
+        if not org.can_read(self):
+            return False
+        self.localize_to_org(org)
+        org_access[org.id] = (self.user_settings_task, self.user_settings_task_answers, self.can_see_org_settings)
+        cache.set(cache_key, org_access, 60*5) # 5 minutes
+        return True
+
+    @staticmethod
+    def get_org_access_cache_key(user_id, org_access_version):
+        return "user_org_access_{}_{}".format(user_id, org_access_version)
+
+    @staticmethod
+    def clear_org_access_cache(user_id):
+        User.objects.filter(id=user_id).update(org_access_version=models.F("org_access_version") + 1)
+
     def user_settings_task_create_if_doesnt_exist(self):
         # If a task is set, return it.
         if getattr(self, 'user_settings_task', None):
@@ -342,6 +389,31 @@ class Organization(models.Model):
         prj, isnew = Project.objects.get_or_create(organization=self, is_organization_project=True)
         return prj
 
+    @staticmethod
+    def get_by_subdomain(subdomain):
+        # Get the Organization at a subdomain, or None. This runs on every
+        # request to an organization subdomain, so cache it for a bit. The
+        # cache is cleared when the Organization is saved.
+        from django.core.cache import cache
+        cache_key = "org_subdomain_{}".format(subdomain)
+        org = cache.get(cache_key)
+        if org is None:
+            org = Organization.objects.filter(subdomain=subdomain).first()
+            if org is None:
+                return None
+            cache.set(cache_key, org, 60*10) # 10 minutes
+        return org
+
+    def save(self, *args, **kwargs):
+        # Clear the cache entries for the Organization's subdomain, and for
+        # its old subdomain if it is being renamed.
+        subdomains = { self.subdomain }
+        if self.id:
+            subdomains |= set(Organization.objects.filter(id=self.id).values_list("subdomain", flat=True))
+        super().save(*args, **kwargs)
+        from django.core.cache import cache
+        cache.delete_many(["org_subdomain_{}".format(subdomain) for subdomain in subdomains])
+
     def get_logo(self):
         # Cache the logo for a bit since it's loaded on every page load.
         from django.core.cache import cache
@@ -428,7 +500,7 @@ class Folder(models.Model):
             .distinct()
 
     def has_read_priv(self, user):
-        return (user in self.get_admins()) or len(self.get_readable_projects(user)) > 0
+        return (user in self.get_admins()) or self.get_readable_projects(user).exists()
 
     def get_readable_projects(self, user):
         # Get the projects that are in the folder that the user can see. This also handily
@@ -449,6 +521,8 @@ class Project(models.Model):
         # other instance is created
     root_task = models.ForeignKey('guidedmodules.Task', blank=True, null=True, related_name="root_of", on_delete=models.CASCADE, help_text="The root Task of this Project, which defines the structure of the Project.")
 
+    lifecycle_stage_code = models.CharField(max_length=64, blank=True, null=True, help_text="The lifecycle stage code computed by the root Task's govready_lifecycle_stage_code output document, or null if it needs to be computed because the answers it was computed from have changed.")
+
     created = models.DateTimeField(auto_now_add=True, db_index=True)
     updated = models.DateTimeField(auto_now=True, db_index=True)
     extra = JSONField(blank=True, help_text="Additional information stored with this object.")
@@ -484,6 +558,30 @@ class Project(models.Model):
             parts.append(self.title)
         return " / ".join(parts)
         
+    def get_lifecycle_stage_code(self):
+        # Return the string identifying the Project's lifecycle stage, which
+        # is computed by the root Task's app's output document named
+        # govready_lifecycle_stage_code. It's stored on the Project so that
+        # listing projects doesn't render the document for each Project. It's
+        # cleared by Task.clear_state when the document's cached rendering is
+        # cleared and is computed again by Task.on_answer_changed, or here.
+        if self.lifecycle_stage_code is None:
+            self.update_lifecycle_stage_code()
+        return self.lifecycle_stage_code
+
+    def update_lifecycle_stage_code(self):
+        # Render only the text of the govready_lifecycle_stage_code document,
+        # and don't evaluate the root Task's answers at all if its app
+        # doesn't have one.
+        code = ""
+        if self.root_task:
+            for i, doc in enumerate(self.root_task.module.spec.get("output", [])):
+                if doc.get("id") == "govready_lifecycle_stage_code":
+                    code = self.root_task.render_output_documents()[i]["text"].strip()
+                    break
+        self.lifecycle_stage_code = code[:Project._meta.get_field("lifecycle_stage_code").max_length]
+        Project.objects.filter(id=self.id).update(lifecycle_stage_code=self.lifecycle_stage_code)
+
     def get_members(self):
         return User.objects.filter(projectmembership__project=self)
 
@@ -564,54 +662,48 @@ class Project(models.Model):
     def get_projects_with_read_priv(user, organization, filters={}, excludes={}):
         # Gets all projects a user has read priv to, excluding
         # account and organization profile projects, and sorted
-        # in reverse chronological order by modified date.
-
-        projects = set()
+        # in reverse chronological order by modified date. Returns
+        # a QuerySet so that callers can re-sort and paginate it in
+        # the database. Each Project is annotated with whether the
+        # user is an admin of the project (user_is_admin).
 
         if not user.is_authenticated:
-            return projects
-
-        # Add all of the Projects the user is a member of within the Organization
-        # that the user is on the subdomain of.
-        for pm in ProjectMembership.objects\
-            .filter(project__organization=organization, user=user)\
-            .filter(**{ "project__"+k: v for k, v in filters.items() })\
-            .exclude(**{ "project__"+k: v for k, v in excludes.items() })\
-            .select_related('project__root_task__module')\
-            .prefetch_related('project__root_task__module__questions'):
-            projects.add(pm.project)
-            if pm.is_admin:
-                # Annotate with whether the user is an admin of the project.
-                pm.project.user_is_admin = True
-
-        # Add projects that the user is the editor of a task in, even if
-        # the user isn't a team member of that project.
-        from guidedmodules.models import Task
-        for task in Task.get_all_tasks_readable_by(user, organization)\
-            .filter(**{ "project__"+k: v for k, v in filters.items() })\
-            .exclude(**{ "project__"+k: v for k, v in excludes.items() })\
-            .order_by('-created')\
-            .select_related('project__root_task__module')\
-            .prefetch_related('project__root_task__module__questions'):
-            projects.add(task.project)
-
-        # Add projects that the user is participating in a Discussion in
-        # as a guest.
-        from discussion.models import Discussion
-        for d in Discussion.objects.filter(organization=organization, guests=user):
-            if d.attached_to is not None: # because it is generic there is no cascaded delete and the Discussion can become dangling
-                if not filters or d.attached_to.task.project in Project.objects.filter(**filters):
-                    if not excludes or d.attached_to.task.project not in Project.objects.exclude(**filters):
-                        projects.add(d.attached_to.task.project)
+            return Project.objects.none()
 
-        # Don't show system projects.
-        system_projects = set(p for p in projects if p.is_organization_project or p.is_account_project)
-        projects -= system_projects
+        from django.db.models import Q, Exists, OuterRef
+        from django.contrib.contenttypes.models import ContentType
+        from guidedmodules.models import Task, TaskAnswer
+        from discussion.models import Discussion
 
-        # Sort.
-        projects = sorted(projects, key = lambda x : x.updated, reverse=True)
+        # The Projects the user is a member of.
+        member_of = ProjectMembership.objects.filter(user=user).values("project")
 
-        return projects
+        # The Projects that the user is the editor of a task in, even if
+        # the user isn't a team member of that project.
+        editor_in = Task.objects.filter(editor=user, deleted_at=None).values("project")
+
+        # The Projects that the user is participating in a Discussion in
+        # as a guest. Discussions are attached to TaskAnswers. Since the
+        # attachment is generic there is no cascaded delete and a Discussion
+        # can be dangling, but then it matches no TaskAnswer here.
+        guest_in = TaskAnswer.objects.filter(
+            id__in=Discussion.objects.filter(
+                organization=organization,
+                guests=user,
+                attached_to_content_type=ContentType.objects.get_for_model(TaskAnswer))
+            .values("attached_to_object_id"))\
+            .values("task__project")
+
+        return Project.objects\
+            .filter(organization=organization)\
+            .filter(Q(id__in=member_of) | Q(id__in=editor_in) | Q(id__in=guest_in))\
+            .filter(**filters)\
+            .exclude(**excludes)\
+            .exclude(is_organization_project=True)\
+            .exclude(is_account_project=True)\
+            .annotate(user_is_admin=Exists(ProjectMembership.objects.filter(project=OuterRef("pk"), user=user, is_admin=True)))\
+            .select_related('root_task__module')\
+            .order_by('-updated')
 
     def get_parent_projects(self):
         parents = []
@@ -626,15 +718,19 @@ class Project(models.Model):
     def get_open_tasks(self, user):
         # Get all tasks that the user might want to continue working on
         # (except for the project root task).
+        # Tasks whose stored rollups say they are finished are skipped in
+        # the query. The rest are checked in case their rollups haven't
+        # been computed yet.
         from guidedmodules.models import Task
         return [
             task for task in
             Task.get_all_tasks_readable_by(user, self.organization)
                 .filter(project=self, editor=user) \
+                .exclude(finished=True) \
+                .exclude(id=self.root_task_id) \
                 .order_by('-updated')\
                 .select_related('project')
-            if not task.is_finished()
-               and task != self.root_task ]
+            if not task.is_finished() ]
 
     def set_root_task(self, module, editor, expected_module_type="project"):
         # create task and set it as the project root task
@@ -871,8 +967,11 @@ class Project(models.Model):
             # missing or empty fields, which will preserve the existing metadata we have.
             pass
 
-        # Update root task.
-        self.root_task.import_json_update(data, deserializer)
+        # Update root task. Update the rollups of the Tasks once, after all
+        # of the answers are saved.
+        from guidedmodules.module_logic import DeferredRollups
+        with DeferredRollups():
+            self.root_task.import_json_update(data, deserializer)
 
         return True
 
@@ -896,6 +995,17 @@ class ProjectMembership(models.Model):
     class Meta:
         unique_together = [('project', 'user')]
 
+    # Project memberships determine which Organizations a user can read,
+    # which is cached (see User.localize_to_org_if_can_read).
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        User.clear_org_access_cache(self.user_id)
+
+    def delete(self, *args, **kwargs):
+        ret = super().delete(*args, **kwargs)
+        User.clear_org_access_cache(self.user_id)
+        return ret
+
 class Invitation(models.Model):
     organization = models.ForeignKey(Organization, related_name="invitations", on_delete=models.CASCADE, help_text="The Organization that this Invitation belongs to.")
 
@@ -20,6 +20,8 @@ MIDDLEWARE += [
     'siteapp.middleware.ContentSecurityPolicyMiddleware',
     'siteapp.middleware.OrganizationSubdomainMiddleware',
     'guidedmodules.middleware.InstrumentQuestionPageLoadTimes',
+    'guidedmodules.middleware.AnswerSnapshotMiddleware',
+    'guidedmodules.middleware.DeferredRollupsMiddleware',
 ]
 
 TEMPLATES[0]['OPTIONS']['context_processors'] += [
@@ -62,6 +64,23 @@ GOVREADY_CMS_API_AUTH = environment.get('govready_cms_api_auth')
 MAILGUN_API_KEY = environment.get('mailgun_api_key', '') # for the incoming mail route
 
 VALIDATE_EMAIL_DELIVERABILITY = True
+
+# Output documents converted to PDF, DOCX, etc. are cached on disk, up to
+# a maximum total size in megabytes. At most this many conversions run at
+# once in each process.
+DOCUMENT_CONVERSION_CACHE_DIR = environment.get("document-conversion-cache", os.path.join("local", "document-cache"))
+DOCUMENT_CONVERSION_CACHE_MAX_SIZE = int(environment.get("document-conversion-cache-max-size", 500))
+DOCUMENT_CONVERSION_WORKERS = int(environment.get("document-conversion-workers", 2))
+
+# Git repository AppSources are mirrored on disk. A mirror is fetched again
+# only if it was last fetched more than this many seconds ago.
+GIT_MIRROR_CACHE_DIR = environment.get("git-mirror-cache", os.path.join("local", "git-mirrors"))
+GIT_MIRROR_FRESHNESS = int(environment.get("git-mirror-freshness", 60))
+
+# Module specifications of large apps are validated in this many worker
+# processes when an app is loaded by the load_modules command. Set to 1 to
+# validate them in-process.
+APP_LOADING_WORKERS = int(environment.get("app-loading-workers", min(4, os.cpu_count() or 1)))
  
 # Get the version of this software.
 import os.path
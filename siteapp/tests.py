@@ -2,6 +2,8 @@ from django.conf import settings
 from django.contrib.staticfiles.testing import StaticLiveServerTestCase
 from django.utils.crypto import get_random_string
 
+from guidedmodules.tests import TestCaseWithFixtureData
+
 from unittest import skip
 
 import os
@@ -933,3 +935,62 @@ class QuestionsTests(OrganizationSiteFunctionalTests):
         var_sleep(.5)
         self.assertRegex(self.browser.title, "^Test The Module Question Types - ")
 
+
+class ProjectListTests(TestCaseWithFixtureData):
+    # Tests of listing the projects a user can read. These don't use
+    # a browser.
+
+    def test_projects_with_read_priv(self):
+        # The Projects a user can read are found in one query, including
+        # those the user is only a guest in a discussion in, and the project
+        # list pages through them with a cursor.
+        from unittest import mock
+        from django.db import connection
+        from django.test import RequestFactory
+        from django.test.utils import CaptureQueriesContext
+        from siteapp.models import User, Project, Folder
+        from siteapp.views import project_list
+        from discussion.models import Discussion
+        from guidedmodules.models import Task, TaskAnswer, ProjectMembership
+        other_user = User.objects.create(username="other.user")
+        def make_project(user, how):
+            project = Project.objects.create(organization=self.organization)
+            project.set_root_task(self.fixture_app.modules.get(module_name="app"), other_user)
+            if how == "member":
+                ProjectMembership.objects.create(project=project, user=user, is_admin=True)
+            elif how == "editor":
+                Task.objects.create(module=self.getModule("simple"), project=project, editor=user)
+            elif how == "guest":
+                task = Task.objects.create(module=self.getModule("simple"), project=project, editor=other_user)
+                ta = TaskAnswer.objects.create(task=task, question=task.module.questions.get(key="q1"))
+                Discussion.get_for(self.organization, ta, create=True).guests.add(user)
+            return project
+        readable = [make_project(self.user, how) for how in ("member", "editor", "guest")]
+        make_project(self.user, None)
+        make_project(other_user, "member")
+        self.organization.get_organization_project()
+
+        projects = Project.get_projects_with_read_priv(self.user, self.organization)
+        with CaptureQueriesContext(connection) as queries:
+            projects = list(projects)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(set(projects), set(readable) | { self.project }) # editor of its root task
+        self.assertEqual({ p for p in projects if p.user_is_admin }, { readable[0] })
+
+        # Page through the project list one project at a time.
+        folder = Folder.objects.create(organization=self.organization, title="Folder")
+        folder.projects.add(*readable)
+        self.user.can_see_org_settings = False
+        seen = []
+        url = "?sort=-created"
+        with mock.patch("siteapp.views.PROJECT_LIST_PAGE_SIZE", 1), \
+             mock.patch("siteapp.views.render") as render:
+            while url:
+                request = RequestFactory().get("/projects" + url)
+                request.user = self.user
+                request.organization = self.organization
+                project_list(request)
+                context = render.call_args[0][2]
+                seen.extend(project for lifecycle in context["lifecycles"] for stage in lifecycle["stages"] for project in stage.get("projects", []))
+                url = context["next_page_url"]
+        self.assertEqual(seen, sorted(readable, key=lambda p : p.created, reverse=True))
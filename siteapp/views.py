@@ -1,4 +1,5 @@
 import random
+import threading
 
 from django.shortcuts import render, redirect, get_object_or_404
 from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse, HttpResponseNotAllowed
@@ -65,36 +66,67 @@ def assign_project_lifecycle_stage(projects):
             )
 
     # Load each project's lifecycle stage, which is computed by each project's
-    # root task's app's output document named govready_lifecycle_stage_code.
-    # That output document yields a string identifying a lifecycle stage.
+    # root task's app's output document named govready_lifecycle_stage_code
+    # and stored on the project. That output document yields a string
+    # identifying a lifecycle stage.
     for project in projects:
-        outputs = project.root_task.render_output_documents()
-        for doc in outputs:
-            if doc.get("id") == "govready_lifecycle_stage_code":
-                value = doc["text"].strip()
-                if value in lifecycle_stage_code_mapping:
-                    project.lifecycle_stage = lifecycle_stage_code_mapping[value]
-                    break
+        value = project.get_lifecycle_stage_code()
+        if value in lifecycle_stage_code_mapping:
+            project.lifecycle_stage = lifecycle_stage_code_mapping[value]
         else:
             # No matching output document with a non-empty value.
             project.lifecycle_stage = lifecycle_stage_code_mapping["none_none"]
 
 
+# The ways the project list can be sorted: ?sort= value => label. The
+# values are Project fields to order by, descending if prefixed with "-".
+PROJECT_LIST_SORTS = [
+    ("created", "Oldest first"),
+    ("-created", "Newest first"),
+    ("-updated", "Recently updated"),
+]
+PROJECT_LIST_PAGE_SIZE = 30
+
 def project_list(request):
+    from django.db.models import Q
+    from urllib.parse import urlencode
+
     # Get all of the projects that the user can see *and* that are in a folder,
     # which indicates it is top-level.
     projects = Project.get_projects_with_read_priv(
         request.user, request.organization,
         excludes={ "contained_in_folders": None })
 
-    # Sort the projects by their creation date. The projects
+    # Sort the projects, by default by their creation date. The projects
     # won't always appear in that order, but it will determine
-    # the overall order of the page in a stable way.
-    projects = sorted(projects, key = lambda project : project.created)
-
-    # Load each project's lifecycle stage, which is computed by each project's
-    # root task's app's output document named govready_lifecycle_stage_code.
-    # That output document yields a string identifying a lifecycle stage.
+    # the overall order of the page in a stable way. Break ties by ID
+    # so that the order is total, which the cursor below relies on.
+    sort = request.GET.get("sort")
+    if sort not in dict(PROJECT_LIST_SORTS):
+        sort = PROJECT_LIST_SORTS[0][0]
+    sort_field = sort.lstrip("-")
+    descending = sort.startswith("-")
+    projects = projects.order_by(sort, "-id" if descending else "id")
+
+    # Paginate. The cursor in ?after= is the ID of the last project on the
+    # previous page, and the page is the projects that come after it in the
+    # sort order, so that a page costs the same no matter how deep it is.
+    try:
+        after = int(request.GET.get("after", ""))
+        after_value = projects.filter(id=after).values_list(sort_field, flat=True).get()
+    except (ValueError, Project.DoesNotExist):
+        pass # first page
+    else:
+        op = "lt" if descending else "gt"
+        projects = projects.filter(
+            Q(**{ sort_field + "__" + op: after_value })
+            | Q(**{ sort_field: after_value, "id__" + op: after }))
+    projects = list(projects[:PROJECT_LIST_PAGE_SIZE+1])
+    has_next_page = len(projects) > PROJECT_LIST_PAGE_SIZE
+    projects = projects[:PROJECT_LIST_PAGE_SIZE]
+
+    # Load each project's lifecycle stage, which is stored on the project
+    # when answers change, so no output documents are rendered here.
     assign_project_lifecycle_stage(projects)
 
     # Group projects into lifecyle types, and then lifecycle stages. The lifecycle
@@ -108,8 +140,19 @@ def project_list(request):
         # Put the project into the lifecycle's appropriate stage.
         project.lifecycle_stage[1].setdefault("projects", []).append(project)
 
+    # Make links to other sort orders and pages.
+    def make_url(**qsargs):
+        qsargs = { k: v for k, v in qsargs.items() if v }
+        return "?" + urlencode(qsargs)
+
     return render(request, "projects.html", {
         "lifecycles": lifecycles,
+        "sorts": [
+            { "label": label, "url": make_url(sort=value), "selected": value == sort }
+            for value, label in PROJECT_LIST_SORTS
+        ],
+        "first_page_url": make_url(sort=sort) if "after" in request.GET else None,
+        "next_page_url": make_url(sort=sort, after=projects[-1].id) if has_next_page else None,
         "can_invite_to_org": request.user.can_see_org_settings,
         "send_invitation": Invitation.form_context_dict(request.user, request.organization.get_organization_project(), [request.user]),
     })
@@ -117,14 +160,19 @@ def project_list(request):
 
 def get_compliance_apps_catalog(organization, reset_cache=False):
     # Load the compliance apps available to the given organization.
-    # Since accessing remote AppSources is an expensive operation,
-    # cache the catalog information.
+    return get_compliance_apps_catalog_and_index(organization, reset_cache=reset_cache)[0]
 
-    from django.core.cache import cache
+def get_compliance_apps_catalog_and_index(organization, reset_cache=False):
+    # Load the compliance apps available to the given organization
+    # and an AppCatalogIndex over them. Since accessing remote AppSources
+    # is an expensive operation, cache the catalog information.
 
     from guidedmodules.models import AppSource
+    from .app_catalog_index import AppCatalogIndex
 
     apps = []
+    indexes = []
+    approved_apps = { }
 
     # For each AppSource....
     for appsrc in AppSource.objects.all():
@@ -132,24 +180,12 @@ def get_compliance_apps_catalog(organization, reset_cache=False):
         if appsrc.is_system_source:
             continue
 
-        # If we don't have cached catalog info for this source...
-        # (keyed off of the current state of the AppSource instance)
-        cache_key = "compliance_catalog_source_{}".format(appsrc.id)
-        cache_stale_key = appsrc.make_cache_stale_key()
-        cached_apps = cache.get(cache_key, (None, None))
-        if cached_apps[0] != cache_stale_key or reset_cache:
-            # Connect to the remote app data...
-            with appsrc.open() as appsrc_connection:
-                # Iterate through all of the apps provided by this source.
-                cached_apps = []
-                for app in appsrc_connection.list_apps():
-                    # Render the catalog info for display.
-                    app = render_app_catalog_entry(app)
-                    cached_apps.append(app)
-
-                # Cache the results.
-                cached_apps = (cache_stale_key, cached_apps)
-                cache.set(cache_key, cached_apps)
+        # Get the catalog info for this source, rebuilding it now if
+        # we're asked to.
+        if reset_cache:
+            cached_apps, cached_index = build_app_catalog_for_source(appsrc)
+        else:
+            cached_apps, cached_index = get_app_catalog_for_source(appsrc)
 
         # Add the apps in this source to the returned list. But apps
         # from private sources are only listed if the organization
@@ -159,9 +195,102 @@ def get_compliance_apps_catalog(organization, reset_cache=False):
             continue
 
         # Add the apps from the cached data structure.
-        apps.extend(cached_apps[1])
+        apps.extend(cached_apps)
+        indexes.append(cached_index)
+        approved_apps[appsrc.id] = appsrc.approved_apps or {}
+
+    index = AppCatalogIndex.combine(indexes)
+    index.approved_apps = approved_apps
+    return apps, index
+
+def get_app_catalog_cache_key(appsrc):
+    return "compliance_catalog_index_source_{}".format(appsrc.id)
+
+def get_app_catalog_for_source(appsrc):
+    # Return the last known catalog info for the source. If the
+    # cached catalog info is stale (keyed off of the current state
+    # of the AppSource instance), the last known catalog is returned
+    # anyway and a fresh one is built in the background so that the
+    # request doesn't have to wait on the remote source. The catalog
+    # is only built synchronously when we don't have one at all.
+    from django.core.cache import cache
+    cached_apps = cache.get(get_app_catalog_cache_key(appsrc))
+    if cached_apps is None:
+        return build_app_catalog_for_source(appsrc)
+    if cached_apps[0] != appsrc.make_cache_stale_key():
+        refresh_app_catalog_in_background(appsrc)
+    return cached_apps[1:]
+
+def is_app_catalog_stale(appsrc):
+    from django.core.cache import cache
+    cached_apps = cache.get(get_app_catalog_cache_key(appsrc))
+    return cached_apps is None or cached_apps[0] != appsrc.make_cache_stale_key()
 
-    return apps
+def build_app_catalog_for_source(appsrc):
+    # Connect to the remote app data and build the catalog info
+    # and an AppCatalogIndex for the source, cache them, and return
+    # them. The time it took is recorded on the AppSource.
+    from django.core.cache import cache
+    from .app_catalog_index import AppCatalogIndex
+    import time
+
+    cache_stale_key = appsrc.make_cache_stale_key()
+    start_time = time.time()
+    try:
+        with appsrc.open() as appsrc_connection:
+            # Iterate through all of the apps provided by this source.
+            cached_apps = []
+            for app in appsrc_connection.list_apps():
+                # Render the catalog info for display.
+                app = render_app_catalog_entry(app)
+                cached_apps.append(app)
+
+        # Index the apps for searching.
+        cached_index = AppCatalogIndex(cached_apps)
+    except Exception as e:
+        appsrc.record_catalog_build(time.time() - start_time, 0, error=e)
+        raise
+    appsrc.record_catalog_build(time.time() - start_time, len(cached_apps))
+
+    # Cache the results. The entry doesn't expire: it's replaced when
+    # it becomes stale, and until then it's what we show.
+    cache.set(get_app_catalog_cache_key(appsrc), (cache_stale_key, cached_apps, cached_index), None)
+
+    return cached_apps, cached_index
+
+_app_catalog_refreshes = set() # ids of AppSources being refreshed
+_app_catalog_refreshes_lock = threading.Lock()
+
+def refresh_app_catalog_in_background(appsrc):
+    # Rebuild the catalog info for the source on a background thread,
+    # unless it's already being rebuilt by this process.
+    with _app_catalog_refreshes_lock:
+        if appsrc.id in _app_catalog_refreshes:
+            return
+        _app_catalog_refreshes.add(appsrc.id)
+    threading.Thread(
+        target=_refresh_app_catalog,
+        args=(appsrc.id,),
+        name="app-catalog-refresh-{}".format(appsrc.id),
+        daemon=True).start()
+
+def _refresh_app_catalog(appsrc_id):
+    from django.db import connection
+    from guidedmodules.models import AppSource
+    import logging
+    try:
+        appsrc = AppSource.objects.filter(id=appsrc_id).first()
+        if appsrc is not None:
+            build_app_catalog_for_source(appsrc)
+    except Exception:
+        # Keep serving the last known catalog. The error is recorded
+        # on the AppSource.
+        logging.exception("Refreshing the app catalog for AppSource {} failed.".format(appsrc_id))
+    finally:
+        with _app_catalog_refreshes_lock:
+            _app_catalog_refreshes.discard(appsrc_id)
+        # This thread got its own database connection.
+        connection.close()
 
 def render_app_catalog_entry(app):
             from guidedmodules.module_logic import render_content
@@ -197,14 +326,6 @@ def render_app_catalog_entry(app):
                 "%s %s" % (repr(catalog_info["name"]), "short description")
             )
 
-            catalog_info["search_haystak"] = "".join([
-                app.name,
-                catalog_info["title"],
-                catalog_info.get("vendor", ""),
-                catalog_info["description"]["short"],
-                catalog_info["description"]["long"],
-            ])
-
             # Convert the app icon raw bytes data to a data URL.
             if "app-icon" in catalog_info:
                 from guidedmodules.models import image_to_dataurl
@@ -239,43 +360,21 @@ def app_satifies_interface(app, filter_protocols):
         raise ValueError(filter_protocols)
 
     # Get the protocols implemented by the app.
-    if isinstance(app.get("protocol"), str):
-        # Just one - wrap in a set().
-        app_protocols = { app["protocol"] }
-    elif isinstance(app.get("protocol"), list):
-        # It's an array. Unique-ify with a set.
-        app_protocols = set(app["protocol"])
-    else:
-        # no protocol or invalid data type
-        app_protocols = set()
+    from .app_catalog_index import get_app_protocols
+    app_protocols = get_app_protocols(app)
 
     # Check that every protocol required by the question is implemented by the
     # app.
     return filter_protocols <= set(app_protocols)
 
 
-def filter_app_catalog(catalog, request):
+def filter_app_catalog(catalog, index, request):
+    # Filter the catalog using its AppCatalogIndex (see
+    # get_compliance_apps_catalog_and_index).
     filter_description = None
 
     # Filter out unpublished apps.
-    from guidedmodules.models import AppSource
-    approved_apps = { src.id: (src.approved_apps or {}) for src in AppSource.objects.all() }
-    def is_app_available(app):
-        # Query the AppSource for whether this app is considered
-        # published or not.
-        try:
-            published = approved_apps[app["appsource_id"]][app["name"]]
-
-        # Fall back to the app's catalog information.
-        except KeyError:
-            published = app.get("published")
-
-        # Hide if unpublished
-        if published == "unpublished":
-            return False
-        return True
-
-    catalog = filter(is_app_available, catalog)
+    catalog = filter(index.is_app_published, catalog)
 
     if request.GET.get("q"):
         # Check if the app satisfies the interface required by a paricular question.
@@ -283,17 +382,21 @@ def filter_app_catalog(catalog, request):
         # It must be a module-type question with a protocol filter. Only apps that
         # satisfy that protocol are shown.
         task, q = get_task_question(request)
-        catalog = filter(lambda app : app_satifies_interface(app, q), catalog)
+        keys = index.get_apps_implementing_question(q)
+        catalog = filter(lambda app : app["key"] in keys, catalog)
         filter_description = q.spec["title"]
 
     if request.GET.get("protocol"):
         # Check if the app satisfies the app protocol interface given.
-        catalog = filter(lambda app : app_satifies_interface(app, request.GET["protocol"].split(",")), catalog)
+        keys = index.get_apps_implementing(request.GET["protocol"].split(","))
+        catalog = filter(lambda app : app["key"] in keys, catalog)
         filter_description = None # can't generate nice description of this filter
 
     return catalog, filter_description
 
 
+APPS_CATALOG_PAGE_SIZE = 30
+
 @login_required
 def apps_catalog(request):
     # A POST from a Django user with permission on AppSources
@@ -308,42 +411,90 @@ def apps_catalog(request):
     from urllib.parse import urlencode
     forward_qsargs = { }
     if "q" in request.GET: forward_qsargs["q"] = request.GET["q"]
+    if "protocol" in request.GET: forward_qsargs["protocol"] = request.GET["protocol"]
 
     # Get the app catalog. If the user is answering a question, then filter to
     # just the apps that can answer that question.
     from guidedmodules.app_source_connections import AppSourceConnectionError
     try:
-        catalog, filter_description = filter_app_catalog(get_compliance_apps_catalog(request.organization), request)
+        catalog, index = get_compliance_apps_catalog_and_index(request.organization)
+        catalog, filter_description = filter_app_catalog(catalog, index, request)
+        catalog = list(catalog)
     except (ValueError, AppSourceConnectionError) as e:
         return render(request, "app-store.html", {
             "error": e,
             "apps": [],
         })        
 
-    # Group by category from catalog metadata.
-    from collections import defaultdict
-    catalog_by_category = defaultdict(lambda : { "title": None, "apps": [] })
+    # List every category of the apps that can be shown, for navigation,
+    # before the catalog is narrowed by the search and category filters.
+    # Sort categories by title.
+    from .app_catalog_index import get_app_categories
+    def category_sort_key(title):
+        return (
+            title != "Great starter apps", # this category goes first
+            title.lower(), # sort case insensitively
+            title, # except if two categories differ only in case, sort case-sensitively
+        )
+    categories = sorted(
+        { (category or "Uncategorized") for app in catalog for category in get_app_categories(app) },
+        key=category_sort_key)
+
+    # Search the catalog using the index.
+    search = request.GET.get("search", "").strip()
+    if search:
+        keys = index.search(search)
+        catalog = [app for app in catalog if app["key"] in keys]
+
+    # List each app under each of its categories, or just under the
+    # category the user has chosen. Sort by category and then by app
+    # title within each category.
+    category_filter = request.GET.get("category")
+    entries = []
     for app in catalog:
-        for category in app.get("categories", [app.get("category")]):
-            catalog_by_category[category]["title"] = (category or "Uncategorized")
-            catalog_by_category[category]["apps"].append(app)
-
-    # Sort categories by title and discard keys.
-    catalog_by_category = sorted(catalog_by_category.values(), key = lambda category : (
-        category["title"] != "Great starter apps", # this category goes first
-        category["title"].lower(), # sort case insensitively
-        category["title"], # except if two categories differ only in case, sort case-sensitively
-        ))
-
-    # Sort the apps within each category.
-    for category in catalog_by_category:
-        category["apps"].sort(key = lambda app : (
-            app["title"].lower(), # sort case-insensitively
-            app["title"], # except if two apps differ only in case, sort case-sensitively
-        ))
+        for category in get_app_categories(app):
+            category = (category or "Uncategorized")
+            if category_filter and category != category_filter:
+                continue
+            entries.append((category, app))
+    entries.sort(key = lambda entry : (
+        category_sort_key(entry[0]),
+        entry[1]["title"].lower(), # sort case-insensitively
+        entry[1]["title"], # except if two apps differ only in case, sort case-sensitively
+    ))
+
+    # Paginate, and then group the apps on the page by category.
+    from django.core.paginator import Paginator, InvalidPage
+    paginator = Paginator(entries, APPS_CATALOG_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get("page", 1))
+    except InvalidPage:
+        page = paginator.page(1)
+    catalog_by_category = []
+    for category, app in page.object_list:
+        if not catalog_by_category or catalog_by_category[-1]["title"] != category:
+            catalog_by_category.append({ "title": category, "apps": [] })
+        catalog_by_category[-1]["apps"].append(app)
+
+    # Make links to other categories and pages that keep the other filters.
+    def make_url(**new_qsargs):
+        qsargs = dict(forward_qsargs, search=search, category=category_filter)
+        qsargs.update(new_qsargs)
+        qsargs = { k: v for k, v in qsargs.items() if v }
+        return "?" + urlencode(qsargs)
 
     return render(request, "app-store.html", {
         "apps": catalog_by_category,
+        "categories": [
+            { "title": category, "url": make_url(category=category), "selected": category == category_filter }
+            for category in categories
+        ],
+        "all_categories_url": make_url(category=None),
+        "category_filter": category_filter,
+        "search": search,
+        "page": page,
+        "prev_page_url": make_url(page=page.previous_page_number()) if page.has_previous() else None,
+        "next_page_url": make_url(page=page.next_page_number()) if page.has_next() else None,
         "filter_description": filter_description,
         "forward_qsargs": ("?" + urlencode(forward_qsargs)) if forward_qsargs else "",
         "can_clear_catalog_cache": can_clear_catalog_cache,
@@ -353,13 +504,12 @@ def apps_catalog(request):
 def apps_catalog_item(request, source_slug, app_name):
     # Is this a module the user has access to? The app store
     # does some authz based on the organization.
-    from guidedmodules.models import AppSource
-    catalog, _ = filter_app_catalog(get_compliance_apps_catalog(request.organization), request)
-    for app_catalog_info in catalog:
-        if app_catalog_info["key"] == source_slug + "/" + app_name:
-            # We found it.
-            break
-    else:
+    catalog, index = get_compliance_apps_catalog_and_index(request.organization)
+    app_catalog_info = index.get_app(source_slug + "/" + app_name)
+    if app_catalog_info is None:
+        raise Http404()
+    catalog, _ = filter_app_catalog([app_catalog_info], index, request)
+    if not list(catalog):
         raise Http404()
 
     error = None
@@ -449,8 +599,9 @@ def start_app(app_catalog_info, organization, user, folder, task, q):
                 if app.get_catalog_info()["authz"] != "none":
                     raise ValueError("Invalid access.")
 
-                # 4) Import. Use the module named "app".
-                appinst = load_app_into_database(app)
+                # 4) Import, re-using an AppInstance previously loaded from
+                #    identical app content. Use the module named "app".
+                appinst = load_app_into_database(app, reuse_identical=True)
                 module = appinst.modules.get(module_name="app")
 
         else:
@@ -700,7 +851,7 @@ def project(request, project):
         "project": project,
 
         "is_admin": request.user in project.get_admins(),
-        "can_upgrade_app": project.root_task.module.app.has_upgrade_priv(request.user),
+        "can_upgrade_app": project.root_task.module.app.has_upgrade_priv(request.user, project),
         "can_start_task": can_start_task,
         "can_start_any_apps": can_start_any_apps,
 
@@ -1002,8 +1153,13 @@ def delete_project(request, project):
     
     # Get the project's parents for redirect.
     parents = project.get_parent_projects()
+    member_ids = list(project.members.values_list("user_id", flat=True))
     project.delete()
 
+    # The members may have lost access to the organization.
+    for user_id in member_ids:
+        User.clear_org_access_cache(user_id)
+
     # Only choose parents the user can see.
     parents = [parent for parent in parents if parent.has_read_priv(request.user)]
     if len(parents) > 0:
@@ -1051,7 +1207,7 @@ def import_project_data(request, project):
 
 def project_start_apps(request, *args):
     # Load the Compliance Store catalog of apps.
-    all_apps = get_compliance_apps_catalog(request.organization)
+    _, index = get_compliance_apps_catalog_and_index(request.organization)
 
     # What questions can be answered with an app?
     def get_questions(project):
@@ -1064,7 +1220,9 @@ def project_start_apps(request, *args):
              and  q.spec.get("protocol") \
              and (q.key not in root_task_answers or q.spec["type"] == "module-set"):
                 # What apps can be used to start this question?
-                q.startable_apps = list(filter(lambda app : app_satifies_interface(app, q), all_apps))
+                q.startable_apps = sorted(
+                    (index.get_app(key) for key in index.get_apps_implementing_question(q)),
+                    key = lambda app : (app["title"].lower(), app["title"]))
                 if len(q.startable_apps) > 0:
                     yield q
 
@@ -1133,7 +1291,7 @@ def project_upgrade_app(request, project):
     return render(request, "project-upgrade-app.html", {
         "page_title": "Upgrade App",
         "project": project,
-        "can_upgrade_app": project.root_task.module.app.has_upgrade_priv(request.user),
+        "can_upgrade_app": project.root_task.module.app.has_upgrade_priv(request.user, project),
         "error": error,
         "app": app,
     })